@@ -36,6 +36,7 @@ ${SSHCMD} "sudo cp ${WEBROOT}deploy/nginx-cloudstrype.conf ${CONFIG_NGINX}"
 ${SSHCMD} "sudo cp ${WEBROOT}deploy/hitch-cloudstrype.conf ${CONFIG_HITCH}"
 ${SSHCMD} "sudo cp ${WEBROOT}deploy/supervisord-uwsgi.ini ${CONFIG_SUPERVISORD}"
 ${SSHCMD} "sudo cp ${WEBROOT}deploy/supervisord-array.ini ${CONFIG_SUPERVISORD}"
+${SSHCMD} "sudo cp ${WEBROOT}deploy/supervisord-transfer.ini ${CONFIG_SUPERVISORD}"
 
 # Restart serices
 if ! ${SSHCMD} "sudo nginx -t -c /etc/nginx/nginx.conf"; then
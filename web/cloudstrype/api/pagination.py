@@ -0,0 +1,136 @@
+"""
+Directory listing pagination.
+
+Listings are paged using a cursor (keyset) rather than an offset, so that
+fetching a page deep into a huge directory is as cheap as fetching the first.
+Directories are listed before files, each ordered by (name, id). A file's
+versions are paged the same way, newest first.
+"""
+
+import json
+
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from rest_framework import exceptions
+
+
+DIRS = 'd'
+FILES = 'f'
+VERSIONS = 'v'
+
+
+def encode_cursor(kind, name=None, id=None):
+    """
+    Encode a position within a listing.
+
+    The cursor points after the given entry, or at the start of kind when name
+    is None.
+    """
+    data = json.dumps([kind, name, id]).encode('utf-8')
+    return urlsafe_b64encode(data).decode('ascii')
+
+
+def decode_cursor(cursor, kinds=(DIRS, FILES)):
+    """
+    Decode a cursor produced by encode_cursor().
+
+    Raises ValidationError if the cursor is not valid (or not of kinds).
+    """
+    try:
+        kind, name, id = json.loads(
+            urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError, UnicodeError):
+        raise exceptions.ValidationError('Invalid cursor')
+    if kind not in kinds:
+        raise exceptions.ValidationError('Invalid cursor')
+    return kind, name, id
+
+
+def after(queryset, name, id):
+    """Return the entries of queryset that follow (name, id)."""
+    queryset = queryset.order_by('name', 'id')
+    if name is None:
+        return queryset
+    return queryset.filter(Q(name__gt=name) | Q(name=name, id__gt=id))
+
+
+def _page(queryset, limit):
+    """
+    Select a page from an ordered queryset.
+
+    Only the keys are fetched here, the returned queryset (of len(keys) items)
+    is evaluated by the caller, so related objects can still be prefetched.
+    """
+    keys = list(queryset.values_list('name', 'id')[:limit + 1])
+    return queryset[:min(len(keys), limit)], keys
+
+
+def paginate(dirs, files, cursor=None, limit=100):
+    """
+    Select a page of a directory listing.
+
+    Returns (dirs, files, next) where next is the cursor for the following
+    page, or None if this is the last page.
+    """
+    kind, name, id = DIRS, None, None
+    if cursor:
+        kind, name, id = decode_cursor(cursor)
+
+    if kind == DIRS:
+        dirs, keys = _page(after(dirs, name, id), limit)
+        if len(keys) > limit:
+            return dirs, files.none(), encode_cursor(DIRS, *keys[limit - 1])
+        limit -= len(keys)
+        name, id = None, None
+    else:
+        dirs = dirs.none()
+
+    files, keys = _page(after(files, name, id), limit)
+    if len(keys) > limit:
+        if limit == 0:
+            # The page was filled by directories.
+            return dirs, files, encode_cursor(FILES)
+        return dirs, files, encode_cursor(FILES, *keys[limit - 1])
+    return dirs, files, None
+
+
+def iterate(dirs, files, cursor=None, size=100):
+    """
+    Iterate over a directory listing a page at a time.
+
+    Yields (dirs, files) for each page, starting at cursor.
+    """
+    while True:
+        page_dirs, page_files, cursor = paginate(dirs, files, cursor, size)
+        yield page_dirs, page_files
+        if cursor is None:
+            break
+
+
+def paginate_versions(versions, cursor=None, limit=100):
+    """
+    Select a page of versions, newest first.
+
+    Returns (versions, next) where next is the cursor for the following page,
+    or None if this is the last page.
+    """
+    versions = versions.order_by('-created', '-id')
+    if cursor:
+        _, created, id = decode_cursor(cursor, kinds=(VERSIONS,))
+        try:
+            created = parse_datetime(created)
+        except (ValueError, TypeError):
+            created = None
+        if created is None:
+            raise exceptions.ValidationError('Invalid cursor')
+        versions = versions.filter(
+            Q(created__lt=created) | Q(created=created, id__lt=id))
+    versions = list(versions[:limit + 1])
+    if len(versions) > limit:
+        last = versions[limit - 1]
+        return versions[:limit], encode_cursor(
+            VERSIONS, last.created.isoformat(), last.id)
+    return versions, None
@@ -1,14 +1,24 @@
+import json
 import mock
+import os
+import shutil
+import tarfile
+import tempfile
 
 from io import BytesIO
 
-from django.test import TestCase
+from django.core import signing
+from django.core.cache import cache
+from django.test import TestCase, override_settings
 from django.urls import reverse
 
 from rest_framework.test import APIClient
 
+from main.fs import get_fs, CHUNK_CACHE_WRITER
+from main.fs.transfer import Transfer
 from main.models import (
-    User, Option, Storage, UserFile, UserDir, Tag,
+    User, Option, Storage, UserFile, UserDir, Tag, Chunk, ChunkStorage, Job,
+    RetentionPolicy,
 )
 from main.tests.test_fs import MockClients
 
@@ -74,6 +84,235 @@ class APIFSTestCase(TestCase):
             self.assertEqual(TEST_FILE_BODY,
                              b''.join(list(r.streaming_content)))
 
+    def test_upload_stream(self):
+        with MockClients(self.user).patch():
+            # The raw body is the file.
+            r = self.client.post(
+                reverse('api:files_data_path', args=('/foo',)) +
+                '?format=json', TEST_FILE_BODY,
+                content_type='application/octet-stream')
+            self.assertEqual(200, r.status_code)
+            self.assertEqual(len(TEST_FILE_BODY), r.json()['size'])
+
+            file = UserFile.objects.get()
+            # The test client only sends a content type with a body.
+            r = self.client.post(
+                reverse('api:files_data_uid', args=(file.uid,)) +
+                '?format=json', b'', content_type='application/octet-stream',
+                CONTENT_TYPE='application/octet-stream')
+            self.assertEqual(200, r.status_code)
+            self.assertEqual(0, r.json()['size'])
+
+            with get_fs(self.user).download('/foo') as f:
+                self.assertEqual(b'', b''.join(f))
+
+    def test_transfer(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with override_settings(CLOUDSTRYPE_TRANSFER_LOCATION='/transfer/',
+                               CLOUDSTRYPE_TRANSFER_UPLOAD_DIR=tmpdir,
+                               CLOUDSTRYPE_INLINE_THRESHOLD=0,
+                               TRANSFER_SERVER='nginx'), \
+                MockClients(self.user).patch():
+            # As spooled by the nginx upload module.
+            temp = os.path.join(tmpdir, '0000000001')
+            with open(temp, 'wb') as f:
+                f.write(TEST_FILE_BODY)
+            r = self.client.post(
+                reverse('api:files_data_path', args=('/foo',)),
+                {'file[filename]': 'foo', 'file[path]': temp})
+            self.assertEqual(200, r.status_code)
+            location = r['X-Accel-Redirect']
+            self.assertTrue(location.startswith('/transfer/'))
+            transfer = Transfer(location[len('/transfer/'):])
+            file = transfer.upload()
+            self.assertEqual('/foo', file.path)
+            self.assertFalse(os.path.exists(temp))
+
+            r = self.client.get(
+                reverse('api:files_data_path', args=('/foo',)),
+                {'format': 'json', 'download': 1})
+            self.assertEqual(200, r.status_code)
+            transfer = Transfer(r['X-Accel-Redirect'][len('/transfer/'):])
+            self.assertEqual('attachment; filename="foo"',
+                             transfer.claims['disposition'])
+            _, _, reader = transfer.download()
+            with reader:
+                self.assertEqual(TEST_FILE_BODY, b''.join(reader))
+
+            # Only files spooled by nginx are accepted.
+            r = self.client.post(
+                reverse('api:files_data_path', args=('/bar',)),
+                {'file[filename]': 'bar', 'file[path]': __file__})
+            self.assertEqual(400, r.status_code)
+            with self.assertRaises(signing.BadSignature):
+                Transfer(location[len('/transfer/'):] + 'x')
+
+    def test_batch_upload(self):
+        with MockClients(self.user).patch():
+            r = self.client.post(
+                reverse('api:dirs_data_path', args=('/foo',)) +
+                '?format=json', {
+                    'a': BytesIO(TEST_FILE_BODY),
+                    'bar/b': BytesIO(TEST_FILE_BODY),
+                })
+            self.assertEqual(200, r.status_code)
+            results = r.json()['results']
+            self.assertEqual(['/foo/a', '/foo/bar/b'],
+                             sorted(result['path'] for result in results))
+            self.assertEqual([15, 15], [result['info']['size']
+                                        for result in results])
+
+            archive = BytesIO()
+            with tarfile.open(fileobj=archive, mode='w') as tar:
+                for name in ('c', 'bar/d'):
+                    info = tarfile.TarInfo(name)
+                    info.size = len(TEST_FILE_BODY)
+                    tar.addfile(info, BytesIO(TEST_FILE_BODY))
+            r = self.client.post(
+                reverse('api:dirs_data_path', args=('/foo',)) +
+                '?format=json', archive.getvalue(),
+                content_type='application/x-tar')
+            self.assertEqual(200, r.status_code)
+            self.assertEqual(
+                [('/foo/c', 'c'), ('/foo/bar/d', 'd')],
+                [(result['path'], result['info']['name'])
+                 for result in r.json()['results']])
+
+            fs = get_fs(self.user)
+            self.assertEqual(2, len(fs.listdir('/foo/bar').files))
+
+            r = self.client.post(
+                reverse('api:dirs_data_path', args=('/foo',)) +
+                '?format=json', b'not a tar', content_type='application/x-tar')
+            self.assertEqual(400, r.status_code)
+
+            escape = BytesIO()
+            with tarfile.open(fileobj=escape, mode='w') as tar:
+                for name in ('e', 'bar/../../f'):
+                    info = tarfile.TarInfo(name)
+                    info.size = len(TEST_FILE_BODY)
+                    tar.addfile(info, BytesIO(TEST_FILE_BODY))
+            r = self.client.post(
+                reverse('api:dirs_data_path', args=('/foo',)) +
+                '?format=json', escape.getvalue(),
+                content_type='application/x-tar')
+            self.assertEqual(400, r.status_code)
+            self.assertFalse(fs.exists('/f'))
+            self.assertFalse(fs.exists('/foo/e'))
+
+            limit = len(TEST_FILE_BODY) * 2 - 1
+            with self.settings(API_UPLOAD_BATCH_TOTAL_SIZE=limit):
+                r = self.client.post(
+                    reverse('api:dirs_data_path', args=('/foo',)) +
+                    '?format=json', archive.getvalue(),
+                    content_type='application/x-tar')
+                self.assertEqual(400, r.status_code)
+            with self.settings(API_UPLOAD_BATCH_FILE_SIZE=limit // 2):
+                r = self.client.post(
+                    reverse('api:dirs_data_path', args=('/foo',)) +
+                    '?format=json', archive.getvalue(),
+                    content_type='application/x-tar')
+                self.assertEqual(400, r.status_code)
+
+    def test_upload_session(self):
+        parts = [TEST_FILE_BODY, b'second part', b'last']
+
+        def url(name, **kwargs):
+            return reverse(name, kwargs=kwargs) + '?format=json'
+
+        with MockClients(self.user).patch():
+            r = self.client.post(
+                url('api:uploads'),
+                json.dumps({'path': '/foo', 'size': sum(map(len, parts))}),
+                content_type='application/json')
+            self.assertEqual(201, r.status_code)
+            uid = r.json()['uid']
+
+            # Out of order, and the first part twice.
+            for number in (3, 1, 1):
+                r = self.client.put(
+                    url('api:upload_part', uid=uid, number=number),
+                    parts[number - 1],
+                    content_type='application/octet-stream')
+                self.assertEqual(200, r.status_code)
+                self.assertEqual(len(parts[number - 1]), r.json()['size'])
+            # The replaced part is released.
+            self.assertEqual(1, Chunk.objects.filter(refcount=0).count())
+
+            r = self.client.post(url('api:upload_commit', uid=uid))
+            self.assertEqual(400, r.status_code)
+            r = self.client.get(url('api:upload', uid=uid))
+            self.assertEqual([1, 3],
+                             [p['number'] for p in r.json()['parts']])
+
+            r = self.client.put(url('api:upload_part', uid=uid, number=2),
+                                parts[1],
+                                content_type='application/octet-stream')
+            self.assertEqual(200, r.status_code)
+            r = self.client.post(url('api:upload_commit', uid=uid))
+            self.assertEqual(200, r.status_code)
+            self.assertEqual(sum(map(len, parts)), r.json()['size'])
+
+            CHUNK_CACHE_WRITER.join()
+            with get_fs(self.user).download('/foo') as f:
+                self.assertEqual(b''.join(parts), b''.join(f))
+            self.assertEqual(
+                404, self.client.get(url('api:upload', uid=uid)).status_code)
+
+            r = self.client.post(url('api:uploads'),
+                                 json.dumps({'path': '/'}),
+                                 content_type='application/json')
+            self.assertEqual(400, r.status_code)
+
+    def test_changes(self):
+        r = self.client.get(reverse('api:changes'), {'format': 'json'})
+        self.assertEqual(200, r.status_code)
+        cursor = r.json()['cursor']
+
+        with MockClients(self.user).patch():
+            fs = get_fs(self.user)
+            fs.mkdir('/foo')
+            with BytesIO(TEST_FILE_BODY) as f:
+                fs.upload('/foo/a', f)
+            with BytesIO(TEST_FILE_BODY) as f:
+                fs.upload('/foo/a', f)
+            fs.tag('/foo/a', 'qux')
+            fs.move('/foo', '/bar')
+            fs.delete('/bar/a')
+            fs.rmdir('/bar')
+
+        changes = []
+        while True:
+            r = self.client.get(reverse('api:changes'), {
+                'format': 'json', 'cursor': cursor, 'limit': 3})
+            self.assertEqual(200, r.status_code)
+            self.assertLessEqual(len(r.json()['changes']), 3)
+            changes.extend(r.json()['changes'])
+            cursor = r.json()['cursor']
+            if not r.json()['more']:
+                break
+        self.assertEqual([
+            ('create', 'dir', '/foo', None),
+            ('create', 'file', '/foo/a', None),
+            ('update', 'file', '/foo/a', None),
+            ('tag', 'file', '/foo/a', None),
+            ('move', 'dir', '/bar', '/foo'),
+            ('delete', 'file', '/bar/a', None),
+            ('delete', 'dir', '/bar', None),
+        ], [(c['action'], c['type'], c['path'], c['old_path'])
+            for c in changes])
+
+        # Nothing new, waits (briefly) and returns the same cursor.
+        r = self.client.get(reverse('api:changes'), {
+            'format': 'json', 'cursor': cursor, 'timeout': 0.1})
+        self.assertEqual({'changes': [], 'cursor': cursor, 'more': False},
+                         r.json())
+
+        r = self.client.get(reverse('api:changes'), {
+            'format': 'json', 'cursor': 'foo'})
+        self.assertEqual(400, r.status_code)
+
 
 class APITestCase(TestCase):
     @classmethod
@@ -97,14 +336,22 @@ class APITestCase(TestCase):
         self.client.force_login(self.user)
 
     def test_public_cloud_list(self):
+        cache.delete('storage-summary')
+        Storage.objects.create(type=Storage.TYPE_DROPBOX, user=self.user)
         r = self.client.get(reverse('api:public_clouds'), {'format': 'json'})
         self.assertEqual(200, r.status_code)
         self.assertEqual(1, len(r.json()))
+        self.assertEqual('Dropbox', r.json()[0]['name'])
+        self.assertEqual(2, r.json()[0]['storages'])
 
     def test_cloud_list(self):
+        chunk = Chunk.objects.create(user=self.user, size=10)
+        ChunkStorage.objects.create(chunk=chunk, storage=self.storage)
         r = self.client.get(reverse('api:clouds'), {'format': 'json'})
         self.assertEqual(200, r.status_code)
         self.assertEqual(1, len(r.json()))
+        self.assertEqual(1, r.json()[0]['chunks'])
+        self.assertEqual(10, r.json()[0]['stored'])
 
     def test_me(self):
         r = self.client.get(reverse('api:me'), {'format': 'json'})
@@ -115,10 +362,106 @@ class APITestCase(TestCase):
         self.assertIn('first_name', r.json())
         self.assertIn('last_name', r.json())
 
+    def test_stats(self):
+        r = self.client.get(reverse('api:stats'), {'format': 'json'})
+        self.assertEqual(403, r.status_code)
+        admin = User.objects.create_superuser('admin@bar.org', 'password')
+        self.client.force_login(admin)
+        r = self.client.get(reverse('api:stats'), {'format': 'json'})
+        self.assertEqual(200, r.status_code)
+        self.assertIn('ratio', r.json()['dentry'])
+
+    def test_jobs(self):
+        job = Job.objects.create(user=self.user, type=Job.TYPE_SHARE,
+                                 total=10)
+        r = self.client.get(reverse('api:jobs'), {'format': 'json'})
+        self.assertEqual(200, r.status_code)
+        self.assertEqual(1, len(r.json()))
+        r = self.client.get(reverse('api:job', args=(job.uid,)),
+                            {'format': 'json'})
+        self.assertEqual(200, r.status_code)
+        self.assertEqual('Pending', r.json()['state'])
+        self.assertEqual(10, r.json()['total'])
+        r = self.client.get(reverse('api:job', args=('missing',)),
+                            {'format': 'json'})
+        self.assertEqual(404, r.status_code)
+
     def test_options(self):
         r = self.client.get(reverse('api:options'), {'format': 'json'})
         self.assertEqual(200, r.status_code)
 
+    def post_json(self, url, data):
+        return self.client.post(url + '?format=json', json.dumps(data),
+                                content_type='application/json')
+
+    def test_stat(self):
+        for i in range(3):
+            UserFile.objects.create(path='/foo/%s' % i, user=self.user)
+        paths = ['/foo/bar.txt', 'foo/', '/missing', '/foo/0', '/foo/1', '/']
+        uids = [self.file.uid, self.dir.uid, 'invalid']
+        # Files and directories are each fetched with a single query (plus
+        # the session, user and root directory).
+        with self.assertNumQueries(5):
+            r = self.post_json(reverse('api:stat'), {
+                'paths': paths, 'uids': uids, 'fields': 'name,size'})
+        self.assertEqual(200, r.status_code)
+        results = r.json()['results']
+        self.assertEqual(len(paths) + len(uids), len(results))
+        self.assertEqual(
+            ['file', 'dir', None, 'file', 'file', 'dir', 'file', 'dir', None],
+            [result.get('type') for result in results])
+        self.assertEqual({'path': '/foo/bar.txt', 'uid': self.file.uid,
+                          'name': 'bar.txt', 'size': 0}, results[0]['info'])
+        self.assertEqual('foo/', results[1]['path'])
+        self.assertEqual({'path': '/missing', 'error': 'Not found'},
+                         results[2])
+        self.assertEqual(self.dir.uid, results[7]['uid'])
+
+        r = self.post_json(reverse('api:stat'), {'paths': '/foo'})
+        self.assertEqual(400, r.status_code)
+        with self.settings(API_STAT_BATCH_SIZE=2):
+            r = self.post_json(reverse('api:stat'), {'paths': paths})
+        self.assertEqual(400, r.status_code)
+
+    def test_retention(self):
+        r = self.client.get(reverse('api:retention'), {'format': 'json'})
+        self.assertEqual(200, r.status_code)
+        self.assertIsNone(r.json()['keep_last'])
+        r = self.client.post(reverse('api:retention'), {'keep_last': 10})
+        self.assertEqual(200, r.status_code)
+        self.assertEqual(10, RetentionPolicy.objects.get(
+            user=self.user, file=None).keep_last)
+        r = self.client.post(
+            reverse('api:files_retention_uid', args=(self.file.uid,)),
+            {'keep_days': 30})
+        self.assertEqual(200, r.status_code)
+        self.assertEqual(30, self.file.file.retention_policy.keep_days)
+
+    def test_versions(self):
+        for i in range(4):
+            self.file.file.add_version()
+        versions, cursor = [], None
+        while True:
+            params = {'format': 'json', 'limit': 2}
+            if cursor:
+                params['cursor'] = cursor
+            r = self.client.get(
+                reverse('api:files_versions_uid', args=(self.file.uid,)),
+                params)
+            self.assertEqual(200, r.status_code)
+            self.assertLessEqual(len(r.json()['versions']), 2)
+            versions.extend(v['uid'] for v in r.json()['versions'])
+            cursor = r.json()['next']
+            if cursor is None:
+                break
+        self.assertEqual(
+            [v.uid for v in self.file.file.versions.order_by('-created')],
+            versions)
+        r = self.client.get(
+            reverse('api:files_versions_path', args=('/foo/bar.txt',)),
+            {'format': 'json', 'cursor': 'bad'})
+        self.assertEqual(400, r.status_code)
+
     def test_dirs_path(self):
         r = self.client.get(reverse('api:dirs_path', args=('/bar',)),
                             {'format': 'json'})
@@ -198,3 +541,109 @@ class APITestCase(TestCase):
                             {'format': 'json'})
         self.assertEqual(200, r.status_code)
         self.assertEqual(1, len(r.json()))
+
+
+class APIListingTestCase(TestCase):
+    """
+    Directory listings use a constant number of queries.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(email='foo@bar.org')
+        cls.other = User.objects.create_user(email='foo@baz.org')
+        cls.storage = Storage.objects.create(
+            type=Storage.TYPE_DROPBOX, user=cls.user)
+        Tag.objects.create(name='foo')
+        cls.dir = UserDir.objects.create(path='/foo', user=cls.user)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def add_files(self, count):
+        for _ in range(count):
+            i = UserFile.objects.filter(user=self.user).count()
+            file = UserFile.objects.create(path='/foo/%s.txt' % i,
+                                           user=self.user)
+            file.add_tag('foo')
+            file.file.add_version()
+            chunk = Chunk.objects.create(user=self.user, size=1)
+            file.file.version.add_chunk(chunk)
+            ChunkStorage.objects.create(chunk=chunk, storage=self.storage)
+            UserFile.objects.create(path='/%s.txt' % i, user=self.other,
+                                    file=file.file)
+            UserDir.objects.create(path='/foo/%s' % i, user=self.user) \
+                .tags.add(Tag.objects.get(name='foo'))
+
+    def get_listing(self, **kwargs):
+        kwargs.setdefault('format', 'json')
+        r = self.client.get(reverse('api:dirs_path', args=('/foo',)), kwargs)
+        self.assertEqual(200, r.status_code)
+        return r.json()
+
+    def test_queries(self):
+        self.add_files(2)
+        # Warm up (session, root directory etc.)
+        self.get_listing()
+        with self.assertNumQueries(17):
+            listing = self.get_listing()
+        self.assertEqual(2, len(listing['files']))
+        file = listing['files'][0]
+        self.assertEqual({'Dropbox': 1}, file['chunks'])
+        self.assertEqual(['foo'], file['tags'])
+        self.assertEqual(2, len(file['versions']))
+        self.assertEqual(['foo@baz.org'],
+                         [u['email'] for u in file['shared_with']])
+        self.assertEqual(['foo'], listing['dirs'][0]['tags'])
+
+        # More files, same number of queries.
+        self.add_files(8)
+        with self.assertNumQueries(17):
+            listing = self.get_listing()
+        self.assertEqual(10, len(listing['files']))
+        self.assertEqual(10, len(listing['dirs']))
+
+    def test_pagination(self):
+        self.add_files(3)
+        names, cursor = [], None
+        for _ in range(4):
+            kwargs = {'limit': 2}
+            if cursor:
+                kwargs['cursor'] = cursor
+            listing = self.get_listing(**kwargs)
+            page = listing['dirs'] + listing['files']
+            self.assertLessEqual(len(page), 2)
+            names.extend(entry['name'] for entry in page)
+            cursor = listing['next']
+            if cursor is None:
+                break
+        self.assertIsNone(cursor)
+        self.assertEqual(['0', '1', '2', '0.txt', '1.txt', '2.txt'], names)
+
+        r = self.client.get(reverse('api:dirs_path', args=('/foo',)),
+                            {'format': 'json', 'cursor': 'foo'})
+        self.assertEqual(400, r.status_code)
+
+    def test_fields(self):
+        self.add_files(1)
+        listing = self.get_listing(fields='name,size')
+        self.assertEqual({'name': '0.txt', 'size': 0}, listing['files'][0])
+        self.assertEqual({'name': '0', 'size': 0}, listing['dirs'][0])
+        # The directory itself is described in full.
+        self.assertIn('uid', listing['info'])
+
+    def test_stream(self):
+        self.add_files(3)
+        r = self.client.get(reverse('api:dirs_path', args=('/foo',)),
+                            {'stream': '', 'limit': 2, 'fields': 'name'})
+        self.assertEqual(200, r.status_code)
+        lines = [
+            json.loads(line.decode('utf-8'))
+            for line in b''.join(r.streaming_content).splitlines()
+        ]
+        self.assertEqual('foo', lines[0]['info']['name'])
+        self.assertEqual([
+            {'dir': {'name': '0'}}, {'dir': {'name': '1'}},
+            {'dir': {'name': '2'}}, {'file': {'name': '0.txt'}},
+            {'file': {'name': '1.txt'}}, {'file': {'name': '2.txt'}},
+        ], lines[1:])
@@ -12,7 +12,11 @@ from api.views import (
     MeView, PublicCloudListView, CloudListView, UserDirUidView,
     UserDirPathView, UserFileUidView, UserFilePathView, DataUidView,
     DataPathView, DataPathVersionView, DataUidVersionView, OptionsView,
-    UserDirTagView, UserFileTagView, TagListView, TagItemView,
+    UserDirTagView, UserFileTagView, TagListView, TagItemView, StatsView,
+    JobListView, JobView, RetentionView, FileRetentionView,
+    VersionListUidView, VersionListPathView, ChangeListView, StatView,
+    BatchUploadView, UploadSessionListView, UploadSessionView, UploadPartView,
+    UploadCommitView,
 )
 
 urlpatterns = [
@@ -20,12 +24,21 @@ urlpatterns = [
     # -------------
     url(r'^v1/clouds/', PublicCloudListView.as_view(), name='public_clouds'),
 
+    # Administrative access
+    # ---------------------
+    url(r'^v1/stats/$', StatsView.as_view(), name='stats'),
+
     # Authenticated access
     # --------------------
     # General
     url(r'^v1/me/$', MeView.as_view(), name='me'),
     url(r'^v1/me/clouds/$', CloudListView.as_view(), name='clouds'),
     url(r'^v1/me/options/$', OptionsView.as_view(), name='options'),
+    url(r'^v1/me/retention/$', RetentionView.as_view(), name='retention'),
+    url(r'^v1/me/changes/$', ChangeListView.as_view(), name='changes'),
+    url(r'^v1/me/stat/$', StatView.as_view(), name='stat'),
+    url(r'^v1/me/jobs/$', JobListView.as_view(), name='jobs'),
+    url(r'^v1/me/jobs/(?P<uid>.+)/$', JobView.as_view(), name='job'),
 
     # Directories
     url(r'^v1/me/dirs/by-uid:(.+):$', UserDirUidView.as_view(),
@@ -43,11 +56,31 @@ urlpatterns = [
     url(r'^v1/me/files/by-tag:(?P<name>.+):$', UserFileTagView.as_view(),
         name='filetaglist'),
 
+    # File versions
+    url(r'^v1/me/files/by-uid:(.+):/versions/$', VersionListUidView.as_view(),
+        name='files_versions_uid'),
+    url(r'^v1/me/files/by-path:(/.+):/versions/$',
+        VersionListPathView.as_view(), name='files_versions_path'),
+    url(r'^v1/me/files/by-uid:(.+):/retention/$', FileRetentionView.as_view(),
+        name='files_retention_uid'),
+
     # File data (multipart) for browser uploads
     url(r'^v1/me/files/by-uid:(.+):/data/$', DataUidView.as_view(),
         name='files_data_uid'),
     url(r'^v1/me/files/by-path:(/.+):/data/$', DataPathView.as_view(),
         name='files_data_path'),
+    # Many files (multipart or tar) uploaded into a directory
+    url(r'^v1/me/dirs/by-path:(/.*):/data/$', BatchUploadView.as_view(),
+        name='dirs_data_path'),
+
+    # Resumable uploads
+    url(r'^v1/me/uploads/$', UploadSessionListView.as_view(), name='uploads'),
+    url(r'^v1/me/uploads/(?P<uid>[^/]+)/$', UploadSessionView.as_view(),
+        name='upload'),
+    url(r'^v1/me/uploads/(?P<uid>[^/]+)/parts/(?P<number>\d+)/$',
+        UploadPartView.as_view(), name='upload_part'),
+    url(r'^v1/me/uploads/(?P<uid>[^/]+)/commit/$', UploadCommitView.as_view(),
+        name='upload_commit'),
 
     # File version data.
     url(r'^v1/me/files/by-uid:(.+):/data/(.+)/$',
@@ -5,38 +5,165 @@ This file contains the serializers views and supporting code that produces the
 API.
 """
 
-from django.db.models import Count
-from django.http import StreamingHttpResponse
+import shutil
+import tarfile
+import tempfile
+import time
+
+from hashlib import md5
+from io import BytesIO
+from os.path import join as pathjoin
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models
+from django.db.models import QuerySet
+from django.http import StreamingHttpResponse, FileResponse
+from django.utils import timezone
+from django.utils.datastructures import MultiValueDict
+
+from django_transfer import TransferHttpResponse, is_enabled
 
 from rest_framework import (
     serializers, permissions, views, generics, response, exceptions, parsers,
-    mixins,
+    mixins, status,
 )
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.mediatypes import media_type_matches
 
-from main.fs import get_fs
+from api import pagination
+
+from main.cache import DentryCache
+from main.fs import get_fs, transfer
 from main.fs.errors import (
-    DirectoryNotFoundError, PathNotFoundError
+    DirectoryNotFoundError, PathNotFoundError, DirectoryConflictError,
+    IncompleteUploadError,
 )
 from main.models import (
-    User, Storage, UserDir, UserFile, ChunkStorage, Option, Tag, Version,
+    User, Storage, UserDir, UserFile, Option, Tag, Version, Job,
+    RetentionPolicy, Change, UploadSession, normpath,
 )
 
 
-class StorageSerializer(serializers.ModelSerializer):
+def data_response(request, fs, path, file, version):
     """
-    Serialize a Cloud.
+    Prepare a response containing file data.
 
-    Provides statistics for a supported cloud.
+    If the file version is cached locally, the front-end (or sendfile()) sends
+    it. Otherwise it is streamed from the clouds, by the transfer server if
+    transfers are handed off.
     """
+    content_disposition = 'filename="%s"' % file.name
+    if 'download' in request.GET:
+        content_disposition = 'attachment; %s' % content_disposition
+
+    cached = fs.cached(version)
+    if cached is None and transfer.is_enabled() and not version.inline:
+        response = transfer.handoff(
+            transfer.ACTION_DOWNLOAD, request.user, file=file.id,
+            version=version.id, disposition=content_disposition)
+    elif cached is None:
+        response = StreamingHttpResponse(
+            fs.download(path, file=file, version=version),
+            content_type=version.mime)
+    elif is_enabled():
+        response = TransferHttpResponse(cached, content_type=version.mime)
+    else:
+        # FileResponse uses wsgi.file_wrapper, which uWSGI implements using
+        # sendfile().
+        response = FileResponse(open(cached, 'rb'),
+                                content_type=version.mime)
+    response['Content-Disposition'] = content_disposition
+    return response
+
+
+def upload_response(request, fs, path):
+    """
+    Upload the file of a data view request.
 
-    chunks = serializers.SerializerMethodField()
+    A file spooled by nginx is uploaded by the transfer server if transfers
+    are handed off.
+    """
+    f = uploaded_file(request)
+    try:
+        spooled = transfer.is_spooled(f)
+    except ValueError as e:
+        raise exceptions.ValidationError(str(e))
+    if spooled and transfer.is_enabled():
+        # The transfer server opens it.
+        f.close()
+        return transfer.handoff(transfer.ACTION_UPLOAD, request.user,
+                                path=path, temp=f.path)
+    file = fs.upload(path, f=f)
+    return response.Response(UserFileSerializer(file).data)
+
+
+class RetentionPolicySerializer(serializers.ModelSerializer):
+    """
+    Serialize a version retention policy.
+    """
 
     class Meta:
-        model = Storage
-        fields = ('name', 'size', 'used', 'chunks')
+        model = RetentionPolicy
+        fields = ('keep_last', 'keep_days', 'keep_hourly', 'keep_daily',
+                  'keep_weekly')
 
-    def get_chunks(self, obj):
-        return ChunkStorage.objects.filter(storage=obj).count()
+
+class RetentionView(mixins.RetrieveModelMixin, mixins.UpdateModelMixin,
+                    generics.GenericAPIView):
+    """
+    Retention policy view.
+
+    Allows user to view/set the default retention policy for their files.
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = RetentionPolicySerializer
+
+    def get_object(self):
+        return RetentionPolicy.objects.get_or_create(
+            user=self.request.user, file=None)[0]
+
+    def get(self, request, *args, **kwargs):
+        return self.retrieve(request, *args, **kwargs)
+
+    def post(self, request, *args, **kwargs):
+        return self.update(request, *args, **kwargs)
+
+
+class FileRetentionView(RetentionView):
+    """
+    File retention policy view.
+
+    Allows the owner of a file to view/set a retention policy for it,
+    overriding their default policy.
+    """
+
+    def get_object(self):
+        try:
+            file = UserFile.objects.get(uid=self.args[0],
+                                        user=self.request.user)
+        except UserFile.DoesNotExist:
+            raise exceptions.NotFound(self.args[0])
+        if file.file.owner_id != self.request.user.id:
+            raise exceptions.PermissionDenied()
+        return RetentionPolicy.objects.get_or_create(
+            user=self.request.user, file=file.file)[0]
+
+
+class StorageSummarySerializer(serializers.Serializer):
+    """
+    Serialize a Cloud.
+
+    Provides statistics for a supported cloud.
+    """
+
+    name = serializers.CharField()
+    storages = serializers.IntegerField()
+    size = serializers.IntegerField()
+    used = serializers.IntegerField()
+    chunks = serializers.IntegerField()
+    stored = serializers.IntegerField()
 
 
 class PublicCloudListView(generics.ListAPIView):
@@ -48,11 +175,13 @@ class PublicCloudListView(generics.ListAPIView):
     """
 
     permission_classes = [permissions.AllowAny]
-    queryset = Storage.objects.all()
-    serializer_class = StorageSerializer
+    serializer_class = StorageSummarySerializer
 
     def get_queryset(self):
-        return Storage.objects.all().order_by('type')
+        # Rolled up from every storage, so computed periodically.
+        return cache.get_or_set('storage-summary',
+                                Storage.objects.all().summary,
+                                settings.API_CLOUD_SUMMARY_TIMEOUT)
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -129,14 +258,12 @@ class StorageSerializer(serializers.ModelSerializer):
     Provides statistics for a cloud account.
     """
 
-    chunks = serializers.SerializerMethodField()
+    chunks = serializers.IntegerField(source='chunk_count')
+    stored = serializers.IntegerField(source='chunk_bytes')
 
     class Meta:
         model = Storage
-        fields = ('name', 'size', 'used', 'chunks')
-
-    def get_chunks(self, obj):
-        return obj.chunks.all().count()
+        fields = ('name', 'size', 'used', 'chunks', 'stored')
 
 
 class CloudListView(generics.ListAPIView):
@@ -155,7 +282,192 @@ class CloudListView(generics.ListAPIView):
         return Storage.objects.filter(user=self.request.user).order_by('type')
 
 
-class UserDirSerializer(serializers.ModelSerializer):
+class JobSerializer(serializers.ModelSerializer):
+    """
+    Serialize a Job.
+
+    Provides the state and progress of a background job.
+    """
+
+    type = serializers.SerializerMethodField()
+    state = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Job
+        fields = ('uid', 'type', 'state', 'total', 'done', 'error', 'created',
+                  'started', 'finished')
+
+    def get_type(self, obj):
+        return obj.TYPES[obj.type]
+
+    def get_state(self, obj):
+        return obj.STATES[obj.state]
+
+
+class JobListView(generics.ListAPIView):
+    """
+    List background jobs.
+
+    Lets a user monitor the progress of their long running operations.
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = JobSerializer
+
+    def get_queryset(self):
+        return Job.objects.filter(user=self.request.user).order_by('-id')
+
+
+class JobView(generics.RetrieveAPIView):
+    """
+    Background job detail view.
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = JobSerializer
+
+    def get_object(self):
+        try:
+            return Job.objects.get(uid=self.kwargs['uid'],
+                                   user=self.request.user)
+        except Job.DoesNotExist:
+            raise exceptions.NotFound(self.kwargs['uid'])
+
+
+class ChangeSerializer(serializers.ModelSerializer):
+    """
+    Serialize a Change.
+    """
+
+    action = serializers.SerializerMethodField()
+    type = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Change
+        fields = ('action', 'type', 'uid', 'path', 'old_path', 'created')
+
+    def get_action(self, obj):
+        return obj.ACTIONS[obj.action].lower()
+
+    def get_type(self, obj):
+        return 'dir' if obj.isdir else 'file'
+
+
+def wait_for_changes(user, cursor, limit, timeout):
+    """
+    Fetch (up to limit + 1) changes made after cursor.
+
+    If there are none, waits up to timeout seconds for one. While waiting, the
+    journal is only queried again once the cached id of the user's latest
+    change moves (or is not cached).
+    """
+    changes = Change.objects.filter(user=user).since(cursor)
+    deadline = time.monotonic() + timeout
+    key = Change.latest_key(user.id)
+    while True:
+        page = list(changes[:limit + 1])
+        if page or time.monotonic() >= deadline:
+            return page
+        latest = cache.get(key)
+        while True:
+            time.sleep(max(0, min(settings.API_CHANGES_INTERVAL,
+                                  deadline - time.monotonic())))
+            if time.monotonic() >= deadline:
+                break
+            current = cache.get(key)
+            if current is None or current != latest:
+                break
+
+
+class ChangeListView(views.APIView):
+    """
+    Change feed view.
+
+    Lists the changes made to the user's tree after `cursor`, oldest first.
+    Without a cursor, no changes are listed, only the current cursor (a client
+    lists it's tree and then follows changes from there). If there are no
+    changes yet, waits up to `timeout` seconds for one (long-poll).
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, format=None):
+        changes = Change.objects.filter(user=request.user)
+        cursor = request.GET.get('cursor')
+        if not cursor:
+            latest = changes.aggregate(models.Max('id'))['id__max']
+            return response.Response({
+                'changes': [], 'cursor': str(latest or 0), 'more': False,
+            })
+        try:
+            cursor = int(cursor)
+            limit = int(request.GET.get('limit',
+                                        settings.API_CHANGES_PAGE_SIZE))
+            timeout = float(request.GET.get('timeout', 0))
+        except ValueError:
+            raise exceptions.ValidationError('Invalid cursor or parameters')
+        limit = max(1, min(limit, settings.API_CHANGES_PAGE_SIZE))
+        timeout = max(0, min(timeout, settings.API_CHANGES_TIMEOUT))
+
+        page = wait_for_changes(request.user, cursor, limit, timeout)
+        more = len(page) > limit
+        page = page[:limit]
+        return response.Response({
+            'changes': ChangeSerializer(page, many=True).data,
+            'cursor': str(page[-1].id if page else cursor),
+            'more': more,
+        })
+
+
+class StatsView(views.APIView):
+    """
+    Operational statistics.
+
+    Exposes cache hit rates and the like to administrators.
+    """
+
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, format=None):
+        return response.Response({
+            'dentry': DentryCache.stats(),
+        })
+
+
+class PrefetchListSerializer(serializers.ListSerializer):
+    """
+    Serialize many objects.
+
+    The child serializer's prefetch() is given all of the objects at once, so
+    that it can load their related data in bulk rather than one object at a
+    time.
+    """
+
+    def to_representation(self, data):
+        if isinstance(data, models.Manager):
+            data = data.all()
+        return super().to_representation(self.child.prefetch(data))
+
+
+class SelectFieldsMixin(object):
+    """
+    Allow the client to select fields of listed objects.
+
+    If the serializer context contains `fields` (a set of names) the other
+    fields are omitted, and are therefore never computed. This only applies
+    when serializing many objects.
+    """
+
+    def get_fields(self):
+        fields = super().get_fields()
+        selected = self.context.get('fields')
+        if selected and isinstance(self.parent, serializers.ListSerializer):
+            for name in set(fields) - selected:
+                del fields[name]
+        return fields
+
+
+class UserDirSerializer(SelectFieldsMixin, serializers.ModelSerializer):
     """
     Serialize a Directory.
 
@@ -165,16 +477,27 @@ class UserDirSerializer(serializers.ModelSerializer):
     mime = serializers.SerializerMethodField()
     tags = serializers.SerializerMethodField()
     path = serializers.SerializerMethodField()
+    # Recursive totals, maintained as the tree changes.
+    size = serializers.IntegerField(source='total_size', read_only=True)
+    files = serializers.IntegerField(source='total_files', read_only=True)
+    dirs = serializers.IntegerField(source='total_dirs', read_only=True)
 
     class Meta:
         model = UserDir
-        fields = ('uid', 'name', 'path', 'mime', 'created', 'tags', 'attrs')
+        fields = ('uid', 'name', 'path', 'mime', 'created', 'tags', 'attrs',
+                  'size', 'files', 'dirs')
+        list_serializer_class = PrefetchListSerializer
+
+    def prefetch(self, dirs):
+        if isinstance(dirs, QuerySet) and 'tags' in self.fields:
+            dirs = dirs.prefetch_related('tags')
+        return dirs
 
     def get_mime(self, obj):
         return 'application/x-directory'
 
     def get_tags(self, obj):
-        return obj.tags.all().values_list('name', flat=True)
+        return [tag.name for tag in obj.tags.all()]
 
     def get_path(self, obj):
         # This is not a model attribute, since we are rendering from a FileInfo
@@ -188,7 +511,7 @@ class VersionSerializer(serializers.ModelSerializer):
         fields = ('uid', 'size', 'md5', 'sha1', 'mime', 'created')
 
 
-class UserFileSerializer(serializers.ModelSerializer):
+class UserFileSerializer(SelectFieldsMixin, serializers.ModelSerializer):
     """
     Serialize a File.
 
@@ -212,32 +535,78 @@ class UserFileSerializer(serializers.ModelSerializer):
         fields = ('uid', 'name', 'extension', 'path', 'size', 'md5', 'sha1',
                   'mime', 'created', 'tags', 'attrs', 'version', 'versions',
                   'chunks', 'shared_with')
+        list_serializer_class = PrefetchListSerializer
+
+    def prefetch(self, files):
+        fields = self.fields
+        if isinstance(files, QuerySet):
+            files = files.with_details(tags='tags' in fields,
+                                       versions='versions' in fields,
+                                       shared='shared_with' in fields)
+        files = list(files)
+        if 'chunks' in fields:
+            # Chunks are counted for all files with one query.
+            counts = Version.count_chunks({f.file.version_id for f in files})
+            for f in files:
+                f.chunk_counts = counts[f.file.version_id]
+        return files
 
     def get_chunks(self, obj):
-        # These names are a bit long...
-        n1 = 'storages__storage__type'
-        n2 = 'storages__storage'
-        chunks = {}
-        for item in obj.file.version.chunks.values(n1).annotate(Count(n2)):
-            chunks[Storage.TYPES[item[n1]]] = \
-                item['%s__count' % n2]
-        return chunks
+        try:
+            return obj.chunk_counts
+        except AttributeError:
+            version_id = obj.file.version_id
+            return Version.count_chunks([version_id])[version_id]
 
     def get_shared_with(self, obj):
-        return UserSerializer(
-            UserFile.objects.filter(file=obj.file)
-            .exclude(user=obj.file.owner)
-            .exclude(user=obj.user),
-            many=True).data
+        # Works from the (possibly prefetched) list of the file's UserFiles.
+        users = [
+            f.user for f in obj.file.user_files.all()
+            if f.deleted is None and
+            f.user_id not in (obj.file.owner_id, obj.user_id)
+        ]
+        return UserSerializer(users, many=True).data
 
     def get_tags(self, obj):
-        return obj.tags.all().values_list('name', flat=True)
+        return [tag.name for tag in obj.tags.all()]
 
     def get_version(self, obj):
         return VersionSerializer(obj.file.version).data
 
     def get_versions(self, obj):
-        return VersionSerializer(obj.file.versions.all(), many=True).data
+        # Only the newest page, all versions are paged by versions_response().
+        versions = sorted(obj.file.versions.all(),
+                          key=lambda v: (v.created, v.id), reverse=True)
+        return VersionSerializer(
+            versions[:settings.API_VERSIONS_PAGE_SIZE], many=True).data
+
+
+class VersionListSerializer(serializers.Serializer):
+    """
+    Serialize a page of a File's versions.
+    """
+
+    versions = VersionSerializer(many=True)
+    next = serializers.CharField(allow_null=True)
+
+
+def versions_response(request, file):
+    """
+    Prepare a response containing a page of a file's versions.
+
+    Versions are listed newest first, `cursor` and `limit` select the page and
+    the response contains the `next` cursor.
+    """
+    try:
+        limit = int(request.GET.get('limit', settings.API_VERSIONS_PAGE_SIZE))
+    except ValueError:
+        raise exceptions.ValidationError('Invalid limit')
+    limit = max(1, min(limit, settings.API_VERSIONS_PAGE_SIZE))
+    versions, next = pagination.paginate_versions(
+        file.file.versions.all(), request.GET.get('cursor'), limit)
+    return response.Response(VersionListSerializer({
+        'versions': versions, 'next': next,
+    }).data)
 
 
 class UserDirListingSerializer(serializers.Serializer):
@@ -251,6 +620,58 @@ class UserDirListingSerializer(serializers.Serializer):
     info = UserDirSerializer()
     dirs = UserDirSerializer(many=True)
     files = UserFileSerializer(many=True)
+    next = serializers.CharField(allow_null=True)
+
+
+def listing_response(request, fs, path, dir=None):
+    """
+    Prepare a response containing a directory listing.
+
+    Listings are paged, `cursor` and `limit` select the page and the response
+    contains the `next` cursor. If `stream` is given, the listing is instead
+    streamed (from `cursor` to the end) as JSON lines; the directory itself
+    followed by one line per entry. `fields` selects the fields of each entry.
+    """
+    try:
+        dir, dirs, files = fs.listdir(path, dir=dir)
+    except DirectoryNotFoundError:
+        raise exceptions.NotFound(path)
+    cursor = request.GET.get('cursor')
+    try:
+        limit = int(request.GET.get('limit', settings.API_LISTING_PAGE_SIZE))
+    except ValueError:
+        raise exceptions.ValidationError('Invalid limit')
+    limit = max(1, min(limit, settings.API_LISTING_PAGE_SIZE))
+    context = {
+        'request': request,
+        'fields': set(filter(None, request.GET.get('fields', '').split(','))),
+    }
+
+    if 'stream' not in request.GET:
+        dirs, files, next = pagination.paginate(dirs, files, cursor, limit)
+        return response.Response(UserDirListingSerializer({
+            'info': dir, 'dirs': dirs, 'files': files, 'next': next,
+        }, context=context).data)
+
+    # Validate the cursor before the response starts.
+    if cursor:
+        pagination.decode_cursor(cursor)
+    renderer = JSONRenderer()
+
+    def _lines():
+        yield renderer.render({
+            'info': UserDirSerializer(dir, context=context).data,
+        }) + b'\n'
+        for page in pagination.iterate(dirs, files, cursor, limit):
+            for key, entries in zip(('dir', 'file'), page):
+                serializer = UserDirSerializer if key == 'dir' else \
+                    UserFileSerializer
+                for entry in serializer(entries, many=True,
+                                        context=context).data:
+                    yield renderer.render({key: entry}) + b'\n'
+
+    return StreamingHttpResponse(_lines(),
+                                 content_type='application/x-ndjson')
 
 
 class UserDirUidView(views.APIView):
@@ -268,10 +689,7 @@ class UserDirUidView(views.APIView):
             dir = UserDir.objects.get(uid=uid, user=request.user)
         except UserDir.DoesNotExist:
             raise exceptions.NotFound(uid)
-        dir, dirs, files = fs.listdir(dir.path, dir=dir)
-        return response.Response(UserDirListingSerializer({
-            'info': dir, 'dirs': dirs, 'files': files
-        }).data)
+        return listing_response(request, fs, dir.path, dir=dir)
 
     def delete(self, request, uid, format=None):
         fs = get_fs(request.user)
@@ -296,13 +714,7 @@ class UserDirPathView(views.APIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get(self, request, path, format=None):
-        try:
-            dir, dirs, files = get_fs(request.user).listdir(path)
-        except DirectoryNotFoundError:
-            raise exceptions.NotFound(path)
-        return response.Response(UserDirListingSerializer({
-            'info': dir, 'dirs': dirs, 'files': files
-        }).data)
+        return listing_response(request, get_fs(request.user), path)
 
     def post(self, request, path, format=None):
         return response.Response(
@@ -377,6 +789,142 @@ class UserFilePathView(views.APIView):
             raise exceptions.NotFound(path)
 
 
+class StatView(views.APIView):
+    """
+    Batch stat view.
+
+    Describes many files and directories, identified by `paths` and/or `uids`,
+    in one request. They are resolved together, so the number of queries does
+    not depend on how many are requested. Results are returned in the order
+    requested, each with it's `type` and `info`, or an `error`. `fields`
+    selects the fields of each result.
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    @staticmethod
+    def _list(data, name):
+        items = data.get(name, [])
+        if not isinstance(items, list) or \
+                not all(isinstance(item, str) for item in items):
+            raise exceptions.ValidationError('%s must be a list' % name)
+        return items
+
+    def post(self, request, format=None):
+        user = request.user
+        paths = self._list(request.data, 'paths')
+        uids = self._list(request.data, 'uids')
+        if len(paths) + len(uids) > settings.API_STAT_BATCH_SIZE:
+            raise exceptions.ValidationError(
+                'At most %s paths and uids' % settings.API_STAT_BATCH_SIZE)
+        fields = request.data.get('fields') or []
+        if isinstance(fields, str):
+            fields = fields.split(',')
+        context = {'request': request, 'fields': set(fields)}
+        if fields:
+            # Needed to match results to the request.
+            context['fields'] |= {'uid', 'path'}
+
+        normalized = {path: normpath(path) for path in paths}
+        if '/' in normalized.values():
+            UserDir.objects.get_root(user)
+        files = UserFile.objects.all().at_paths(user, paths) | \
+            UserFile.objects.filter(user=user, uid__in=uids)
+        dirs = UserDir.objects.filter(
+            user=user, path__in=set(normalized.values())) | \
+            UserDir.objects.filter(user=user, uid__in=uids)
+        found = {'file': {}, 'dir': {}}
+        for type, serializer in (
+                ('file', UserFileSerializer(files, many=True,
+                                            context=context)),
+                ('dir', UserDirSerializer(dirs, many=True,
+                                          context=context))):
+            for info in serializer.data:
+                found[type][info['path']] = found[type][info['uid']] = info
+
+        results = []
+        for key, items in (('path', paths), ('uid', uids)):
+            for item in items:
+                lookup = normalized[item] if key == 'path' else item
+                for type in ('file', 'dir'):
+                    info = found[type].get(lookup)
+                    if info is not None:
+                        results.append({key: item, 'type': type,
+                                        'info': info})
+                        break
+                else:
+                    results.append({key: item, 'error': 'Not found'})
+        return response.Response({'results': results})
+
+
+class VersionListUidView(views.APIView):
+    """
+    File versions view.
+
+    Lists the versions of a file identified by it's uid.
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, uid, format=None):
+        try:
+            file = UserFile.objects.get(uid=uid, user=request.user)
+        except UserFile.DoesNotExist:
+            raise exceptions.NotFound(uid)
+        return versions_response(request, file)
+
+
+class VersionListPathView(views.APIView):
+    """
+    File versions view.
+
+    Lists the versions of a file identified by it's path.
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, path, format=None):
+        fs = get_fs(request.user)
+        try:
+            info = fs.info(path)
+        except PathNotFoundError:
+            raise exceptions.NotFound(path)
+        if info.isdir:
+            raise exceptions.NotFound(path)
+        return versions_response(request, info)
+
+
+class OctetStreamParser(parsers.BaseParser):
+    """
+    Pass a raw request body through as the uploaded file.
+
+    Unlike MultiPartParser, the body is not read (and spooled to disk) before
+    the upload starts. It is read a chunk at a time as the file is uploaded,
+    so the first chunks reach the clouds while the rest is still arriving.
+    """
+
+    media_type = 'application/octet-stream'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        return parsers.DataAndFiles({}, MultiValueDict({'file': [stream]}))
+
+
+def uploaded_file(request):
+    """
+    Return the file uploaded by a data view request.
+
+    Either the `file` field of a multipart body or a raw body.
+    """
+    try:
+        return request.FILES['file']
+    except KeyError:
+        # An empty body is not parsed.
+        if media_type_matches(OctetStreamParser.media_type,
+                              request.content_type):
+            return BytesIO()
+        raise exceptions.ValidationError('No file')
+
+
 class DataUidVersionView(views.APIView):
     """
     File data view.
@@ -385,7 +933,7 @@ class DataUidVersionView(views.APIView):
     """
 
     permission_classes = [permissions.IsAuthenticated]
-    parser_classes = (parsers.MultiPartParser,)
+    parser_classes = (parsers.MultiPartParser, OctetStreamParser)
 
     def get(self, request, uid, version, format=None):
         fs = get_fs(request.user)
@@ -402,19 +950,8 @@ class DataUidVersionView(views.APIView):
         except Version.DoesNotExist:
             raise exceptions.NotFound(version)
 
-        # Prepare response.
-        response = StreamingHttpResponse(
-            fs.download(file.path, file=file, version=version),
-            content_type=version.mime)
-
-        # Adjust headers
-        content_disposition = 'filename="%s"' % file.name
-        if 'download' in request.GET:
-            content_disposition = 'attachment; %s' % content_disposition
-        response['Content-Disposition'] = content_disposition
-
         # Send the file.
-        return response
+        return data_response(request, fs, file.path, file, version)
 
 
 class DataUidView(DataUidVersionView):
@@ -435,10 +972,7 @@ class DataUidView(DataUidVersionView):
         except UserFile.DoesNotExist:
             raise exceptions.NotFound(uid)
 
-        file = fs.upload(
-            file.path, f=request.FILES['file'])
-
-        return response.Response(UserFileSerializer(file).data)
+        return upload_response(request, fs, file.path)
 
 
 class DataPathVersionView(views.APIView):
@@ -450,7 +984,7 @@ class DataPathVersionView(views.APIView):
     """
 
     permission_classes = [permissions.IsAuthenticated]
-    parser_classes = (parsers.MultiPartParser,)
+    parser_classes = (parsers.MultiPartParser, OctetStreamParser)
 
     def get(self, request, path, version, format=None):
         fs = get_fs(request.user)
@@ -467,23 +1001,12 @@ class DataPathVersionView(views.APIView):
         except Version.DoesNotExist:
             raise exceptions.NotFound(version)
 
-        # Prepare response.
+        # Send the file.
         try:
-            response = StreamingHttpResponse(
-                fs.download(path, file=file, version=version),
-                content_type=version.mime)
+            return data_response(request, fs, path, file, version)
         except PathNotFoundError:
             raise exceptions.NotFound(path)
 
-        # Adjust headers.
-        content_disposition = 'filename="%s"' % file.name
-        if 'download' in request.GET:
-            content_disposition = 'attachment; %s' % content_disposition
-        response['Content-Disposition'] = content_disposition
-
-        # Send the file.
-        return response
-
 
 class DataPathView(DataPathVersionView):
     def get(self, request, path, format=None):
@@ -498,7 +1021,243 @@ class DataPathView(DataPathVersionView):
 
     def post(self, request, path, format=None):
         fs = get_fs(request.user)
-        file = fs.upload(path, f=request.FILES['file'])
+        return upload_response(request, fs, path)
+
+
+class TarParser(parsers.BaseParser):
+    """
+    Parse a tar stream into files.
+
+    Each regular file in the archive becomes a file named for it's path in the
+    archive. The archive is read as a stream, it's members are spooled (in
+    memory while small) since they can only be read in turn. Members larger
+    than API_UPLOAD_BATCH_FILE_SIZE, or beyond API_UPLOAD_BATCH_TOTAL_SIZE in
+    all, are refused.
+    """
+
+    media_type = 'application/x-tar'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        files, total = MultiValueDict(), 0
+        try:
+            with tarfile.open(fileobj=stream, mode='r|*') as archive:
+                for member in archive:
+                    if not member.isfile():
+                        continue
+                    if len(files) >= settings.API_UPLOAD_BATCH_SIZE:
+                        raise exceptions.ParseError('Too many files')
+                    if member.size > settings.API_UPLOAD_BATCH_FILE_SIZE:
+                        raise exceptions.ParseError(
+                            '%s is larger than %s bytes' % (
+                                member.name,
+                                settings.API_UPLOAD_BATCH_FILE_SIZE))
+                    total += member.size
+                    if total > settings.API_UPLOAD_BATCH_TOTAL_SIZE:
+                        raise exceptions.ParseError(
+                            'Files are larger than %s bytes in all' %
+                            settings.API_UPLOAD_BATCH_TOTAL_SIZE)
+                    f = tempfile.SpooledTemporaryFile(
+                        max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+                    # Only the member's size (from it's header) is read, 64KB
+                    # at a time (as Django reads uploads).
+                    shutil.copyfileobj(archive.extractfile(member), f,
+                                       64 * 1024)
+                    f.seek(0)
+                    files.appendlist(member.name, f)
+        except tarfile.TarError as e:
+            raise exceptions.ParseError('Invalid archive: %s' % e)
+        return parsers.DataAndFiles({}, files)
+
+
+class BatchUploadView(views.APIView):
+    """
+    Batch upload view.
+
+    Uploads many files into a directory identified by it's path, with a single
+    request. The body is either multipart, each field named for the path of a
+    file (relative to the directory), or a tar stream. The files are uploaded
+    together (see MultiCloudFilesystem.upload_many()). Results are returned in
+    order, each with the file's `info` or an `error`.
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+    parser_classes = (parsers.MultiPartParser, TarParser)
+
+    def post(self, request, path, format=None):
+        fs = get_fs(request.user)
+        if fs.isfile(path):
+            raise exceptions.ValidationError('%s is a file' % path)
+        root, files = normpath(path), []
+        for name, uploads in request.FILES.lists():
+            dst = normpath(pathjoin(root, name.lstrip('/')))
+            # Names may not escape the directory (using '..').
+            if not dst.startswith(root.rstrip('/') + '/'):
+                raise exceptions.ValidationError(
+                    '%s is outside of %s' % (name, root))
+            files.extend((dst, f) for f in uploads)
+        if not files:
+            raise exceptions.ValidationError('No files')
+        if len(files) > settings.API_UPLOAD_BATCH_SIZE:
+            raise exceptions.ValidationError(
+                'At most %s files' % settings.API_UPLOAD_BATCH_SIZE)
+        results = fs.upload_many(files)
+
+        # Described together, as a listing is.
+        uploaded = [f.id for _, f in results if isinstance(f, UserFile)]
+        info = {
+            data['uid']: data for data in UserFileSerializer(
+                UserFile.objects.filter(id__in=uploaded), many=True).data
+        }
+        return response.Response({'results': [
+            {'path': path, 'info': info[result.uid]}
+            if isinstance(result, UserFile) else
+            {'path': path, 'error': str(result)}
+            for path, result in results
+        ]})
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    """
+    Serialize an upload session, including the parts received so far.
+    """
+
+    parts = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UploadSession
+        fields = ('uid', 'path', 'size', 'created', 'expires', 'parts')
+
+    def get_parts(self, obj):
+        return [{'number': number, 'size': size}
+                for number, size in obj.parts()]
+
+
+def get_upload_session(request, uid):
+    """Find one of the user's (unexpired) upload sessions."""
+    try:
+        return UploadSession.objects.get(uid=uid, user=request.user,
+                                         expires__gte=timezone.now())
+    except UploadSession.DoesNotExist:
+        raise exceptions.NotFound(uid)
+
+
+class UploadSessionListView(views.APIView):
+    """
+    Resumable upload view.
+
+    Starts an upload session for a file identified by it's `path` (and
+    optionally it's `size`). The file's data is then uploaded in numbered
+    parts, in any order and in parallel, and finally committed. Lists the
+    user's sessions so that an interrupted upload can be resumed.
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, format=None):
+        sessions = UploadSession.objects.filter(
+            user=request.user, expires__gte=timezone.now()).order_by('id')
+        return response.Response(
+            UploadSessionSerializer(sessions, many=True).data)
+
+    def post(self, request, format=None):
+        path, size = request.data.get('path'), request.data.get('size')
+        if not path:
+            raise exceptions.ValidationError('path is required')
+        if size is not None:
+            try:
+                size = int(size)
+            except (ValueError, TypeError):
+                raise exceptions.ValidationError('Invalid size')
+        fs = get_fs(request.user)
+        try:
+            session = fs.start_upload(path, size=size)
+        except DirectoryConflictError as e:
+            raise exceptions.ValidationError(str(e))
+        return response.Response(UploadSessionSerializer(session).data,
+                                 status=status.HTTP_201_CREATED)
+
+
+class UploadSessionView(views.APIView):
+    """
+    Upload session view.
+
+    Shows which parts of the upload have been received. Deleting the session
+    abandons the upload.
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, uid, format=None):
+        session = get_upload_session(request, uid)
+        return response.Response(UploadSessionSerializer(session).data)
+
+    def delete(self, request, uid, format=None):
+        session = get_upload_session(request, uid)
+        UploadSession.objects.filter(pk=session.pk).purge()
+        return response.Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class UploadPartView(views.APIView):
+    """
+    Upload part view.
+
+    The body of a PUT is the data of the numbered part (numbered from 1). A
+    part that failed can simply be uploaded again.
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    def put(self, request, uid, number, format=None):
+        session = get_upload_session(request, uid)
+        number = int(number)
+        if not 1 <= number <= settings.API_UPLOAD_MAX_PARTS:
+            raise exceptions.ValidationError(
+                'Parts are numbered 1 to %s' % settings.API_UPLOAD_MAX_PARTS)
+        limit = settings.API_UPLOAD_PART_SIZE
+        # Reads may return less than asked for, read until one byte more
+        # than the limit, or the end. The stream is None when there is no
+        # body.
+        pieces, size = [], 0
+        while request.stream and size <= limit:
+            piece = request.stream.read(limit + 1 - size)
+            if not piece:
+                break
+            pieces.append(piece)
+            size += len(piece)
+        data = b''.join(pieces)
+        if not data:
+            raise exceptions.ValidationError('Empty part')
+        if len(data) > limit:
+            raise exceptions.ValidationError(
+                'Parts are at most %s bytes' % limit)
+        fs = get_fs(request.user)
+        try:
+            fs.write_part(session, number, data)
+        except UploadSession.DoesNotExist:
+            raise exceptions.NotFound(uid)
+        return response.Response({'number': number, 'size': len(data),
+                                  'md5': md5(data).hexdigest()})
+
+
+class UploadCommitView(views.APIView):
+    """
+    Upload commit view.
+
+    Creates (or updates) the file once all of it's parts are uploaded. The
+    session is then gone.
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, uid, format=None):
+        session = get_upload_session(request, uid)
+        fs = get_fs(request.user)
+        try:
+            file = fs.commit_upload(session)
+        except UploadSession.DoesNotExist:
+            raise exceptions.NotFound(uid)
+        except (IncompleteUploadError, DirectoryConflictError) as e:
+            raise exceptions.ValidationError(str(e))
         return response.Response(UserFileSerializer(file).data)
 
 
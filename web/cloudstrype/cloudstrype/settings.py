@@ -137,6 +137,57 @@ CACHES = {
     },
 }
 
+# Lifetime of cached path lookups, see main.cache.DentryCache.
+DENTRY_CACHE_TIMEOUT = ENV('DENTRY_CACHE_TIMEOUT', cast=int, default=300)
+
+# Chunks are written to the chunk cache by a background thread. When this many
+# chunks are waiting to be written, further chunks are not cached.
+CHUNK_CACHE_QUEUE_SIZE = ENV('CHUNK_CACHE_QUEUE_SIZE', cast=int, default=32)
+# Number of leading chunks of each upload to cache (None caches every chunk).
+CHUNK_CACHE_WRITE_CHUNKS = ENV('CHUNK_CACHE_WRITE_CHUNKS', cast=int,
+                               default=None)
+
+# Directory for caching whole, decrypted files (None disables). This should be
+# an encrypted volume. Cached files are sent by nginx when TRANSFER_SERVER is
+# set, otherwise by the application server (using sendfile() if available).
+CLOUDSTRYPE_ASSEMBLED_CACHE = ENV('CLOUDSTRYPE_ASSEMBLED_CACHE', default=None)
+CLOUDSTRYPE_ASSEMBLED_CACHE_MAX_ENTRIES = \
+    ENV('CLOUDSTRYPE_ASSEMBLED_CACHE_MAX_ENTRIES', cast=int, default=300)
+# Larger files are not assembled.
+CLOUDSTRYPE_ASSEMBLED_CACHE_MAX_SIZE = \
+    ENV('CLOUDSTRYPE_ASSEMBLED_CACHE_MAX_SIZE', cast=int,
+        default=256 * 1024 * 1024)
+
+# django-transfer, maps local paths to nginx internal locations.
+TRANSFER_SERVER = ENV('TRANSFER_SERVER', default=None)
+TRANSFER_MAPPINGS = {}
+if CLOUDSTRYPE_ASSEMBLED_CACHE:
+    TRANSFER_MAPPINGS[CLOUDSTRYPE_ASSEMBLED_CACHE] = '/assembled/'
+
+# Transfers are handed off to the transfer server through this nginx internal
+# location (None performs them in the application), see main.fs.transfer.
+# Tokens expire after CLOUDSTRYPE_TRANSFER_TOKEN_TTL seconds. Files spooled by
+# the nginx upload module are only accepted from
+# CLOUDSTRYPE_TRANSFER_UPLOAD_DIR (it's upload_store).
+CLOUDSTRYPE_TRANSFER_LOCATION = \
+    ENV('CLOUDSTRYPE_TRANSFER_LOCATION', default=None)
+CLOUDSTRYPE_TRANSFER_TOKEN_TTL = \
+    ENV('CLOUDSTRYPE_TRANSFER_TOKEN_TTL', cast=int, default=60)
+CLOUDSTRYPE_TRANSFER_UPLOAD_DIR = \
+    ENV('CLOUDSTRYPE_TRANSFER_UPLOAD_DIR', default='/data/uploads')
+
+# The cloud clients share a pool of keep-alive connections per provider, of
+# this many connections per host. Asynchronous requests (see
+# main.fs.clouds.aio) time out after CLOUDSTRYPE_CLOUD_TIMEOUT seconds.
+CLOUDSTRYPE_CLOUD_CONNECTIONS = \
+    ENV('CLOUDSTRYPE_CLOUD_CONNECTIONS', cast=int, default=16)
+CLOUDSTRYPE_CLOUD_TIMEOUT = \
+    ENV('CLOUDSTRYPE_CLOUD_TIMEOUT', cast=int, default=300)
+# Clients of this many storages are kept (per process) for reuse, see
+# main.fs.clouds.ClientPool.
+CLOUDSTRYPE_CLIENT_POOL_SIZE = \
+    ENV('CLOUDSTRYPE_CLIENT_POOL_SIZE', cast=int, default=1000)
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.10/ref/settings/#auth-password-validators
@@ -207,6 +258,40 @@ REST_FRAMEWORK = {
     ),
 }
 
+# Maximum (and default) number of entries in a page of a directory listing.
+API_LISTING_PAGE_SIZE = ENV('API_LISTING_PAGE_SIZE', cast=int, default=1000)
+# Lifetime of the cached per-provider storage summary (public cloud list).
+API_CLOUD_SUMMARY_TIMEOUT = \
+    ENV('API_CLOUD_SUMMARY_TIMEOUT', cast=int, default=300)
+
+# Maximum (and default) number of versions in a page of a file's versions.
+API_VERSIONS_PAGE_SIZE = \
+    ENV('API_VERSIONS_PAGE_SIZE', cast=int, default=100)
+
+# Maximum number of paths and uids described by a single batch stat request.
+API_STAT_BATCH_SIZE = ENV('API_STAT_BATCH_SIZE', cast=int, default=1000)
+
+# Maximum number of files uploaded by a single batch upload request.
+API_UPLOAD_BATCH_SIZE = ENV('API_UPLOAD_BATCH_SIZE', cast=int, default=1000)
+# Largest file, and total size of the files, in a batch upload tar stream.
+API_UPLOAD_BATCH_FILE_SIZE = \
+    ENV('API_UPLOAD_BATCH_FILE_SIZE', cast=int, default=100 * 1024 * 1024)
+API_UPLOAD_BATCH_TOTAL_SIZE = \
+    ENV('API_UPLOAD_BATCH_TOTAL_SIZE', cast=int, default=1024 * 1024 * 1024)
+
+# Limits of resumable uploads, each part is stored as a single chunk.
+API_UPLOAD_PART_SIZE = \
+    ENV('API_UPLOAD_PART_SIZE', cast=int, default=8 * 1024 * 1024)
+API_UPLOAD_MAX_PARTS = ENV('API_UPLOAD_MAX_PARTS', cast=int, default=10000)
+
+# Maximum (and default) number of changes in a page of the change feed.
+API_CHANGES_PAGE_SIZE = ENV('API_CHANGES_PAGE_SIZE', cast=int, default=500)
+# Longest time (seconds) a change feed request may wait for new changes, and
+# how often it checks for them while waiting. A waiting request ties up a
+# uWSGI worker, so waits are kept short (clients simply poll again).
+API_CHANGES_TIMEOUT = ENV('API_CHANGES_TIMEOUT', cast=int, default=10)
+API_CHANGES_INTERVAL = ENV('API_CHANGES_INTERVAL', cast=float, default=1.0)
+
 STATIC_ROOT = ENV('STATIC_ROOT', default='.static')
 
 SITE_ID = 1
@@ -255,6 +340,56 @@ LOGGING = {
 # chunks.
 CLOUDSTRYPE_CHUNK_SIZE = ENV('CLOUDSTRYPE_CHUNK_SIZE', default=1024 * 1024)
 
+# Files up to this size are stored (encrypted) in the database rather than
+# with the cloud providers, so reading them needs no provider requests. Files
+# that grow past it are written to chunks again (each version is stored on
+# it's own).
+CLOUDSTRYPE_INLINE_THRESHOLD = \
+    ENV('CLOUDSTRYPE_INLINE_THRESHOLD', cast=int, default=4 * 1024)
+
+# Files up to this size, uploaded together, are packed into shared chunks of
+# (about) CLOUDSTRYPE_PACK_SIZE bytes. Packs that become mostly unused (live
+# data less than CLOUDSTRYPE_PACK_COMPACT_RATIO of their size) are rewritten
+# by the compact management command.
+CLOUDSTRYPE_PACK_THRESHOLD = \
+    ENV('CLOUDSTRYPE_PACK_THRESHOLD', cast=int, default=64 * 1024)
+CLOUDSTRYPE_PACK_SIZE = \
+    ENV('CLOUDSTRYPE_PACK_SIZE', cast=int, default=4 * 1024 * 1024)
+CLOUDSTRYPE_PACK_COMPACT_RATIO = \
+    ENV('CLOUDSTRYPE_PACK_COMPACT_RATIO', cast=float, default=0.5)
+
+# Number of rows written per query by bulk operations (such as copying a
+# directory tree).
+CLOUDSTRYPE_BULK_BATCH_SIZE = \
+    ENV('CLOUDSTRYPE_BULK_BATCH_SIZE', cast=int, default=1000)
+
+# Sharing a directory containing more files than this is done in the
+# background (by the jobs management command).
+CLOUDSTRYPE_SHARE_JOB_THRESHOLD = \
+    ENV('CLOUDSTRYPE_SHARE_JOB_THRESHOLD', cast=int, default=1000)
+
+# Time (seconds) after which a running job is assumed to have been abandoned
+# (it's worker crashed) and is run again. Must exceed the longest job.
+CLOUDSTRYPE_JOB_TIMEOUT = \
+    ENV('CLOUDSTRYPE_JOB_TIMEOUT', cast=int, default=86400)
+
+# Deleted files are purged after this many seconds (by the gc management
+# command), and their chunks deleted from storage. Deleted files can be
+# restored until then.
+CLOUDSTRYPE_GC_GRACE = ENV('CLOUDSTRYPE_GC_GRACE', cast=int, default=86400 * 7)
+# Number of chunks the garbage collector examines per query.
+CLOUDSTRYPE_GC_BATCH_SIZE = \
+    ENV('CLOUDSTRYPE_GC_BATCH_SIZE', cast=int, default=500)
+# Number of chunks deleted from the storage providers concurrently, and the
+# maximum number of deletes per second sent to a single storage.
+CLOUDSTRYPE_GC_WORKERS = ENV('CLOUDSTRYPE_GC_WORKERS', cast=int, default=8)
+CLOUDSTRYPE_GC_RATE = ENV('CLOUDSTRYPE_GC_RATE', cast=float, default=10)
+
+# Resumable upload sessions not used for this many seconds are abandoned, they
+# are purged by the garbage collector.
+CLOUDSTRYPE_UPLOAD_SESSION_TTL = \
+    ENV('CLOUDSTRYPE_UPLOAD_SESSION_TTL', cast=int, default=86400)
+
 # In production, we send mail through a 3rd party. Otherwise use locmem.
 EMAIL_BACKEND = ENV('EMAIL_BACKEND', default='django.core.mail.backends.console.EmailBackend')
 EMAIL_FROM = ('Cloudstrype', 'service@cloudstrype.io')
@@ -1,10 +1,22 @@
 import os
 import pickle
+import queue
+import logging
 import tempfile
+import threading
 
+from hashlib import md5
+from os.path import dirname
+
+from django.conf import settings
+from django.core.cache import cache as default_cache
 from django.core.cache.backends.filebased import FileBasedCache
 from django.core.cache.backends.base import DEFAULT_TIMEOUT
 from django.core.files.move import file_move_safe
+from django.db import transaction
+
+
+LOGGER = logging.getLogger(__name__)
 
 
 class ChunkFileCache(FileBasedCache):
@@ -40,3 +52,283 @@ class ChunkFileCache(FileBasedCache):
         finally:
             if not renamed:
                 os.remove(tmp_path)
+
+
+class WriteBehindCache(object):
+    """
+    Populates a cache from a background thread.
+
+    Calls to set() are queued and performed by a worker thread, so the caller
+    never waits on the cache backend. The queue is bounded, when it is full new
+    entries are dropped. A dropped entry only costs a cache miss later, which
+    is preferable to stalling an upload on local disk.
+    """
+
+    def __init__(self, cache, maxsize=32):
+        self.cache = cache
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _start(self):
+        # The thread is started lazily, and restarted in a forked child (uWSGI
+        # forks workers after importing the application, threads do not
+        # survive the fork).
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._queue = queue.Queue(maxsize=self.maxsize)
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name='write-behind-cache')
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def _run(self):
+        q = self._queue
+        while True:
+            key, value, timeout = q.get()
+            try:
+                self.cache.set(key, value, timeout=timeout)
+            except Exception as e:
+                LOGGER.exception(e)
+            finally:
+                q.task_done()
+
+    def get(self, key, default=None):
+        return self.cache.get(key, default)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        """
+        Queue a cache entry for writing.
+
+        Returns False if the entry was dropped because the queue was full.
+        """
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            self._start()
+        try:
+            self._queue.put_nowait((key, value, timeout))
+        except queue.Full:
+            self.dropped += 1
+            LOGGER.debug('Write-behind queue full, dropping %s', key)
+            return False
+        return True
+
+    def join(self):
+        """Block until all queued entries are written."""
+        self._queue.join()
+
+
+class AssembledFileCache(object):
+    """
+    Caches whole files, in plaintext, on local disk.
+
+    Entries are keyed by version uid. A version does not change once written,
+    so entries never need to be invalidated. Cached files can be handed to the
+    front-end (X-Accel-Redirect) or sent using sendfile(), so the data never
+    passes through Python.
+
+    This cache contains decrypted data, the directory should reside on an
+    encrypted volume.
+    """
+
+    def __init__(self, dir, max_entries=300, cull_frequency=3):
+        self.dir = dir
+        self.max_entries = max_entries
+        self.cull_frequency = cull_frequency
+
+    def path(self, key):
+        return os.path.join(self.dir, key)
+
+    def get(self, key):
+        """Return the path of a cached file or None."""
+        path = self.path(key)
+        try:
+            # Touch the file, culling removes the least recently used.
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def writer(self, key):
+        """Return a file-like object that populates the cache on commit()."""
+        os.makedirs(self.dir, exist_ok=True)
+        return AssembledFileWriter(self, key)
+
+    def _cull(self):
+        try:
+            entries = [
+                e for e in os.scandir(self.dir)
+                if e.is_file() and not e.name.startswith('tmp')
+            ]
+        except FileNotFoundError:
+            return
+        if len(entries) < self.max_entries:
+            return
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        for e in entries[:len(entries) // self.cull_frequency or 1]:
+            try:
+                os.remove(e.path)
+            except FileNotFoundError:
+                pass
+
+
+class AssembledFileWriter(object):
+    """
+    Writes a file into AssembledFileCache.
+
+    Data is written to a temporary file, which is moved into place by commit().
+    Partial files are never visible to readers.
+    """
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        fd, self._tmp_path = tempfile.mkstemp(dir=cache.dir)
+        self._f = open(fd, 'wb')
+
+    def write(self, data):
+        self._f.write(data)
+
+    def commit(self):
+        self._f.close()
+        self.cache._cull()
+        file_move_safe(self._tmp_path, self.cache.path(self.key),
+                       allow_overwrite=True)
+
+    def abort(self):
+        self._f.close()
+        try:
+            os.remove(self._tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+class DentryCache(object):
+    """
+    Caches path lookups for a user.
+
+    Maps a path to the type ('d' or 'f') and id of the UserDir or UserFile it
+    refers to. Missing paths are cached too (negative entries), their type is
+    None.
+
+    Entries are kept in the default cache so they are shared by all workers.
+    Each user has a generation counter which forms part of every key.
+    Incrementing the generation invalidates all of that user's entries at
+    once, which is how subtree operations (rmdir, moving or copying a
+    directory) invalidate. Single entries are invalidated by deleting their
+    key (and the keys of their ancestors, which may have been created).
+
+    Invalidation is deferred until the transaction commits, and nothing is
+    cached from within a transaction, so the cache only reflects committed
+    state.
+    """
+
+    DIR = 'd'
+    FILE = 'f'
+
+    # Hits and misses are counted locally and periodically added to counters
+    # in the default cache, so the hit rate covers all workers. Filesystems
+    # may be used by many threads (the transfer server), so counting is
+    # locked.
+    STATS_FLUSH = 100
+    _hits = 0
+    _misses = 0
+    _stats_lock = threading.Lock()
+
+    def __init__(self, user, cache=None,
+                 timeout=settings.DENTRY_CACHE_TIMEOUT):
+        self.user_id = user.id
+        self.cache = cache or default_cache
+        self.timeout = timeout
+
+    @property
+    def generation(self):
+        # Read for every operation, another worker may have incremented it.
+        key = 'dentry-gen:%s' % self.user_id
+        generation = self.cache.get(key)
+        if generation is None:
+            self.cache.add(key, 0, timeout=None)
+            generation = self.cache.get(key, 0)
+        return generation
+
+    def _key(self, path, generation):
+        path = md5(path.encode('utf-8')).hexdigest()
+        return 'dentry:%s:%s:%s' % (self.user_id, generation, path)
+
+    @classmethod
+    def _count(cls, cache, hit):
+        with cls._stats_lock:
+            if hit:
+                cls._hits += 1
+            else:
+                cls._misses += 1
+            if cls._hits + cls._misses < cls.STATS_FLUSH:
+                return
+            hits, misses, cls._hits, cls._misses = cls._hits, cls._misses, 0, 0
+        for key, value in (('hits', hits), ('misses', misses)):
+            key = 'dentry-stats:%s' % key
+            try:
+                if not cache.add(key, value, timeout=None):
+                    cache.incr(key, value)
+            except ValueError:
+                # Evicted (or the cache is unavailable), these counts are
+                # lost.
+                pass
+
+    @classmethod
+    def stats(cls, cache=None):
+        """Return hit rate (for all workers)."""
+        cache = cache or default_cache
+        hits = cache.get('dentry-stats:hits', 0) + cls._hits
+        misses = cache.get('dentry-stats:misses', 0) + cls._misses
+        total = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'ratio': hits / total if total else None,
+        }
+
+    def get(self, path):
+        """
+        Return (type, id) for a path, or None if it is not cached.
+        """
+        entry = self.cache.get(self._key(path, self.generation))
+        self._count(self.cache, entry is not None)
+        return entry
+
+    def set(self, path, type, id=None):
+        # Inside a transaction the entry may describe uncommitted (and possibly
+        # rolled back) state, so it is not cached.
+        if transaction.get_connection().in_atomic_block:
+            return
+        self.cache.set(self._key(path, self.generation), (type, id),
+                       timeout=self.timeout)
+
+    def invalidate(self, *paths):
+        """Invalidate paths, and their ancestors."""
+        keys, generation = set(), self.generation
+        for path in paths:
+            while True:
+                keys.add(self._key(path, generation))
+                if path == '/':
+                    break
+                path = dirname(path)
+        # Until the change is committed, other workers still see (and may
+        # cache) the old state. So invalidation happens after commit.
+        transaction.on_commit(lambda: self.cache.delete_many(keys))
+
+    def invalidate_all(self):
+        """Invalidate all of the user's entries."""
+        transaction.on_commit(self._increment)
+
+    def _increment(self):
+        key = 'dentry-gen:%s' % self.user_id
+        self.cache.add(key, 0, timeout=None)
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            # Evicted between add() and incr().
+            self.cache.set(key, 1, timeout=None)
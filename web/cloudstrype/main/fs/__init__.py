@@ -46,21 +46,35 @@ import magic
 from django.conf import settings
 from django.core.cache import caches
 from django.db import transaction
+from django.db.models import Count, F
 
+from main.cache import WriteBehindCache, AssembledFileCache, DentryCache
 from main.models import (
-    UserDir, UserFile, File, FileTag, Chunk, ChunkStorage,
+    UserDir, UserFile, File, FileTag, FileVersion, Version, Chunk,
+    VersionChunk, ChunkStorage, Change, UploadSession, normpath,
 )
 from main.fs.raid import chunker
 from main.fs.array import get_shared_arrays
 from main.fs.errors import (
     DirectoryNotFoundError, FileNotFoundError, PathNotFoundError,
-    DirectoryConflictError, FileConflictError
+    DirectoryConflictError, FileConflictError, IncompleteUploadError
 )
 
 
 REPLICAS = 2
 LOGGER = logging.getLogger(__name__)
 CHUNK_CACHE = caches['chunks']
+# Cache population is performed in the background, so it never delays a
+# transfer.
+CHUNK_CACHE_WRITER = WriteBehindCache(
+    CHUNK_CACHE, maxsize=settings.CHUNK_CACHE_QUEUE_SIZE)
+# Optional cache of whole, decrypted files. Hot files are served from here.
+if settings.CLOUDSTRYPE_ASSEMBLED_CACHE:
+    ASSEMBLED_CACHE = AssembledFileCache(
+        settings.CLOUDSTRYPE_ASSEMBLED_CACHE,
+        max_entries=settings.CLOUDSTRYPE_ASSEMBLED_CACHE_MAX_ENTRIES)
+else:
+    ASSEMBLED_CACHE = None
 
 
 DirectoryListing = collections.namedtuple('DirectoryListing',
@@ -77,6 +91,54 @@ class MultiCloudBase(object):
         self.storage = list(user.storages.all())
         self.storage.extend(get_shared_arrays())
 
+    def _fetch_chunk(self, chunk):
+        data = CHUNK_CACHE.get('chunk:%s' % chunk.uid)
+        if data is not None:
+            return chunk.unpack(data)
+        # Try providers in random order.
+        for cs in sorted(chunk.storages.all(), key=lambda k: random.random()):
+            # Since chunks are shared with other users, we need to get the
+            # client for the chunk, not one of the clients for the current
+            # user.
+            client = cs.storage.get_client()
+            try:
+                data = client.download(chunk)
+            except Exception as e:
+                LOGGER.exception(e)
+                continue
+            unpacked = chunk.unpack(data)
+            CHUNK_CACHE_WRITER.set('chunk:%s' % chunk.uid, data)
+            return unpacked
+        raise IOError('Failed to read chunk %s' % chunk.uid)
+
+    def _write_chunk_replicas(self, chunk, data, replicas):
+        storages = sorted(self.storage, key=lambda k: random.random())
+        written = 0
+
+        # Try to upload up to three times.
+        for retry in range(3):
+            # Try each remaining provider in turn.
+            for storage in storages:
+                client = storage.get_client()
+                try:
+                    attrs = client.upload(chunk, data)
+                except Exception as e:
+                    LOGGER.exception(e, exc_info=True)
+                    # Try next provider.
+                    continue
+                else:
+                    # Remove this storage provider from the list.
+                    cs = ChunkStorage(chunk=chunk, storage=storages.pop(0))
+                    cs.attrs = attrs or {}
+                    cs.save()
+                    chunk.storages.add(cs)
+                    written += 1
+                # If we reach our goal, return, we are done.
+                if written == replicas + 1:
+                    return
+        # If we get here, we failed to reach our replica goal.
+        raise IOError('Failed to write chunk')
+
 
 class FileLikeBase(object):
     """
@@ -119,41 +181,79 @@ class MultiCloudReader(MultiCloudBase, FileLikeBase):
     def __init__(self, user, version):
         super().__init__(user)
         self.version = version
-        self.chunks = list(
-            Chunk.objects.filter(
-                filechunks__version=version).order_by('filechunks__serial')
-        )
+        self._inline = None
+        if version.inline:
+            # Tiny files are read from the database, see MultiCloudWriter.
+            self.chunks = []
+            self._inline = version.load()
+        else:
+            # The offset and length are those of packed data (otherwise
+            # None).
+            self.chunks = list(
+                Chunk.objects.filter(filechunks__version=version)
+                .annotate(offset=F('filechunks__offset'),
+                          length=F('filechunks__length'))
+                .order_by('filechunks__serial')
+            )
         self._buffer = []
         self._closed = False
+        # Decided by the first read(), see _assembler().
+        self._reading = False
+        self._assembled = None
+
+    def fetch(self, chunk):
+        """
+        Fetch the data of one of self.chunks.
+
+        Unlike read(), chunks can be fetched concurrently (by threads), as the
+        transfer server does.
+        """
+        data = self._fetch_chunk(chunk)
+        if chunk.offset is not None:
+            data = data[chunk.offset:chunk.offset + chunk.length]
+        return data
+
+    def _assembler(self):
+        """
+        Return a writer assembling the file in ASSEMBLED_CACHE, or None.
+
+        If every chunk was read recently, this is a hot file. It is assembled
+        as it is read, so it can be served from disk next time. Only files
+        read in order (by read()) are assembled, and only those of up to
+        CLOUDSTRYPE_ASSEMBLED_CACHE_MAX_SIZE bytes.
+        """
+        if ASSEMBLED_CACHE is None or not self.chunks or \
+                (self.version.size or 0) > \
+                settings.CLOUDSTRYPE_ASSEMBLED_CACHE_MAX_SIZE:
+            return None
+        if not all(CHUNK_CACHE.has_key('chunk:%s' % c.uid)
+                   for c in self.chunks):
+            return None
+        return ASSEMBLED_CACHE.writer(self.version.uid)
 
     def _read_chunk(self):
+        if self._inline is not None:
+            data, self._inline = self._inline, None
+            return data
+        if not self._reading:
+            self._reading = True
+            self._assembled = self._assembler()
         try:
             chunk = self.chunks.pop(0)
         except IndexError:
             raise EOFError('out of chunks')
-        data = CHUNK_CACHE.get('chunk:%s' % chunk.uid)
-        if data is not None:
-            return chunk.unpack(data)
-        # Try providers in random order.
-        for cs in sorted(chunk.storages.all(), key=lambda k: random.random()):
-            # Since chunks are shared with other users, we need to get the
-            # client for the chunk, not one of the clients for the current
-            # user.
-            client = cs.storage.get_client()
-            try:
-                data = client.download(chunk)
-            except Exception as e:
-                LOGGER.exception(e)
-                continue
-            unpacked = chunk.unpack(data)
-            CHUNK_CACHE.set('chunk:%s' % chunk.uid, data)
-            return unpacked
-        raise IOError('Failed to read chunk %s' % chunk.uid)
+        data = self.fetch(chunk)
+        if self._assembled is not None:
+            self._assembled.write(data)
+            if not self.chunks:
+                self._assembled.commit()
+                self._assembled = None
+        return data
 
     def __iter__(self):
         if self._closed:
             raise IOError('I/O operation on closed file.')
-        while self.chunks:
+        while self.chunks or self._inline is not None:
             yield self.read()
 
     def read(self, size=-1):  # NOQA
@@ -167,10 +267,20 @@ class MultiCloudReader(MultiCloudBase, FileLikeBase):
         except EOFError:
             return
 
+    def close(self):
+        super().close()
+        # Discard a partially assembled file.
+        if self._assembled is not None:
+            self._assembled.abort()
+            self._assembled = None
+
 
 class MultiCloudWriter(MultiCloudBase, FileLikeBase):
     """
     File-like object that writes to multiple clouds.
+
+    A file of no more than CLOUDSTRYPE_INLINE_THRESHOLD bytes (written in a
+    single write) is stored on the version instead.
     """
     def __init__(self, user, file, version,
                  chunk_size=settings.CLOUDSTRYPE_CHUNK_SIZE,
@@ -183,36 +293,21 @@ class MultiCloudWriter(MultiCloudBase, FileLikeBase):
         self._md5 = md5()
         self._sha1 = sha1()
         self._size = 0
+        self._count = 0
         self._buffer = []
+        self._inline = None
         self._closed = False
 
-    def _write_chunk_replicas(self, chunk, data):
-        storages = sorted(self.storage, key=lambda k: random.random())
-        replicas = 0
+    def _should_cache(self):
+        """
+        Decide whether a newly written chunk should be cached.
 
-        # Try to upload up to three times.
-        for retry in range(3):
-            # Try each remaining provider in turn.
-            for storage in storages:
-                client = storage.get_client()
-                try:
-                    attrs = client.upload(chunk, data)
-                except Exception as e:
-                    LOGGER.exception(e, exc_info=True)
-                    # Try next provider.
-                    continue
-                else:
-                    # Remove this storage provider from the list.
-                    cs = ChunkStorage(chunk=chunk, storage=storages.pop(0))
-                    cs.attrs = attrs or {}
-                    cs.save()
-                    chunk.storages.add(cs)
-                    replicas += 1
-                # If we reach our goal, return, we are done.
-                if replicas == self.replicas + 1:
-                    return
-        # If we get here, we failed to reach our replica goal.
-        raise IOError('Failed to write chunk')
+        Only the leading chunks of an upload are cached, these are the ones
+        most likely to be read back soon (previews, mime sniffing, players
+        buffering the start of a file).
+        """
+        limit = settings.CHUNK_CACHE_WRITE_CHUNKS
+        return limit is None or self._count <= limit
 
     def _write_chunk(self, data):
         """
@@ -224,10 +319,12 @@ class MultiCloudWriter(MultiCloudBase, FileLikeBase):
         data = chunk.pack(data)
 
         # Try to write replicas. If this fails, it raises.
-        self._write_chunk_replicas(chunk, data)
+        self._write_chunk_replicas(chunk, data, self.replicas)
+        self._count += 1
 
         # Freshen the cache.
-        CHUNK_CACHE.set('chunk:%s' % chunk.uid, data)
+        if self._should_cache():
+            CHUNK_CACHE_WRITER.set('chunk:%s' % chunk.uid, data)
         self.version.add_chunk(chunk)
 
     def write(self, data):
@@ -250,7 +347,16 @@ class MultiCloudWriter(MultiCloudBase, FileLikeBase):
         self._size += len(data)
         self._md5.update(data)
         self._sha1.update(data)
-        self._write_chunk(data)
+        if self._inline is not None:
+            # Not the whole file after all.
+            self._write_chunk(self._inline)
+            self._inline = None
+        if self._count == 0 and \
+                self._size <= settings.CLOUDSTRYPE_INLINE_THRESHOLD:
+            # Held back, it may be the whole file.
+            self._inline = data
+        else:
+            self._write_chunk(data)
 
     def close(self):
         """
@@ -261,8 +367,82 @@ class MultiCloudWriter(MultiCloudBase, FileLikeBase):
         self.version.size = self._size
         self.version.md5 = self._md5.hexdigest()
         self.version.sha1 = self._sha1.hexdigest()
+        fields = ['size', 'md5', 'sha1']
+        if self._inline is not None:
+            self.version.store(self.user, self._inline)
+            fields.extend(('key', 'data'))
         # Flush to db.
-        self.version.save(update_fields=['size', 'md5', 'sha1'])
+        self.version.save(update_fields=fields)
+
+
+class PackWriter(MultiCloudBase, FileLikeBase):
+    """
+    Packs the data of small files into shared chunks.
+
+    Every provider request has a fixed cost (and providers rate limit them),
+    so rather than a chunk per small file, data is appended to a pack which is
+    written as a single chunk once it reaches `size` (or on close). Each item
+    occupies a range (offset, length) of the pack.
+
+    Items are placed by _place() once their pack is written. Items of a pack
+    that could not be written are collected in `failed`.
+    """
+
+    def __init__(self, user, replicas=REPLICAS, size=None):
+        super().__init__(user)
+        self.replicas = replicas
+        self.size = size or settings.CLOUDSTRYPE_PACK_SIZE
+        self.failed = []
+        self._pending = []
+        self._length = 0
+        self._closed = False
+
+    def add(self, item, data):
+        """Append data (of item) to the pack."""
+        if self._closed:
+            raise IOError('I/O operation on closed file.')
+        self._pending.append((item, data))
+        self._length += len(data)
+        if self._length >= self.size:
+            self.flush()
+
+    def flush(self):
+        """Write the pending items as a pack."""
+        pending, self._pending, self._length = self._pending, [], 0
+        if not pending:
+            return
+        data = b''.join(data for _, data in pending)
+        # The pack, and each replica as it is written, are recorded before
+        # the items are placed. A pack that fails part way is then
+        # unreferenced, and the garbage collector deletes the replicas
+        # written.
+        chunk = Chunk.objects.create(size=len(data), user=self.user)
+        packed = chunk.pack(data)
+        try:
+            self._write_chunk_replicas(chunk, packed, self.replicas)
+        except IOError as e:
+            LOGGER.warning('Could not write pack: %s', e)
+            self.failed.extend(item for item, _ in pending)
+            return
+        # Reading any item reads the whole pack, so it is cached.
+        CHUNK_CACHE_WRITER.set('chunk:%s' % chunk.uid, packed)
+        with transaction.atomic():
+            offset = 0
+            for item, data in pending:
+                self._place(item, chunk, offset, data)
+                offset += len(data)
+
+    def _place(self, version, chunk, offset, data):
+        """Place a version (data being it's whole content) in a pack."""
+        version.add_chunk(chunk, offset=offset, length=len(data))
+        version.size = len(data)
+        version.md5 = md5(data).hexdigest()
+        version.sha1 = sha1(data).hexdigest()
+        version.save(update_fields=['size', 'md5', 'sha1'])
+
+    def close(self):
+        super().close()
+        self.flush()
 
 
 class MultiCloudFilesystem(MultiCloudBase):
@@ -272,6 +452,65 @@ class MultiCloudFilesystem(MultiCloudBase):
         self.chunk_size = chunk_size
         self.level = user.get_option('raid_level', 0)
         self.replicas = user.get_option('raid_replicas', replicas)
+        self.dentries = DentryCache(user)
+
+    def _resolve(self, path):
+        """
+        Resolve a path against the database.
+
+        The result (including a missing path) is stored in the dentry cache.
+        """
+        try:
+            obj = UserFile.objects.get(path=path, user=self.user)
+        except UserFile.DoesNotExist:
+            try:
+                obj = UserDir.objects.get(path=path, user=self.user)
+            except UserDir.DoesNotExist:
+                obj = None
+        if obj is None:
+            self.dentries.set(path, None)
+        elif obj.isdir:
+            self.dentries.set(path, DentryCache.DIR, obj.id)
+        else:
+            self.dentries.set(path, DentryCache.FILE, obj.id)
+        return obj
+
+    def _lookup(self, path):
+        """
+        Locate the UserFile or UserDir at path.
+
+        Returns None if path does not exist.
+        """
+        path = normpath(path)
+        entry = self.dentries.get(path)
+        if entry is None:
+            return self._resolve(path)
+        type, id = entry
+        if type is None:
+            return
+        model = UserDir if type == DentryCache.DIR else UserFile
+        try:
+            return model.objects.get(id=id, user=self.user)
+        except model.DoesNotExist:
+            # Stale entry.
+            return self._resolve(path)
+
+    def _stat(self, path):
+        """
+        Determine the type of path.
+
+        Returns DentryCache.DIR, DentryCache.FILE or None if path does not
+        exist. This does not need to load the object, so a cached path does not
+        touch the database.
+        """
+        path = normpath(path)
+        entry = self.dentries.get(path)
+        if entry is not None:
+            return entry[0]
+        obj = self._resolve(path)
+        if obj is None:
+            return
+        return DentryCache.DIR if obj.isdir else DentryCache.FILE
 
     def download(self, path, file=None, version=None):
         """
@@ -282,15 +521,25 @@ class MultiCloudFilesystem(MultiCloudBase):
         """
         # If caller did not give a file (only a path), lookup the file by path.
         if file is None:
-            try:
-                file = UserFile.objects.get(path=path, user=self.user)
-            except UserFile.DoesNotExist:
+            file = self._lookup(path)
+            if file is None or not file.isfile:
                 raise FileNotFoundError(path)
         # If caller did not specify version, select the current one.
         if version is None:
             version = file.file.version
         return MultiCloudReader(self.user, version)
 
+    def cached(self, version):
+        """
+        Locate a local copy of a file version.
+
+        Returns the path of the assembled file if it is cached, otherwise None.
+        The caller can send the file without reading it through Python.
+        """
+        if ASSEMBLED_CACHE is None:
+            return
+        return ASSEMBLED_CACHE.get(version.uid)
+
     @transaction.atomic
     def upload(self, path, f):
         """
@@ -304,28 +553,260 @@ class MultiCloudFilesystem(MultiCloudBase):
             'not enough storage (%s) for %s replicas' % (len(self.storage),
                                                          self.replicas)
 
-        try:
-            # Check user's hierarchy for the file.
-            user_file = UserFile.objects.get(path=path, user=self.user)
+        # Check user's hierarchy for the file.
+        user_file = self._lookup(path)
+        if user_file is not None and user_file.isfile:
             # If it exists, make a new version of it.
+            old_size = user_file.file.version.size
             version = user_file.file.add_version()
-        except UserFile.DoesNotExist:
+            action = Change.ACTION_UPDATE
+        else:
             # Place the new file into the user's hierarchy.
             user_file = UserFile.objects.create(
                 path=path, name=basename(path), user=self.user)
+            self.dentries.invalidate(normpath(path))
             # Grab ref to version, since we upload to THAT.
-            version = user_file.file.version
+            version, old_size = user_file.file.version, 0
+            action = Change.ACTION_CREATE
 
         # Upload the file.
-        size, count = 0, 0
+        self._write(user_file, version, f)
+
+        # Totals of the directories containing the file.
+        user_file.file.add_size(version.size - old_size)
+        Change.objects.record(self.user, action, user_file)
+        return user_file
+
+    def _write(self, user_file, version, f):
+        """Write the data of f to version, in chunks."""
         with MultiCloudWriter(self.user, user_file, version,
                               chunk_size=self.chunk_size,
                               replicas=self.replicas) as out:
             for data in chunker(f, chunk_size=self.chunk_size):
-                size += len(data)
-                count += 1
                 out.write(data)
 
+    @transaction.atomic
+    def upload_many(self, files):
+        """
+        Upload many (small) files.
+
+        files is a sequence of (path, file-like object) pairs. The data of
+        files up to CLOUDSTRYPE_PACK_THRESHOLD bytes is packed together (see
+        PackWriter), other files (including those stored inline) are written
+        as by upload(). The metadata of
+        new files is created in bulk, and the usage totals and change journal
+        are updated once for the whole batch.
+
+        Returns a list of (path, result) pairs in the order given, where result
+        is the UserFile, or the exception that prevented it's upload. A file
+        that fails does not prevent the others from being uploaded.
+        """
+        assert len(self.storage) >= self.replicas, \
+            'not enough storage (%s) for %s replicas' % (len(self.storage),
+                                                         self.replicas)
+
+        paths = [normpath(path) for path, _ in files]
+        existing = {
+            f.path: f for f in UserFile.objects.all()
+            .at_paths(self.user, paths)
+            .select_related('parent', 'file__version')
+        }
+        dirs = set(UserDir.objects.filter(user=self.user, path__in=paths)
+                   .values_list('path', flat=True))
+        parents, seen, written = {}, set(), []
+        inline = settings.CLOUDSTRYPE_INLINE_THRESHOLD
+        threshold = settings.CLOUDSTRYPE_PACK_THRESHOLD
+
+        # Small files are packed together, larger ones are written as by
+        # upload().
+        with PackWriter(self.user, replicas=self.replicas) as packer:
+            for path, (_, f) in zip(paths, files):
+                parent, name = pathsplit(path)
+                try:
+                    if not name or path in dirs:
+                        raise DirectoryConflictError(path)
+                    if path in seen:
+                        raise FileConflictError(path)
+                    seen.add(path)
+                    user_file = existing.get(path)
+                    if user_file is None:
+                        if parent not in parents:
+                            parents[parent], _ = \
+                                UserDir.objects.get_or_create(
+                                    user=self.user, path=parent)
+                        user_file = UserFile(user=self.user, name=name,
+                                             parent=parents[parent])
+                    # A failed write leaves nothing behind.
+                    with transaction.atomic():
+                        version = Version.objects.create()
+                        data = f.read(threshold + 1)
+                        if inline < len(data) <= threshold:
+                            packer.add(version, data)
+                        else:
+                            f.seek(0)
+                            self._write(user_file, version, f)
+                except (IOError, DirectoryConflictError,
+                        FileConflictError) as e:
+                    LOGGER.warning('Could not upload %s: %s', path, e)
+                    written.append((path, e, None))
+                    continue
+                written.append((path, user_file, version))
+
+        # Files whose pack could not be written.
+        failed = {version.id for version in packer.failed}
+        if failed:
+            Version.objects.filter(id__in=failed).delete()
+        results, created, updated = [], [], []
+        for path, user_file, version in written:
+            if version is None:
+                # user_file is the exception.
+                pass
+            elif version.id in failed:
+                user_file = IOError('Failed to write pack')
+            elif user_file.pk is None:
+                created.append((user_file, version))
+            else:
+                updated.append((user_file, version))
+            results.append((path, user_file))
+
+        if created:
+            new = File.objects.bulk_create([
+                File(owner=self.user, version=version)
+                for _, version in created
+            ])
+            FileVersion.objects.bulk_create([
+                FileVersion(file=file, version=file.version) for file in new
+            ])
+            for (user_file, _), file in zip(created, new):
+                user_file.file = file
+            UserFile.objects.bulk_create([f for f, _ in created])
+            totals = collections.defaultdict(lambda: [0, 0])
+            for user_file, version in created:
+                total = totals[user_file.parent.path]
+                total[0] += version.size
+                total[1] += 1
+            for path, (size, count) in totals.items():
+                UserDir.objects.add_usage(self.user.id, path, size, count)
+            self.dentries.invalidate(*[f.path for f, _ in created])
+        for user_file, version in updated:
+            old_size = user_file.file.version.size
+            user_file.file.add_version(version)
+            user_file.file.add_size(version.size - old_size)
+        Change.objects.record_many(self.user, Change.ACTION_CREATE,
+                                   [f for f, _ in created])
+        Change.objects.record_many(self.user, Change.ACTION_UPDATE,
+                                   [f for f, _ in updated])
+        return results
+
+    @transaction.atomic
+    def start_upload(self, path, size=None):
+        """
+        Start a resumable upload of the file at path.
+
+        Parts are written by write_part(), the file is created (or updated)
+        by commit_upload(). See UploadSession.
+        """
+        path = normpath(path)
+        if self.isdir(path):
+            raise DirectoryConflictError(path)
+        return UploadSession.objects.create(
+            user=self.user, path=path, size=size,
+            version=Version.objects.create())
+
+    def write_part(self, session, number, data):
+        """
+        Write part number of an upload session as a single chunk.
+
+        Parts can be written concurrently. Writing a part again replaces it.
+        """
+        assert len(self.storage) >= self.replicas, \
+            'not enough storage (%s) for %s replicas' % (len(self.storage),
+                                                         self.replicas)
+        # Referenced before it is written, so the garbage collector leaves it
+        # be. Written to the providers outside of the lock, so parts are
+        # transferred in parallel.
+        chunk = self.add_part(session, number, len(data))
+        data = chunk.pack(data)
+        try:
+            self._write_chunk_replicas(chunk, data, self.replicas)
+        except Exception:
+            # Released, the garbage collector deletes any replicas written.
+            VersionChunk.objects.filter(version_id=session.version_id,
+                                        chunk=chunk).delete()
+            raise
+        # Leading parts are cached, as for MultiCloudWriter.
+        limit = settings.CHUNK_CACHE_WRITE_CHUNKS
+        if limit is None or number <= limit:
+            CHUNK_CACHE_WRITER.set('chunk:%s' % chunk.uid, data)
+        return chunk
+
+    @transaction.atomic
+    def add_part(self, session, number, size):
+        """
+        Add a chunk of size to an upload session as part number.
+
+        The chunk is not yet written, commit_upload() refuses the session
+        until it is. Raises UploadSession.DoesNotExist if the session was
+        committed (or expired).
+        """
+        session = UploadSession.objects.select_for_update() \
+            .select_related('version').get(pk=session.pk)
+        chunk = Chunk.objects.create(size=size, user=self.user)
+        session.version.add_chunk(chunk, serial=number)
+        session.touch()
+        return chunk
+
+    @transaction.atomic
+    def commit_upload(self, session):
+        """
+        Create (or update) the file of an upload session.
+
+        Raises IncompleteUploadError if parts are missing, or the size is not
+        that given when the session was started.
+        """
+        session = UploadSession.objects.select_for_update() \
+            .select_related('version').get(pk=session.pk)
+        parts = session.parts()
+        if [number for number, _ in parts] != list(range(1, len(parts) + 1)):
+            raise IncompleteUploadError('Parts are missing')
+        version = session.version
+        if version.filechunks.annotate(replicas=Count('chunk__storages')) \
+                .filter(replicas__lte=self.replicas).exists():
+            raise IncompleteUploadError('Parts are being written')
+        version.size = sum(size for _, size in parts)
+        if session.size is not None and version.size != session.size:
+            raise IncompleteUploadError(
+                'Received %s of %s bytes' % (version.size, session.size))
+        # Whole file digests would mean reading the file back, they are
+        # left empty.
+        version.save(update_fields=['size'])
+        session.delete()
+        return self.put_version(session.path, version)
+
+    @transaction.atomic
+    def put_version(self, path, version):
+        """
+        Make version (already written) the current version of the file at path.
+
+        The file is created if it does not exist.
+        """
+        path = normpath(path)
+        user_file = self._lookup(path)
+        if user_file is not None and user_file.isdir:
+            raise DirectoryConflictError(path)
+        if user_file is not None:
+            old_size = user_file.file.version.size
+            user_file.file.add_version(version)
+            user_file.file.add_size(version.size - old_size)
+            Change.objects.record(self.user, Change.ACTION_UPDATE, user_file)
+        else:
+            # The directory totals include the version's size.
+            file = File.objects.create(owner=self.user, version=version)
+            FileVersion.objects.create(file=file, version=version)
+            user_file = UserFile.objects.create(path=path, file=file,
+                                                user=self.user)
+            self.dentries.invalidate(path)
+            Change.objects.record(self.user, Change.ACTION_CREATE, user_file)
         return user_file
 
     @transaction.atomic
@@ -340,29 +821,40 @@ class MultiCloudFilesystem(MultiCloudBase):
         the chunks from cloud providers and Metastore backend.
         """
         if file is None:
-            try:
-                file = UserFile.objects.get(path=path, user=self.user)
-            except UserFile.DoesNotExist:
+            file = self._lookup(path)
+            if file is None or not file.isfile:
                 raise FileNotFoundError(path)
+        path = file.path
         file.delete()
+        Change.objects.record(self.user, Change.ACTION_DELETE, file)
+        self.dentries.invalidate(path)
 
+    @transaction.atomic
     def mkdir(self, path):
         if self.isfile(path):
             raise FileConflictError(path)
-        return UserDir.objects.create(path=path, user=self.user)
+        dir = UserDir.objects.create(path=path, user=self.user)
+        Change.objects.record(self.user, Change.ACTION_CREATE, dir)
+        self.dentries.invalidate(dir.path)
+        return dir
 
+    @transaction.atomic
     def rmdir(self, path, dir=None):
         if dir is None:
-            try:
-                dir = UserDir.objects.get(path=path, user=self.user)
-            except UserDir.DoesNotExist:
+            dir = self._lookup(path)
+            if dir is None or not dir.isdir:
                 raise DirectoryNotFoundError(path)
-        dir.delete()
+        stats = dir.delete()
+        Change.objects.record(self.user, Change.ACTION_DELETE, dir)
+        # Everything beneath dir is gone too.
+        self.dentries.invalidate_all()
+        return stats
 
     @transaction.atomic
     def _move_file(self, file, dst):
         if self.isdir(dst):
             raise DirectoryConflictError(dst)
+        src = file.path
         dst, file.name = pathsplit(dst.lstrip('/'))
         if dst:
             try:
@@ -371,12 +863,16 @@ class MultiCloudFilesystem(MultiCloudBase):
             except UserDir.DoesNotExist:
                 raise DirectoryNotFoundError(dst)
         file.save(update_fields=['parent', 'name'])
+        Change.objects.record(self.user, Change.ACTION_MOVE, file,
+                              old_path=src)
+        self.dentries.invalidate(src, file.path)
         return file
 
     @transaction.atomic
     def _move_dir(self, dir, dst):
         if self.isfile(dst):
             raise DirectoryConflictError(dst)
+        src = dir.path
         try:
             # First try moving the directory to the given path. If this fails,
             # it means the given path does not exist, and thus the given path
@@ -390,6 +886,9 @@ class MultiCloudFilesystem(MultiCloudBase):
                 # This is just a rename...
                 dir.name = basename(dst)
                 dir.save(update_fields=['name'])
+                Change.objects.record(self.user, Change.ACTION_MOVE, dir,
+                                      old_path=src)
+                self.dentries.invalidate_all()
                 return dir
             # No, in this case, we were asked to move to a non-existant
             # directory so raise.
@@ -398,25 +897,18 @@ class MultiCloudFilesystem(MultiCloudBase):
             # OK, the parent has been changed, we move it into the requested
             # directory.
             dir.save(update_fields=['parent'])
+            Change.objects.record(self.user, Change.ACTION_MOVE, dir,
+                                  old_path=src)
+            self.dentries.invalidate_all()
         return dir
 
     def move(self, src, dst):
-        # Is it a file?
-        try:
-            file = UserFile.objects.get(path=src, user=self.user)
-            # Move it.
-            return self._move_file(file, dst)
-        except UserFile.DoesNotExist:
-            pass
-        # No, is it a dir?
-        try:
-            dir = UserDir.objects.get(path=src, user=self.user)
-            # Move it.
-            return self._move_dir(dir, dst)
-        except UserDir.DoesNotExist:
-            pass
-        # Neither, raise.
-        raise PathNotFoundError(src)
+        obj = self._lookup(src)
+        if obj is None:
+            raise PathNotFoundError(src)
+        if obj.isfile:
+            return self._move_file(obj, dst)
+        return self._move_dir(obj, dst)
 
     @transaction.atomic
     def _copy_file(self, srcfile, dst):
@@ -434,8 +926,10 @@ class MultiCloudFilesystem(MultiCloudBase):
         # Place the new file into the user's hierarchy.
         dstfile = UserFile.objects.create(path=dst, file=file, user=self.user,
                                           attrs=srcfile.attrs)
+        self.dentries.invalidate(normpath(dst))
         for tag in srcfile.tags.all():
             FileTag.objects.create(file=dstfile, tag=tag)
+        Change.objects.record(self.user, Change.ACTION_CREATE, dstfile)
         return dstfile
 
     @transaction.atomic
@@ -448,46 +942,45 @@ class MultiCloudFilesystem(MultiCloudBase):
         # or the adjusted one if it was a directory.
         if self.exists(dst):
             raise FileConflictError(dst)
-        # Clone srcdir first.
-        dstdir = UserDir.objects.create(path=dst, user=self.user,
-                                        attrs=srcdir.attrs)
-        for tag in srcdir.tags.all():
-            dstdir.tags.add(tag)
-        # Then copy children recursively.
-        for subdir in srcdir.child_dirs.all():
-            self._copy_dir(subdir, dstdir.path)
-        for subfile in srcdir.child_files.all():
-            self._copy_file(subfile, dstdir.path)
+        # Missing parents are created.
+        parent, name = pathsplit(normpath(dst))
+        parent, _ = UserDir.objects.get_or_create(path=parent, user=self.user)
+        # The whole tree is copied using bulk inserts.
+        dstdir = srcdir.clone(parent, name)
+        Change.objects.record(self.user, Change.ACTION_CREATE, dstdir)
+        self.dentries.invalidate_all()
         return dstdir
 
     def copy(self, src, dst):
-        # Is it a file?
-        try:
-            file = UserFile.objects.get(path=src, user=self.user)
-            # Copy it.
-            return self._copy_file(file, dst)
-        except UserFile.DoesNotExist:
-            pass
-        # No, is it a dir?
-        try:
-            dir = UserDir.objects.get(path=src, user=self.user)
-            # Copy it.
-            return self._copy_dir(dir, dst)
-        except UserDir.DoesNotExist:
-            pass
-        # Neither, raise.
-        raise PathNotFoundError('src')
+        obj = self._lookup(src)
+        if obj is None:
+            raise PathNotFoundError('src')
+        if obj.isfile:
+            return self._copy_file(obj, dst)
+        return self._copy_dir(obj, dst)
+
+    @transaction.atomic
+    def tag(self, path, *tags):
+        """
+        Tag the file or directory at path.
+        """
+        obj = self._lookup(path)
+        if obj is None:
+            raise PathNotFoundError(path)
+        for tag in tags:
+            obj.add_tag(tag)
+        Change.objects.record(self.user, Change.ACTION_TAG, obj)
+        return obj
 
     def listdir(self, path, dir=None):
         if dir is None:
-            try:
-                dir = UserDir.objects.get(path=path, user=self.user)
-            except UserDir.DoesNotExist:
+            dir = self._lookup(path)
+            if dir is None or not dir.isdir:
                 raise DirectoryNotFoundError(path)
         return DirectoryListing(
             dir,
-            dir.child_dirs.all(),
-            dir.child_files.all()
+            dir.child_dirs.order_by('name', 'id'),
+            dir.child_files.filter(deleted__isnull=True).order_by('name', 'id')
         )
 
     def info(self, path, file=None, dir=None):
@@ -495,25 +988,19 @@ class MultiCloudFilesystem(MultiCloudBase):
             return file
         if dir is not None:
             return dir
-        try:
-            return UserFile.objects.get(path=path, user=self.user)
-        except UserFile.DoesNotExist:
-            pass
-        try:
-            return UserDir.objects.get(path=path, user=self.user)
-        except UserDir.DoesNotExist:
-            pass
-        raise PathNotFoundError(path)
+        obj = self._lookup(path)
+        if obj is None:
+            raise PathNotFoundError(path)
+        return obj
 
     def isdir(self, path):
-        return UserDir.objects.filter(path=path, user=self.user).exists()
+        return self._stat(path) == DentryCache.DIR
 
     def isfile(self, path):
-        return UserFile.objects.filter(path=path, user=self.user).exists()
+        return self._stat(path) == DentryCache.FILE
 
     def exists(self, path):
-        return self.isdir(path) or \
-               self.isfile(path)
+        return self._stat(path) is not None
 
 
 def get_fs(user, **kwargs):
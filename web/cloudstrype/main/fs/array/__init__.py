@@ -31,11 +31,16 @@ class ArrayClient(object):
         self.storage = storage
         self.user = storage.user
         self.name = storage.attrs['name']
+        self.session = requests.Session()
+        self.session.mount('http://', get_adapter(self.TYPE))
 
-    def request(self, method, path, headers={}, **kwargs):
+    def _url(self, path):
         url = 'http://%s:%s/' % (settings.ARRAY_HOST, settings.ARRAY_PORT)
-        url = pathjoin(url, path)
-        return requests.request(method, url, headers=headers, **kwargs)
+        return pathjoin(url, path)
+
+    def request(self, method, path, headers={}, **kwargs):
+        url = self._url(path)
+        return self.session.request(method, url, headers=headers, **kwargs)
 
     def chunk_request(self, method, chunk, **kwargs):
         path = pathjoin(self.name, chunk.uid)
@@ -58,3 +63,30 @@ class ArrayClient(object):
 
     def stats(self):
         return self.request('GET', '/api/stats/')
+
+
+class AsyncArrayClient(ArrayClient):
+    """
+    Asynchronous (aiohttp) variant of ArrayClient.
+    """
+
+    async def request(self, method, path, headers={}, **kwargs):
+        return await get_session(self.TYPE).request(
+            method, self._url(path), headers=headers, **kwargs)
+
+    async def download(self, chunk, **kwargs):
+        assert isinstance(chunk, Chunk), 'must be chunk instance'
+        return await read(await self.chunk_request('GET', chunk, **kwargs))
+
+    async def upload(self, chunk, data, **kwargs):
+        assert isinstance(chunk, Chunk), 'must be chunk instance'
+        await read(await self.chunk_request('PUT', chunk, data=data,
+                                            **kwargs))
+
+    async def delete(self, chunk, **kwargs):
+        assert isinstance(chunk, Chunk), 'must be chunk instance'
+        await read(await self.chunk_request('DELETE', chunk, **kwargs))
+
+
+from main.fs.clouds.aio import get_session, read  # NOQA
+from main.fs.clouds.base import get_adapter  # NOQA
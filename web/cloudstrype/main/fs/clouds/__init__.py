@@ -1,13 +1,19 @@
 import os
 import logging
+import threading
 
+from collections import OrderedDict
+
+from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 
-from main.fs.clouds.dropbox import DropboxAPIClient
-from main.fs.clouds.onedrive import OnedriveAPIClient
-from main.fs.clouds.box import BoxAPIClient
-from main.fs.clouds.google import GDriveAPIClient
-from main.fs.array import ArrayClient
+from main.fs.clouds.dropbox import DropboxAPIClient, AsyncDropboxAPIClient
+from main.fs.clouds.onedrive import (
+    OnedriveAPIClient, AsyncOnedriveAPIClient,
+)
+from main.fs.clouds.box import BoxAPIClient, AsyncBoxAPIClient
+from main.fs.clouds.google import GDriveAPIClient, AsyncGDriveAPIClient
+from main.fs.array import ArrayClient, AsyncArrayClient
 
 
 LOGGER = logging.getLogger(__name__)
@@ -20,13 +26,23 @@ CLIENTS = (
     ArrayClient,
 )
 
+# Their download(), upload() and delete() are coroutines, see
+# main.fs.clouds.aio.
+ASYNC_CLIENTS = (
+    AsyncDropboxAPIClient,
+    AsyncOnedriveAPIClient,
+    AsyncBoxAPIClient,
+    AsyncGDriveAPIClient,
+    AsyncArrayClient,
+)
 
-def get_client(type, storage=None, **kwargs):
+
+def get_client(type, storage=None, clients=CLIENTS, **kwargs):
     try:
         slug = Storage.TYPE_SLUGS[type]
     except KeyError as e:
         raise ValueError('Invalid type %s' % e.args[0])
-    for item in CLIENTS:
+    for item in clients:
         if getattr(item, 'TYPE', None) == type:
             client_class = item
             break
@@ -42,9 +58,79 @@ def get_client(type, storage=None, **kwargs):
                                    e.args[0])
     if storage:
         kwargs.setdefault('user', storage.user)
-        kwargs.setdefault('token', storage.auth)
+        # A copy, clients outlive the row (see ClientPool).
+        kwargs.setdefault('token', dict(storage.auth or {}))
         kwargs.setdefault('token_callback', storage.auth_update)
     return client_class(client_id, client_secret, storage=storage, **kwargs)
 
 
+def get_async_client(type, storage=None, **kwargs):
+    return get_client(type, storage=storage, clients=ASYNC_CLIENTS, **kwargs)
+
+
+class ClientPool(object):
+    """
+    Process-wide pool of clients, keyed by Storage id.
+
+    Storage rows are loaded afresh all the time (chunk.storages.all() etc.),
+    pooling their clients lets chunk transfers reuse the clients' sessions,
+    and so connections. The least recently used clients are discarded beyond
+    maxsize.
+    """
+
+    def __init__(self, factory, maxsize=None):
+        self.factory = factory
+        self.maxsize = maxsize
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_current(client, storage):
+        """
+        Decide whether a pooled client can serve storage.
+
+        A client is replaced once the storage was re-authorized (or it's
+        token refreshed by another process). A token the client refreshed
+        itself is newer than that of a row loaded earlier, so it is kept.
+        """
+        if client.storage.attrs != storage.attrs:
+            return False
+        token = getattr(client, 'token', None)
+        if token is None:
+            # Not an OAuth2 client.
+            return True
+        auth = storage.auth or {}
+        if token.get('access_token') == auth.get('access_token'):
+            return True
+        return float(token.get('expires_at') or 0) > \
+            float(auth.get('expires_at') or 0)
+
+    def get(self, storage):
+        with self._lock:
+            client = self._clients.get(storage.id)
+            if client is not None and self.is_current(client, storage):
+                self._clients.move_to_end(storage.id)
+                return client
+        client = self.factory(storage.type, storage=storage)
+        with self._lock:
+            self._clients[storage.id] = client
+            self._clients.move_to_end(storage.id)
+            maxsize = self.maxsize or settings.CLOUDSTRYPE_CLIENT_POOL_SIZE
+            while len(self._clients) > maxsize:
+                self._clients.popitem(last=False)
+        return client
+
+    def evict(self, storage_id):
+        with self._lock:
+            self._clients.pop(storage_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._clients.clear()
+
+
+CLIENT_POOL = ClientPool(get_client)
+ASYNC_CLIENT_POOL = ClientPool(get_async_client)
+
+
 from main.models import Storage  # NOQA
@@ -0,0 +1,144 @@
+"""
+Asynchronous cloud clients.
+
+The provider clients are synchronous (requests), so from an event loop (the
+transfer server) they must be called in threads. Each provider module also
+has an asynchronous variant (aiohttp) of it's client, whose download(),
+upload() and delete() are coroutines. Authorization (authorization_url(),
+fetch_token(), initialize() etc.) is rare and remains synchronous, it is
+inherited from the provider's client, along with it's URLs.
+
+Clients of the same provider share a session, and so a pool of connections
+(CLOUDSTRYPE_CLOUD_CONNECTIONS per host) and timeouts.
+"""
+
+import asyncio
+import json
+import logging
+import time
+import weakref
+
+import aiohttp
+
+from django.conf import settings
+
+from main.fs.clouds.base import HTTPError
+from main.models import Chunk
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Sessions are bound to an event loop, {loop: {provider: session}}.
+_SESSIONS = weakref.WeakKeyDictionary()
+
+
+def get_session(provider):
+    """Get the session shared by the clients of provider."""
+    sessions = _SESSIONS.setdefault(asyncio.get_event_loop(), {})
+    session = sessions.get(provider)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit_per_host=settings.CLOUDSTRYPE_CLOUD_CONNECTIONS)
+        timeout = aiohttp.ClientTimeout(
+            total=settings.CLOUDSTRYPE_CLOUD_TIMEOUT)
+        session = sessions[provider] = aiohttp.ClientSession(
+            connector=connector, timeout=timeout)
+    return session
+
+
+async def close_sessions():
+    """Close the sessions of the running event loop (at shutdown)."""
+    for session in _SESSIONS.pop(asyncio.get_event_loop(), {}).values():
+        await session.close()
+
+
+def run_blocking(func, *args):
+    """Call a blocking function (the ORM) in the loop's default executor."""
+    return asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+
+async def read(response):
+    """
+    Read the body of a response.
+
+    Raises HTTPError for an error status.
+    """
+    async with response:
+        body = await response.read()
+    if not 199 < response.status < 300:
+        raise HTTPError(status=response.status,
+                        text=body.decode('utf-8', 'replace'))
+    return body
+
+
+async def read_json(response):
+    return json.loads((await read(response)).decode('utf-8'))
+
+
+class AsyncOAuth2APIClientMixin(object):
+    """
+    Asynchronous chunk I/O for an OAuth2 API client.
+
+    Mixed into (ahead of) a provider's client.
+    """
+
+    def _token_expired(self):
+        expires_at = self.token.get('expires_at')
+        return expires_at is not None and float(expires_at) < time.time()
+
+    async def refresh_token(self):
+        """Obtain a new access token using the refresh token."""
+        if not self.REFRESH_TOKEN_URL or 'refresh_token' not in self.token:
+            raise HTTPError(status=401, text='Token can not be refreshed')
+        token = await read_json(await get_session(self.TYPE).post(
+            self.REFRESH_TOKEN_URL, data={
+                'grant_type': 'refresh_token',
+                'refresh_token': self.token['refresh_token'],
+                'client_id': self.client_id,
+                'client_secret': self.client_secret,
+            }))
+        if 'expires_in' in token:
+            token['expires_at'] = time.time() + int(token['expires_in'])
+        # The callback saves the token.
+        await run_blocking(self._update_token, token)
+
+    async def request(self, method, url, chunk, headers={}, **kwargs):
+        """
+        Perform HTTP request with OAuth.
+
+        The access token is refreshed (once) if it has expired, or is refused.
+        The caller must read (or release) the response.
+        """
+        tried_refresh = False
+        if self._token_expired():
+            LOGGER.warning('Refreshing access token')
+            await self.refresh_token()
+            tried_refresh = True
+        while True:
+            headers = dict(headers, Authorization='Bearer %s' %
+                           self.token['access_token'])
+            r = await get_session(self.TYPE).request(
+                method, url, headers=headers, **kwargs)
+            if r.status != 401 or tried_refresh or \
+               not self.REFRESH_TOKEN_URL:
+                return r
+            r.release()
+            LOGGER.warning('Refreshing access token')
+            await self.refresh_token()
+            tried_refresh = True
+
+    async def download(self, chunk, **kwargs):
+        assert isinstance(chunk, Chunk), 'must be chunk instance'
+        return await read(await self.request(
+            self.DOWNLOAD_URL[0], self.DOWNLOAD_URL[1], chunk, **kwargs))
+
+    async def upload(self, chunk, data, **kwargs):
+        assert isinstance(chunk, Chunk), 'must be chunk instance'
+        await read(await self.request(
+            self.UPLOAD_URL[0], self.UPLOAD_URL[1], chunk, data=data,
+            **kwargs))
+
+    async def delete(self, chunk, **kwargs):
+        assert isinstance(chunk, Chunk), 'must be chunk instance'
+        await read(await self.request(
+            self.DELETE_URL[0], self.DELETE_URL[1], chunk, **kwargs))
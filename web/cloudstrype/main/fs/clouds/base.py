@@ -1,18 +1,41 @@
 import logging
 
+from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth2Session
 from oauthlib.oauth2 import TokenExpiredError
 
+from django.conf import settings
+
 from main.models import Chunk
 
 
 LOGGER = logging.getLogger(__name__)
 
+# {provider: adapter}
+_ADAPTERS = {}
+
+
+def get_adapter(provider):
+    """
+    Get the transport adapter shared by the clients of provider.
+
+    The adapter holds the connection pools, so chunk transfers (of any of the
+    provider's storages) reuse warm connections.
+    """
+    adapter = _ADAPTERS.get(provider)
+    if adapter is None:
+        adapter = _ADAPTERS.setdefault(provider, HTTPAdapter(
+            pool_maxsize=settings.CLOUDSTRYPE_CLOUD_CONNECTIONS))
+    return adapter
+
 
 class HTTPError(Exception):
-    def __init__(self, response):
-        message = '%s: %s' % (response.status_code, response.text)
-        super().__init__(message)
+    def __init__(self, response=None, status=None, text=None):
+        # The asynchronous clients pass the status and body they have read.
+        if response is not None:
+            status, text = response.status_code, response.text
+        self.status = status
+        super().__init__('%s: %s' % (status, text))
 
 
 class BaseOAuth2APIClient(object):
@@ -20,6 +43,7 @@ class BaseOAuth2APIClient(object):
     OAuth API client base class.
     """
 
+    TYPE = None
     SCOPES = []
     PROFILE_FIELDS = {
         'uid': 'uid',
@@ -57,6 +81,7 @@ class BaseOAuth2APIClient(object):
             self.oauthsession = OAuth2Session(
                 self.client_id, redirect_uri=redirect_uri,
                 scope=self.SCOPES, **kwargs)
+        self.oauthsession.mount('https://', get_adapter(self.TYPE))
 
     def _update_token(self, token):
         """
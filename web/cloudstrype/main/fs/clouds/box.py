@@ -3,6 +3,11 @@ import logging
 
 from io import BytesIO
 
+import aiohttp
+
+from main.fs.clouds.aio import (
+    AsyncOAuth2APIClientMixin, read, read_json, run_blocking,
+)
 from main.fs.clouds.base import BaseOAuth2APIClient, HTTPError
 from main.models import Chunk, Storage
 
@@ -50,13 +55,32 @@ class BoxAPIClient(BaseOAuth2APIClient):
 
     CREATE_URL = 'https://api.box.com/2.0/folders'
 
+    def _file_id(self, chunk):
+        "The file_id Box assigned to chunk (see upload())."
+        chunk_storage = chunk.storages.get(
+            storage__type=self.TYPE)
+        return chunk_storage.attrs['file.id']
+
+    def _file_attrs(self, attrs):
+        """
+        Extract the attributes of an uploaded chunk from Box's response.
+
+        Stored into the attribute store of ChunkStorage.
+        """
+        try:
+            return {'file.id': attrs['entries'][0]['id']}
+        except KeyError as e:
+            LOGGER.error('key "%s" not in response "%s"', e.args[0], attrs)
+            raise
+        except IndexError:
+            LOGGER.error('result was empty "%s"', attrs)
+            raise
+
     def download(self, chunk, **kwargs):
         "Overidden to add file_id to URL."
         assert isinstance(chunk, Chunk), 'must be chunk instance'
-        chunk_storage = chunk.storages.get(
-            storage__type=self.TYPE)
         method, url = self.DOWNLOAD_URL
-        url = url.format(file_id=chunk_storage.attrs['file.id'])
+        url = url.format(file_id=self._file_id(chunk))
         r = self.request(method, url, chunk, **kwargs)
         return r.content
 
@@ -89,25 +113,13 @@ class BoxAPIClient(BaseOAuth2APIClient):
                 raise HTTPError(response=r)
             else:
                 break
-        attrs = r.json()
-        # Store the file_id provided by Box into the attribute store of
-        # ChunkStorage
-        try:
-            return {'file.id': attrs['entries'][0]['id']}
-        except KeyError as e:
-            LOGGER.error('key "%s" not in response "%s"', e.args[0], attrs)
-            raise
-        except IndexError as e:
-            LOGGER.error('result was empty "%s"', attrs)
-            raise
+        return self._file_attrs(r.json())
 
     def delete(self, chunk, **kwargs):
         "Overidden to add file_id to URL."
         assert isinstance(chunk, Chunk), 'must be chunk instance'
-        chunk_storage = chunk.storages.get(
-            storage__type=self.TYPE)
         method, url = self.DELETE_URL
-        url = url.format(file_id=chunk_storage.attrs['file.id'])
+        url = url.format(file_id=self._file_id(chunk))
         r = self.request(method, url, chunk, **kwargs)
         r.close()
 
@@ -146,3 +158,51 @@ class BoxAPIClient(BaseOAuth2APIClient):
                 parent_id = r.json()['id']
         storage.attrs = storage.attrs or {}
         storage.attrs.update({'root.id': parent_id})
+
+
+class AsyncBoxAPIClient(AsyncOAuth2APIClientMixin, BoxAPIClient):
+    """
+    Asynchronous (aiohttp) variant of BoxAPIClient.
+    """
+
+    async def download(self, chunk, **kwargs):
+        "Overidden to add file_id to URL."
+        assert isinstance(chunk, Chunk), 'must be chunk instance'
+        method, url = self.DOWNLOAD_URL
+        url = url.format(file_id=await run_blocking(self._file_id, chunk))
+        return await read(await self.request(method, url, chunk, **kwargs))
+
+    async def upload(self, chunk, data, **kwargs):
+        "Overidden to upload a form, replacing a conflicting file."
+        assert isinstance(chunk, Chunk), 'must be chunk instance'
+        parent_id = self.storage.attrs['root.id']
+        tried_delete = False
+        while True:
+            # A form can only be sent once.
+            form = aiohttp.FormData()
+            form.add_field('attributes', json.dumps({
+                'name': chunk.uid, 'parent': {'id': parent_id}
+            }))
+            form.add_field('file', data, filename=chunk.uid,
+                           content_type='text/plain')
+            r = await self.request(self.UPLOAD_URL[0], self.UPLOAD_URL[1],
+                                   chunk, data=form, **kwargs)
+            if not tried_delete and r.status == 409:
+                # As BoxAPIClient.upload(), delete the conflicting file and
+                # try (once) again.
+                async with r:
+                    conflict = json.loads((await r.read()).decode('utf-8'))
+                method, url = self.DELETE_URL
+                url = url.format(
+                    file_id=conflict['context_info']['conflicts']['id'])
+                await read(await self.request(method, url, chunk))
+                tried_delete = True
+                continue
+            return self._file_attrs(await read_json(r))
+
+    async def delete(self, chunk, **kwargs):
+        "Overidden to add file_id to URL."
+        assert isinstance(chunk, Chunk), 'must be chunk instance'
+        method, url = self.DELETE_URL
+        url = url.format(file_id=await run_blocking(self._file_id, chunk))
+        await read(await self.request(method, url, chunk, **kwargs))
@@ -2,6 +2,7 @@ import json
 import logging
 
 from main.fs import Chunk
+from main.fs.clouds.aio import AsyncOAuth2APIClientMixin
 from main.fs.clouds.base import BaseOAuth2APIClient
 from main.models import Storage
 
@@ -43,11 +44,14 @@ class DropboxAPIClient(BaseOAuth2APIClient):
     UPLOAD_URL = ('post', 'https://content.dropboxapi.com/2/files/upload')
     DELETE_URL = ('post', 'https://api.dropboxapi.com/2/files/delete')
 
-    def request(self, method, url, chunk, headers={}, **kwargs):
-        headers['Dropbox-API-Arg'] = json.dumps({
+    def _api_arg(self, chunk):
+        return json.dumps({
             'path': '/.cloudstrype/%s/%s' % (self.user.uid,
                                              chunk.uid),
         })
+
+    def request(self, method, url, chunk, headers={}, **kwargs):
+        headers['Dropbox-API-Arg'] = self._api_arg(chunk)
         return super().request(method, url, chunk, headers=headers, **kwargs)
 
     def upload(self, chunk, data, headers={}, **kwargs):
@@ -61,3 +65,26 @@ class DropboxAPIClient(BaseOAuth2APIClient):
         }
         super().delete(chunk, headers=headers,
                        data=json.dumps({'path': '/%s' % chunk.uid}), **kwargs)
+
+
+class AsyncDropboxAPIClient(AsyncOAuth2APIClientMixin, DropboxAPIClient):
+    """
+    Asynchronous (aiohttp) variant of DropboxAPIClient.
+    """
+
+    async def request(self, method, url, chunk, headers={}, **kwargs):
+        headers = dict(headers, **{'Dropbox-API-Arg': self._api_arg(chunk)})
+        return await super().request(method, url, chunk, headers=headers,
+                                     **kwargs)
+
+    async def upload(self, chunk, data, headers={}, **kwargs):
+        headers = dict(headers, **{'Content-Type': 'application/octet-stream'})
+        return await super().upload(chunk, data, headers=headers, **kwargs)
+
+    async def delete(self, chunk, **kwargs):
+        headers = {
+            'Content-Type': 'application/json'
+        }
+        await super().delete(chunk, headers=headers,
+                             data=json.dumps({'path': '/%s' % chunk.uid}),
+                             **kwargs)
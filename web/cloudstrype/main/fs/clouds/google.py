@@ -6,6 +6,9 @@ from base64 import b64encode
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 
+from main.fs.clouds.aio import (
+    AsyncOAuth2APIClientMixin, read, read_json, run_blocking,
+)
 from main.fs.clouds.base import BaseOAuth2APIClient, HTTPError
 from main.models import Chunk, Storage
 
@@ -49,34 +52,30 @@ class GDriveAPIClient(BaseOAuth2APIClient):
 
     CREATE_URL = 'https://www.googleapis.com/drive/v2/files'
 
-    def download(self, chunk, **kwargs):
-        "Overidden to add file_id to URL."
-        assert isinstance(chunk, Chunk), 'must be chunk instance'
+    def _file_id(self, chunk):
+        "The file ID Google assigned to chunk (see upload())."
         chunk_storage = chunk.storages.get(
             storage__type=self.TYPE)
-        method, url = self.DOWNLOAD_URL
-        url = url.format(file_id=chunk_storage.attrs['file.id'])
-        r = self.request(method, url, chunk, **kwargs)
-        if not 199 < r.status_code < 300:
-            raise HTTPError(response=r)
-        return r.content
+        return chunk_storage.attrs['file.id']
 
-    def upload(self, chunk, data, **kwargs):
+    def _file_attrs(self, attrs):
         """
-        Overridden to perform uploads.
+        Extract the attributes of an uploaded chunk from Google's response.
 
-        Google is the most problematic of the clouds. Their API is pretty
-        horrible to work with for the following reasons:
-
-        They are _very_ particular in the formatting of requests, and they
-        require atypical formatting, so not fun.
+        Stored into the attribute store of ChunkStorage.
+        """
+        try:
+            return {'file.id': attrs['id']}
+        except KeyError:
+            LOGGER.error('key "id" not in response "%s"', attrs)
+            raise
 
-        Something that works one day will stop working the next. In particular
-        what MIME types they accept. In fact most of my problems have been
-        related to MIME types.
+    def _multipart(self, chunk, data):
         """
-        assert isinstance(chunk, Chunk), 'must be chunk instance'
+        Build the body of an upload.
 
+        Returns (body, headers).
+        """
         try:
             parent_id = self.storage.attrs.get('root.id')
         except ValueError:
@@ -103,7 +102,34 @@ class GDriveAPIClient(BaseOAuth2APIClient):
         # Get the body, discarding the headers, then get the headers as a dict
         # allowing requests to handle the headers.
         body = related.as_bytes().split(b'\n\n', 1)[1]
-        headers = dict(related.items())
+        return body, dict(related.items())
+
+    def download(self, chunk, **kwargs):
+        "Overidden to add file_id to URL."
+        assert isinstance(chunk, Chunk), 'must be chunk instance'
+        method, url = self.DOWNLOAD_URL
+        url = url.format(file_id=self._file_id(chunk))
+        r = self.request(method, url, chunk, **kwargs)
+        if not 199 < r.status_code < 300:
+            raise HTTPError(response=r)
+        return r.content
+
+    def upload(self, chunk, data, **kwargs):
+        """
+        Overridden to perform uploads.
+
+        Google is the most problematic of the clouds. Their API is pretty
+        horrible to work with for the following reasons:
+
+        They are _very_ particular in the formatting of requests, and they
+        require atypical formatting, so not fun.
+
+        Something that works one day will stop working the next. In particular
+        what MIME types they accept. In fact most of my problems have been
+        related to MIME types.
+        """
+        assert isinstance(chunk, Chunk), 'must be chunk instance'
+        body, headers = self._multipart(chunk, data)
 
         method, url = self.UPLOAD_URL
         url += '?uploadType=multipart'
@@ -112,14 +138,7 @@ class GDriveAPIClient(BaseOAuth2APIClient):
 
         if not 199 < r.status_code < 300:
             raise HTTPError(response=r)
-        attrs = r.json()
-        # Store the file ID provided by Google into the attribute store of
-        # ChunkStorage
-        try:
-            return {'file.id': attrs['id']}
-        except KeyError as e:
-            LOGGER.error('key "id" not in response "%s"', attrs)
-            raise
+        return self._file_attrs(r.json())
 
     def delete(self, chunk, **kwargs):
         """
@@ -130,10 +149,8 @@ class GDriveAPIClient(BaseOAuth2APIClient):
         discovering it's ID from it's path.
         """
         assert isinstance(chunk, Chunk), 'must be chunk instance'
-        chunk_storage = chunk.storages.get(
-            storage__type=self.TYPE)
         method, url = self.DELETE_URL
-        url = url.format(file_id=chunk_storage.attrs['file.id'])
+        url = url.format(file_id=self._file_id(chunk))
         r = self.request(method, url, chunk, **kwargs)
         r.close()
 
@@ -207,3 +224,32 @@ class GDriveAPIClient(BaseOAuth2APIClient):
             parent_id = r.json()['id']
         storage.attrs = storage.attrs or {}
         storage.attrs.update({'root.id': parent_id})
+
+
+class AsyncGDriveAPIClient(AsyncOAuth2APIClientMixin, GDriveAPIClient):
+    """
+    Asynchronous (aiohttp) variant of GDriveAPIClient.
+    """
+
+    async def download(self, chunk, **kwargs):
+        "Overidden to add file_id to URL."
+        assert isinstance(chunk, Chunk), 'must be chunk instance'
+        method, url = self.DOWNLOAD_URL
+        url = url.format(file_id=await run_blocking(self._file_id, chunk))
+        return await read(await self.request(method, url, chunk, **kwargs))
+
+    async def upload(self, chunk, data, **kwargs):
+        "Overridden to upload multipart/related, see GDriveAPIClient."
+        assert isinstance(chunk, Chunk), 'must be chunk instance'
+        body, headers = self._multipart(chunk, data)
+        method, url = self.UPLOAD_URL
+        url += '?uploadType=multipart'
+        return self._file_attrs(await read_json(await self.request(
+            method, url, chunk, data=body, headers=headers, **kwargs)))
+
+    async def delete(self, chunk, **kwargs):
+        "Overidden to add file_id to URL."
+        assert isinstance(chunk, Chunk), 'must be chunk instance'
+        method, url = self.DELETE_URL
+        url = url.format(file_id=await run_blocking(self._file_id, chunk))
+        await read(await self.request(method, url, chunk, **kwargs))
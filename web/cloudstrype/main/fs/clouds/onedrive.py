@@ -1,5 +1,6 @@
 import logging
 
+from main.fs.clouds.aio import AsyncOAuth2APIClientMixin
 from main.fs.clouds.base import BaseOAuth2APIClient
 from main.models import Storage
 
@@ -45,8 +46,22 @@ class OnedriveAPIClient(BaseOAuth2APIClient):
     DELETE_URL = \
         ('delete', 'https://api.onedrive.com/v1.0/drive/root:/{path}')
 
-    def request(self, method, url, chunk, headers={}, **kwargs):
-        url = url.format(
+    def _format_url(self, url, chunk):
+        return url.format(
             path='.cloudstrype/%s/%s' % (self.user.uid,
                                          chunk.uid))
+
+    def request(self, method, url, chunk, headers={}, **kwargs):
+        url = self._format_url(url, chunk)
         return super().request(method, url, chunk, headers=headers, **kwargs)
+
+
+class AsyncOnedriveAPIClient(AsyncOAuth2APIClientMixin, OnedriveAPIClient):
+    """
+    Asynchronous (aiohttp) variant of OnedriveAPIClient.
+    """
+
+    async def request(self, method, url, chunk, headers={}, **kwargs):
+        url = self._format_url(url, chunk)
+        return await super().request(method, url, chunk, headers=headers,
+                                     **kwargs)
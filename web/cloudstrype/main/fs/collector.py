@@ -0,0 +1,249 @@
+"""
+Chunk garbage collector.
+
+Deleting a file only marks it deleted, its chunks remain stored with the cloud
+providers. The collector reclaims chunks that no version refers to, using the
+reference count maintained on each chunk.
+
+Collection happens in two phases:
+
+ 1 mark() purges files that have been deleted for the grace period and
+   expired upload sessions (releasing their versions' references) and marks
+   unreferenced chunks.
+ 2 sweep() deletes chunks that have been marked for the grace period. Each
+   batch is locked and rechecked before deletion, chunks referenced again
+   are unmarked and kept. The grace gives chunks being written (not yet
+   referenced) time to be referenced. Chunks are
+   deleted from the providers in parallel, rate limited per storage. Failed
+   provider deletes are retried by the next sweep.
+
+reconcile() verifies the reference counts in batches and repairs any drift.
+It resumes where the previous call stopped, so large tables are covered over
+several runs.
+"""
+
+import logging
+import threading
+import time
+
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache as default_cache
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from main.models import (
+    Chunk, ChunkStorage, File, VersionChunk, UploadSession,
+)
+
+
+LOGGER = logging.getLogger(__name__)
+CHUNK_CACHE = caches['chunks']
+
+
+class RateLimiter(object):
+    """
+    Limit calls to rate per second.
+
+    Shared by threads, each call to wait() blocks until the caller may
+    proceed.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ChunkCollector(object):
+    """
+    Reclaim unreferenced chunks.
+    """
+
+    CURSOR_KEY = 'gc:reconcile'
+
+    def __init__(self, grace=None, batch_size=None, workers=None, rate=None,
+                 cache=None):
+        if grace is None:
+            grace = settings.CLOUDSTRYPE_GC_GRACE
+        self.grace = timedelta(seconds=grace)
+        self.batch_size = batch_size or settings.CLOUDSTRYPE_GC_BATCH_SIZE
+        self.workers = workers or settings.CLOUDSTRYPE_GC_WORKERS
+        self.rate = settings.CLOUDSTRYPE_GC_RATE if rate is None else rate
+        self.cache = cache or default_cache
+        self.limiters = {}
+
+    def mark(self, limit=None):
+        """
+        Purge expired files (and upload sessions) and mark unreferenced chunks.
+
+        Purges at most limit files and marks at most limit chunks (all of them
+        if None). Returns the number of chunks marked.
+        """
+        deadline = timezone.now() - self.grace
+        purged = 0
+        while limit is None or purged < limit:
+            size = self.batch_size
+            if limit is not None:
+                size = min(size, limit - purged)
+            ids = File.objects.dead(deadline).order_by('id') \
+                .values_list('id', flat=True)[:size]
+            count = File.objects.filter(id__in=list(ids)).purge()
+            if not count:
+                break
+            purged += count
+
+        # Abandoned uploads.
+        expired = UploadSession.objects.expired().order_by('id')
+        if limit is not None:
+            expired = UploadSession.objects.filter(
+                id__in=list(expired.values_list('id', flat=True)[:limit]))
+        sessions = expired.purge()
+
+        chunks = Chunk.objects.unreferenced().filter(gc_marked__isnull=True)
+        if limit is not None:
+            chunks = Chunk.objects.filter(
+                id__in=list(chunks.values_list('id', flat=True)[:limit]))
+        marked = chunks.update(gc_marked=timezone.now())
+        LOGGER.info('Purged %s files and %s upload sessions, marked %s chunks',
+                    purged, sessions, marked)
+        return marked
+
+    def sweep(self, limit=None):
+        """
+        Delete chunks marked for the grace period.
+
+        Deletes at most limit chunks (all such chunks if None). Returns the
+        number of chunks deleted.
+        """
+        deadline = timezone.now() - self.grace
+        cursor, deleted = 0, 0
+        while limit is None or deleted < limit:
+            with transaction.atomic():
+                # Lock the batch, so concurrent sweeps skip it, and references
+                # can not be added until the batch is done.
+                chunks = list(
+                    Chunk.objects
+                    .filter(id__gt=cursor, gc_marked__lte=deadline)
+                    .order_by('id').select_for_update(skip_locked=True)
+                    [:self.batch_size])
+                if not chunks:
+                    break
+                cursor = chunks[-1].id
+                ids = [chunk.id for chunk in chunks]
+                # Never trust a count of zero if references exist, those are
+                # repaired by reconcile().
+                dead = set(
+                    Chunk.objects.filter(id__in=ids).unreferenced()
+                    .filter(filechunks__isnull=True)
+                    .values_list('id', flat=True))
+                Chunk.objects.filter(id__in=set(ids) - dead) \
+                    .update(gc_marked=None)
+                deleted += self._delete([c for c in chunks if c.id in dead])
+        LOGGER.info('Deleted %s chunks', deleted)
+        return deleted
+
+    def reconcile(self, limit=None):
+        """
+        Repair reference counts that do not match the references.
+
+        Checks at most limit chunks (all of them if None), starting after the
+        last chunk checked by the previous call. Returns the number of chunks
+        repaired.
+        """
+        cursor = self.cache.get(self.CURSOR_KEY, 0)
+        checked, repaired = 0, 0
+        while limit is None or checked < limit:
+            size = self.batch_size
+            if limit is not None:
+                size = min(size, limit - checked)
+            with transaction.atomic():
+                # Locked so references are not added while counting.
+                chunks = dict(
+                    Chunk.objects.filter(id__gt=cursor).order_by('id')
+                    .select_for_update().values_list('id', 'refcount')[:size])
+                if not chunks:
+                    # Reached the end, the next call starts over.
+                    cursor = 0
+                    break
+                refs = dict.fromkeys(chunks, 0)
+                refs.update(
+                    VersionChunk.objects.filter(chunk_id__in=chunks)
+                    .order_by().values_list('chunk_id')
+                    .annotate(Count('id')))
+                for chunk_id, refcount in refs.items():
+                    if refcount == chunks[chunk_id]:
+                        continue
+                    LOGGER.warning('Chunk %s refcount %s, should be %s',
+                                   chunk_id, chunks[chunk_id], refcount)
+                    Chunk.objects.filter(id=chunk_id) \
+                        .update(refcount=refcount)
+                    repaired += 1
+            cursor, checked = max(chunks), checked + len(chunks)
+            self.cache.set(self.CURSOR_KEY, cursor, None)
+        self.cache.set(self.CURSOR_KEY, cursor, None)
+        LOGGER.info('Repaired %s of %s chunks checked', repaired, checked)
+        return repaired
+
+    def collect(self, limit=None):
+        """
+        Run both phases, returns (marked, deleted).
+        """
+        return self.mark(limit=limit), self.sweep(limit=limit)
+
+    def _limiter(self, storage):
+        try:
+            return self.limiters[storage.id]
+        except KeyError:
+            return self.limiters.setdefault(storage.id,
+                                            RateLimiter(self.rate))
+
+    def _delete_replica(self, chunk_storage):
+        self._limiter(chunk_storage.storage).wait()
+        try:
+            chunk_storage.storage.get_client().delete(chunk_storage.chunk)
+        except Exception as e:
+            LOGGER.warning('Could not delete %s: %s', chunk_storage, e)
+            return False
+        return True
+
+    def _delete(self, chunks):
+        """
+        Delete chunks from the providers and then the database.
+
+        Chunks with a replica that could not be deleted are kept (minus the
+        deleted replicas), returns the number of chunks deleted.
+        """
+        if not chunks:
+            return 0
+        replicas = list(
+            ChunkStorage.objects.filter(chunk__in=chunks)
+            .select_related('chunk', 'storage'))
+        with ThreadPoolExecutor(self.workers) as executor:
+            results = list(executor.map(self._delete_replica, replicas))
+
+        failed = set()
+        for replica, ok in zip(replicas, results):
+            if not ok:
+                failed.add(replica.chunk_id)
+        ChunkStorage.objects.filter(
+            id__in=[r.id for r, ok in zip(replicas, results) if ok]).delete()
+
+        ids = [chunk.id for chunk in chunks if chunk.id not in failed]
+        Chunk.objects.filter(id__in=ids).delete()
+        CHUNK_CACHE.delete_many(
+            ['chunk:%s' % chunk.uid for chunk in chunks
+             if chunk.id not in failed])
+        return len(ids)
@@ -0,0 +1,92 @@
+"""
+Pack compaction.
+
+The data of small files is packed into shared chunks (see PackWriter). As
+those files are deleted (or their versions pruned) their ranges of a pack
+become garbage, yet the whole pack is kept as long as any range of it is
+referenced.
+
+The compactor rewrites packs whose live data is less than
+CLOUDSTRYPE_PACK_COMPACT_RATIO of their size. The live ranges are copied into
+new packs and their references moved, the old pack is then unreferenced and
+reclaimed by the garbage collector.
+"""
+
+import itertools
+import logging
+
+from django.conf import settings
+from django.db.models import F, Sum
+
+from main.fs import PackWriter
+from main.models import Chunk, VersionChunk
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Repacker(PackWriter):
+    """
+    Packs ranges of existing packs (VersionChunk rows) into a new pack.
+    """
+
+    def repack(self, pack):
+        """Add the live ranges of pack."""
+        data = self._fetch_chunk(pack)
+        for row in pack.filechunks.order_by('offset'):
+            self.add(row, data[row.offset:row.offset + row.length])
+
+    def _place(self, row, chunk, offset, data):
+        # The version may have been deleted (or it's range moved) meanwhile.
+        moved = VersionChunk.objects.filter(
+            id=row.id, chunk_id=row.chunk_id, offset=row.offset) \
+            .update(chunk=chunk, offset=offset)
+        if moved:
+            Chunk.objects.filter(id=chunk.id) \
+                .update(refcount=F('refcount') + 1, gc_marked=None)
+            Chunk.objects.filter(id=row.chunk_id) \
+                .update(refcount=F('refcount') - 1)
+
+
+class PackCompactor(object):
+    """
+    Rewrite sparse packs.
+    """
+
+    def __init__(self, ratio=None):
+        if ratio is None:
+            ratio = settings.CLOUDSTRYPE_PACK_COMPACT_RATIO
+        self.ratio = ratio
+
+    def sparse(self):
+        """
+        Select the packs whose live data is less than ratio of their size.
+        """
+        return Chunk.objects.filter(filechunks__offset__isnull=False) \
+            .annotate(live=Sum('filechunks__length')) \
+            .filter(live__lt=F('size') * self.ratio)
+
+    def compact(self, limit=None):
+        """
+        Rewrite at most limit sparse packs (all of them if None).
+
+        Returns the number of packs rewritten.
+        """
+        packs = self.sparse().select_related('key__user') \
+            .order_by('key__user_id', 'id')
+        if limit is not None:
+            packs = packs[:limit]
+        compacted = 0
+        for user, group in itertools.groupby(packs, lambda c: c.key.user):
+            with Repacker(user) as writer:
+                for pack in group:
+                    try:
+                        writer.repack(pack)
+                    except IOError as e:
+                        LOGGER.warning('Could not read pack %s: %s', pack, e)
+                        continue
+                    compacted += 1
+            if writer.failed:
+                LOGGER.warning('Could not move %s ranges', len(writer.failed))
+        LOGGER.info('Compacted %s packs', compacted)
+        return compacted
@@ -35,3 +35,7 @@ class DirectoryConflictError(PathError):
 class FileConflictError(PathError):
     def __init__(self, path):
         super().__init__('path "%s" exists as file', path)
+
+
+class IncompleteUploadError(BaseError):
+    pass
@@ -13,6 +13,16 @@ def chunker(f, chunk_size=settings.CLOUDSTRYPE_CHUNK_SIZE):
         chunk = f.read(chunk_size)
         if not chunk:
             return
+        # Streams (such as a request body) may return less than asked for.
+        parts, size = [chunk], len(chunk)
+        while size < chunk_size:
+            more = f.read(chunk_size - size)
+            if not more:
+                break
+            parts.append(more)
+            size += len(more)
+        if len(parts) > 1:
+            chunk = b''.join(parts)
         assert len(chunk) <= chunk_size, 'chunk exceeds %s' % chunk_size
         yield chunk
 
@@ -0,0 +1,122 @@
+"""
+Transfer hand off.
+
+Transfers take as long as the clouds do, so rather than tying up a uWSGI
+worker for the duration of each, the application only authorizes a transfer
+and hands it to the transfer server (the `transfer` management command)
+through nginx:
+
+ 1 The application validates the request and responds with an
+   X-Accel-Redirect to CLOUDSTRYPE_TRANSFER_LOCATION, the path ending in a
+   signed token describing the transfer.
+ 2 nginx makes the request to the transfer server (the location is internal,
+   so clients can not).
+ 3 The transfer server verifies the token and performs the transfer, it's
+   response is sent to the client.
+
+Uploads are spooled to disk by the nginx upload module before reaching the
+application, the token names the temporary file. Tokens are short lived, nginx
+follows the redirect immediately.
+"""
+
+import os
+
+from django.conf import settings
+from django.core import signing
+from django.http import HttpResponse
+
+from django_transfer import ProxyUploadedFile
+
+from main.fs import get_fs
+from main.models import User, UserFile, Version
+
+
+ACTION_DOWNLOAD = 'download'
+ACTION_UPLOAD = 'upload'
+
+SALT = 'main.fs.transfer'
+
+
+def is_enabled():
+    return settings.CLOUDSTRYPE_TRANSFER_LOCATION is not None
+
+
+def is_spooled(f):
+    """
+    Determine whether an uploaded file was spooled to disk by nginx.
+
+    Raises ValueError for a path outside of CLOUDSTRYPE_TRANSFER_UPLOAD_DIR,
+    the path is a form field, so it could have been given by the client.
+    """
+    if not isinstance(f, ProxyUploadedFile):
+        return False
+    root = os.path.realpath(settings.CLOUDSTRYPE_TRANSFER_UPLOAD_DIR)
+    if os.path.commonpath([root, os.path.realpath(f.path)]) != root:
+        raise ValueError('Invalid upload path %s' % f.path)
+    return True
+
+
+def sign(action, user, **kwargs):
+    """Produce a token authorizing user to perform a transfer."""
+    return signing.dumps(dict(kwargs, action=action, user=user.id),
+                         salt=SALT, compress=True)
+
+
+def unsign(token):
+    """
+    Verify a token produced by sign().
+
+    Raises signing.BadSignature if the token is invalid (or expired).
+    """
+    return signing.loads(token, salt=SALT,
+                         max_age=settings.CLOUDSTRYPE_TRANSFER_TOKEN_TTL)
+
+
+def handoff(action, user, **kwargs):
+    """
+    Hand a transfer off to the transfer server.
+
+    Returns the response redirecting nginx to it.
+    """
+    response = HttpResponse()
+    response['X-Accel-Redirect'] = '%s%s' % (
+        settings.CLOUDSTRYPE_TRANSFER_LOCATION, sign(action, user, **kwargs))
+    return response
+
+
+class Transfer(object):
+    """
+    A transfer authorized by a token.
+
+    Performed (in a thread) by the transfer server.
+    """
+
+    def __init__(self, token):
+        self.claims = unsign(token)
+        self.action = self.claims['action']
+        self.user = User.objects.get(id=self.claims['user'])
+
+    def download(self):
+        """
+        Open the file version to send.
+
+        Returns (user_file, version, reader).
+        """
+        user_file = UserFile.objects.get(id=self.claims['file'],
+                                         user=self.user)
+        version = Version.objects.get(id=self.claims['version'])
+        reader = get_fs(self.user).download(user_file.path, file=user_file,
+                                            version=version)
+        return user_file, version, reader
+
+    def upload(self):
+        """
+        Upload the spooled file, which is then removed.
+
+        Returns the UserFile.
+        """
+        try:
+            with open(self.claims['temp'], 'rb') as f:
+                return get_fs(self.user).upload(self.claims['path'], f)
+        finally:
+            os.remove(self.claims['temp'])
@@ -0,0 +1,25 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from main.fs.compactor import PackCompactor
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+
+class Command(BaseCommand):
+    help = """Compact packs.
+
+    Rewrites packs (chunks shared by small files) that are mostly unused, so
+    that the garbage collector can reclaim them."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=None,
+                            help='Rewrite at most this many packs')
+        parser.add_argument('--ratio', type=float, default=None,
+                            help='Rewrite packs with less live data than this')
+
+    def handle(self, *args, **options):
+        PackCompactor(ratio=options['ratio']).compact(limit=options['limit'])
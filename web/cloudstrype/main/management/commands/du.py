@@ -0,0 +1,28 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from main.models import User, UserDir
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+
+class Command(BaseCommand):
+    help = """Rebuild directory totals.
+
+    Recalculates the recursive size, file and directory counts of each
+    directory, repairing the totals kept as the tree changes."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Only rebuild this user (email).')
+
+    def handle(self, *args, **options):
+        users = User.objects.all().order_by('id')
+        if options['user']:
+            users = users.filter(email=options['user'])
+        repaired = 0
+        for user in users.iterator():
+            repaired += UserDir.objects.rebuild_usage(user)
+        LOGGER.info('Repaired %s directories', repaired)
@@ -0,0 +1,42 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from main.fs.collector import ChunkCollector
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+
+class Command(BaseCommand):
+    help = """Collect garbage.
+
+    Purges files deleted for the grace period, then deletes chunks no longer
+    referenced by any version from storage. With --reconcile, repairs chunk
+    reference counts instead."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=None,
+                            help='Process at most this many files or chunks')
+        parser.add_argument('--grace', type=int, default=None,
+                            help='Grace period in seconds')
+        parser.add_argument('--no-mark', action='store_true',
+                            help='Only delete previously marked chunks')
+        parser.add_argument('--no-sweep', action='store_true',
+                            help='Only mark unreferenced chunks')
+        parser.add_argument('--reconcile', action='store_true',
+                            help='Repair chunk reference counts')
+
+    def handle(self, *args, **options):
+        collector = ChunkCollector(grace=options['grace'])
+        if options['reconcile']:
+            repaired = collector.reconcile(limit=options['limit'])
+            LOGGER.info('Repaired %s chunks', repaired)
+            return
+        if not options['no_mark']:
+            marked = collector.mark(limit=options['limit'])
+            LOGGER.info('Marked %s chunks', marked)
+        if not options['no_sweep']:
+            deleted = collector.sweep(limit=options['limit'])
+            LOGGER.info('Deleted %s chunks', deleted)
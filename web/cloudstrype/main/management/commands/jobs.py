@@ -0,0 +1,36 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from main.models import Job
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+
+class Command(BaseCommand):
+    help = """Run background jobs.
+
+    Runs pending jobs (such as large shares) until none remain."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--wait', type=int, default=0,
+                            help='Wait this many seconds for new jobs before '
+                                 'exiting')
+
+    def handle(self, *args, **options):
+        idle = 0
+        while True:
+            job = Job.objects.claim()
+            if job is None:
+                if idle >= options['wait']:
+                    break
+                time.sleep(1)
+                idle += 1
+                continue
+            idle = 0
+            LOGGER.info('Running job %s: %s', job.uid, job)
+            job.run()
+            LOGGER.info('Finished job %s: %s', job.uid, job)
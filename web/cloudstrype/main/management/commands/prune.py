@@ -0,0 +1,38 @@
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from main.models import File
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+
+class Command(BaseCommand):
+    help = """Prune file versions.
+
+    Detaches versions expired by retention policies, a batch of files at a
+    time. Chunks of deleted versions are reclaimed by the gc command."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int,
+                            default=settings.CLOUDSTRYPE_BULK_BATCH_SIZE,
+                            help='Number of files pruned per transaction')
+
+    def handle(self, *args, **options):
+        cursor, pruned = 0, 0
+        while True:
+            # Only files with more than one version can be pruned.
+            ids = list(
+                File.objects.filter(id__gt=cursor)
+                .annotate(versions_count=Count('versions'))
+                .filter(versions_count__gt=1).order_by('id')
+                .values_list('id', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            cursor = ids[-1]
+            pruned += File.objects.filter(id__in=ids).prune()
+        LOGGER.info('Pruned %s versions', pruned)
@@ -1,46 +1,34 @@
 """
-Provide high-level GET/PUT operations for files.
+Transfer server.
 
-Handles low-level communication with cloud providers, transistions between
-chunks and whole files.
-
-This server interacts with the application server and the front-end load
-balancer (nginx).
+Performs the transfers handed off by the application (see main.fs.transfer),
+so that a transfer ties up a coroutine for as long as the clouds take, rather
+than a uWSGI worker.
 
 Upload flow:
- 1. Upload from client is handled by nginx (written to /tmp).
- 2. Upload handed off to uWSGI application, which auths users and performs
+ 1. Upload from client is handled by nginx (spooled to disk by the upload
+    module).
+ 2. Upload handed off to the application, which auths the user and performs
     validation.
- 3. Upload handed off to aiohttp server, temp file path passed.
- 4. Application waits for aiohttp and nginx waits for application.
+ 3. The application responds with an X-Accel-Redirect, nginx makes the
+    request to this server, the token naming the temporary file.
+ 4. The file is chunked, each chunk's replicas written to the clouds in
+    parallel, a few chunks at a time. The response is sent to the client.
 
  * https://www.nginx.com/resources/wiki/modules/upload/
 
- 5. Optionally, once upload access is verified by the application, it can return
-    a response to nginx causing it to communicate with aiohttp directly. The
-    upload could proceed and the final response returned by aiohttp. In this
-    way the application server would not have to wait for the cloud upload to
-    complete.
-
- * https://www.nginx.com/resources/wiki/start/topics/examples/x-accel/#x-accel-redirect
-
- [User]->[Nginx]<->[uWSGI]<->[AIOHTTP]->[clouds]
-            ^                   ^
-            |                   |
-            +------>[tmp]-------+
-
- - OR -
-
  [User]->[Nginx]<-(redirect)->[uWSGI]
             ^
             |
             v
           [tmp]<->[AIOHTTP]->[clouds]
 
- Download flow:
+Download flow:
  1. Download request hits application via nginx.
  2. Perform validation and auth.
- 3. Redirect nginx to aiohttp, which will stream chunks via nginx to caller.
+ 3. Redirect nginx to this server, which fetches a window of chunks in
+    parallel, streaming them in order (using chunked encoding) via nginx to
+    the caller.
 
  * https://kovyrin.net/2010/07/24/nginx-fu-x-accel-redirect-remote/
 
@@ -50,219 +38,359 @@ Upload flow:
              v
          [AIOHTTP]<--[clouds]
 
-https://hub.docker.com/r/dimka2014/nginx-upload-with-progress-modules/
+Chunks are transferred by the asynchronous cloud clients (see
+main.fs.clouds.aio), so a process performs many transfers at once. The ORM
+(and encryption, which loads keys) blocks, it is called from a pool of
+threads. If the client disconnects, aiohttp cancels the handler, and with it
+the chunks in flight.
 """
 
 import asyncio
+import collections
+import functools
 import logging
+import os
+import random
+import threading
 
-from aiohttp import web
 from concurrent.futures import ThreadPoolExecutor
-from collections import deque
+from hashlib import md5, sha1
 
-from django.core.management.base import BaseCommand, CommandError
+from aiohttp import web
+
+from django.conf import settings
+from django.core import signing
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections, transaction
+
+from api.views import UserFileSerializer
+from main.fs import get_fs, CHUNK_CACHE, CHUNK_CACHE_WRITER
+from main.fs.clouds.aio import close_sessions
+from main.fs.errors import DirectoryConflictError, IncompleteUploadError
+from main.fs.transfer import Transfer, ACTION_DOWNLOAD, ACTION_UPLOAD
+from main.models import ChunkStorage, UploadSession, User, UserFile, Version
 
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
 
-MAX_CONCURRENT_CHUNKS = 3
+# Times each storage is tried when writing a replica.
+RETRIES = 3
+
 
+class TransferServer(object):
+    """
+    Perform transfers.
 
-class ChunkReader(object):
-    def _read_chunk(self, chunk):
-        """Download a single chunk.
+    Each transfer has at most window chunks in flight. The workers threads,
+    which make the blocking (ORM) calls, are shared by all transfers.
+    """
 
-        May need to contact multiple providers to read a replica if the first
-        provider fails."""
-        for storage in chunk.storages.all():
-            client = storage.get_client()
+    def __init__(self, workers=32, window=4):
+        self.executor = ThreadPoolExecutor(workers)
+        self.workers = workers
+        self.window = window
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_route('*', '/transfer/{token}', self.handle)
+        app.on_startup.append(self.startup)
+        app.on_cleanup.append(self.cleanup)
+        return app
+
+    async def startup(self, app):
+        # The asynchronous cloud clients make their (few) blocking calls in
+        # the loop's default executor, they share the pool.
+        asyncio.get_event_loop().set_default_executor(self.executor)
+
+    @staticmethod
+    async def cleanup(app):
+        # The sessions of the asynchronous cloud clients.
+        await close_sessions()
+
+    def close(self):
+        # Each thread has it's own database connections. A job per thread
+        # closes them, the barrier ensures no thread takes two.
+        barrier = threading.Barrier(self.workers)
+
+        def close():
+            barrier.wait()
+            connections.close_all()
+
+        for _ in range(self.workers):
+            self.executor.submit(close)
+        self.executor.shutdown()
+
+    @staticmethod
+    def _call(func, *args):
+        # Threads outlive requests, connections are closed once they expire
+        # (as Django does at the end of each request).
+        close_old_connections()
+        return func(*args)
+
+    def run(self, func, *args):
+        """Call a blocking function in the thread pool."""
+        return asyncio.get_event_loop().run_in_executor(
+            self.executor, functools.partial(self._call, func, *args))
+
+    async def handle(self, request):
+        try:
+            transfer = await self.run(Transfer, request.match_info['token'])
+        except (signing.BadSignature, User.DoesNotExist):
+            raise web.HTTPForbidden()
+        if transfer.action == ACTION_DOWNLOAD:
+            return await self.download(request, transfer)
+        elif transfer.action == ACTION_UPLOAD:
+            return await self.upload(request, transfer)
+        raise web.HTTPBadRequest()
+
+    async def download(self, request, transfer):
+        """
+        Stream a file version to the client.
+
+        Chunks are fetched in parallel, but sent in order.
+        """
+        try:
+            _, version, reader = await self.run(transfer.download)
+        except (UserFile.DoesNotExist, Version.DoesNotExist):
+            raise web.HTTPNotFound()
+
+        response = web.StreamResponse(headers={
+            'Content-Type': version.mime or 'application/octet-stream',
+            'Content-Disposition': transfer.claims['disposition'],
+        })
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+
+        with reader:
+            if not reader.chunks:
+                # Inline (or empty), nothing to fetch.
+                data = reader.read()
+                if data:
+                    await response.write(data)
+
+            chunks, pending = collections.deque(reader.chunks), \
+                collections.deque()
             try:
-                return client.download(chunk)
-            except:
-                continue
-        raise IOError('Could not read chunk')
-
-    async def __iter__(self):
-        """Read the chunks of a file.
-
-        Uses futures and asyncio to parallelize the reading of chunks."""
-        if self._closed:
-            raise IOError('I/O operation on closed file')
-
-        # We use the event loop to schedule futures. We only want a limited
-        # number of futures executing at one time as chunks can be quite large.
-        # Therefore we schedule several, and then await completion of the first
-        # (oldest) and yield it before scheduling another (staying several
-        # steps ahead).
-        loop = asyncio.get_event_loop()
-        q = deque(MAX_CONCURRENT_CHUNKS)
-        exector = ThreadPoolExecutor()
-        # TODO: implement getting chunks as future.
-        chunks = <get_chunks_as_deque()>
-
-        while True:
-            # Start as many concurrent chunk downloads as we are allowed.
-            while len(d) < MAX_CONCURRENT_CHUNKS and len(chunks):
-                try:
-                    d.append(loop.run_in_executor(executor, self._read_chunk,
-                                                  chunks.popleft())
-                except IndexError:
-                    break
-
-            # If futures are pending, wait for the oldest and yield it's result
-            if len(d):
-                task = await asyncio.wait_for(d.popleft())
+                while chunks or pending:
+                    # Keep the window full.
+                    while chunks and len(pending) < self.window:
+                        pending.append(asyncio.ensure_future(
+                            self.fetch(chunks.popleft())))
+                    await response.write(await pending.popleft())
+            finally:
+                # Failed, or the client went away, abandon the rest.
+                for future in pending:
+                    future.cancel()
+
+        await response.write_eof()
+        return response
+
+    async def fetch(self, chunk):
+        """
+        Fetch the data of a chunk (of a reader), as MultiCloudReader.fetch().
+
+        The chunk is read from the cache, or from one of it's storages
+        (tried in random order) using their asynchronous clients.
+        """
+        data = await self.run(CHUNK_CACHE.get, 'chunk:%s' % chunk.uid)
+        if data is None:
+            storages = await self.run(
+                lambda: [cs.storage for cs in
+                         chunk.storages.select_related('storage')])
+            for storage in sorted(storages, key=lambda k: random.random()):
                 try:
-                    yield task.result()
+                    data = await storage.get_async_client().download(chunk)
                 except Exception as e:
-                    # Cancel and return
-                    while len(d):
-                        d.popleft().cancel()
-                    break
-
-            # If there are no more pending futures, and no more chunks to get
-            # we are done and can exit the loop.
-            if not len(d) and not len(chunks):
+                    LOGGER.exception(e)
+                    continue
+                CHUNK_CACHE_WRITER.set('chunk:%s' % chunk.uid, data)
                 break
-
-
-class ChunkWriter(object):
-    def __init__(self):
-        self.executor = ThreadPoolExecutor()
-
-    def _write_chunk_replica(self, data, storage):
-        """Write a chunk replica.
-
-        Writes chunk data to a single provider."""
-        cs = ChunkStorage(storage=storage)
-        client = storage.get_client()
-        cs.attrs = client.upload(data)
-        return cs
-
-    def _write_chunk(self, data):
-        """Write a chunk.
-
-        Handles writing multiple replicas in parallel."""
-        chunk = Chunk()
-
-        tasks = []
-        goal = self.replicas
-        # Try each up to three times.
-        storages = itertools.chain(storages, storages, storages)
-
-        while True:
-            # Schedule enough replica writes to reach our goal.
-            while goal:
-                tasks.append(loop.run_in_executor(self.executor,
-                                              self._write_chunk_replica, data,
-                                              next(storages)))
-                goal -= 1
-
-            # Reap replica writes as they complete. Decrement goal for each
-            # that succeeds.
-            done, tasks = await asyncio.wait(
-                tasks, return_when=asyncio.FIRST_COMPLETED)
-
-            for t in done:
+            else:
+                raise IOError('Failed to read chunk %s' % chunk.uid)
+        # Decrypting loads the chunk's key.
+        data = await self.run(chunk.unpack, data)
+        if chunk.offset is not None:
+            data = data[chunk.offset:chunk.offset + chunk.length]
+        return data
+
+    async def upload(self, request, transfer):
+        """
+        Write a spooled file to the clouds.
+
+        Responds with the file, as the API does.
+        """
+        temp = transfer.claims['temp']
+        try:
+            if os.path.getsize(temp) <= settings.CLOUDSTRYPE_INLINE_THRESHOLD:
+                # Stored inline, there is nothing to parallelize.
+                user_file = await self.run(transfer.upload)
+            else:
                 try:
-                    cs.append(t.result())
-                except:
-                    goal += 1
-
-        return chunk, cs
-
-    @atomic
-    def _write(self, f):
-        """Transactional write.
-
-        This future performs all database operations within a transaction."""
-        loop = asyncio.get_event_loop()
-        d = deque()
-
-        for data in chunker(f):
-            d.append(loop.run_in_executor(self.executor, self._write_chunk, data))
-
-            # If we reach our limit for concurrent operations, block until one
-            # completes.
-            if len(d) == MAX_CONCURRENT_CHUNKS:
-                chunk, chunkstorages = await asyncio.wait_for(d.popleft())
-                chunk.save()
-                for cs in chunkstorages:
-                    cs.chunk = chunk
-                    cs.save()
-
-    async def write(self, f):
-        """Write multiple replicas of each chunk of a file.
-
-        Uses a future to write a file chunk by chunk."""
-        loop = asyncio.get_event_loop()
-        task = loop.run_in_executor(self.executor, self._write, f)
-        await asyncio.wait_for(task)
-
-
-
-async def download(request):
-    """
-    Download a file from clouds.
-
-    Incrementally downloads a file from cloud providers. Starts downloading up
-    to 5 chunks at once and as each is returned (in order) another chunk is
-    started. Handles retries.
-
-    Can be passed a specific verison, otherwise, it locates the most recent
-    version and returns that.
-    """
-    # The request should include the file name in path. This is for naming the
-    # file and will be echoed in the Content-Disposition header. The query
-    # string should consist of the uid of the file we wish to transfer. The
-    # transfer is done using chunked encoding, each chunk is returned as,
-    # well... a chunk.
-    name, uid = request.path, request.query_string
-    
-
-
-async def upload(request):
-    """
-    Upload a file to clouds.
-
-    Accepts a file body or temp file path. Chunks the file, replicates it and
-    uploads to multiple cloud providers.
-    """
-    pass
-
-
-async def handler(request):
-    """
-    Handle web request.
-
-    Validate and then dispatch to upload()/download().
-    """
-    if request.method == 'GET':
-        return await download(request)
-    elif request.method in ('PUT', 'POST'):
-        return await upload(request)
-    else:
-        return web.Response(status=409, text='Method not allowed')
+                    user_file = await self.write(transfer)
+                finally:
+                    os.remove(temp)
+        except DirectoryConflictError:
+            raise web.HTTPConflict()
+        except (IOError, IncompleteUploadError,
+                UploadSession.DoesNotExist) as e:
+            # The session expired (or was purged) meanwhile, or a chunk could
+            # not be written.
+            LOGGER.exception(e)
+            raise web.HTTPServiceUnavailable()
+
+        data = await self.run(lambda: UserFileSerializer(user_file).data)
+        return web.json_response(data)
+
+    async def write(self, transfer):
+        """
+        Write the spooled file in chunks.
+
+        The chunks are the parts of an upload session (see
+        MultiCloudFilesystem.start_upload()), so each is referenced before it
+        is written. Chunks are written (window at a time) before anything is
+        committed, the version then replaces the file's current version in a
+        single transaction. If anything fails, the session is purged.
+
+        Returns the UserFile.
+        """
+        fs = await self.run(get_fs, transfer.user)
+        assert len(fs.storage) >= fs.replicas, \
+            'not enough storage (%s) for %s replicas' % (len(fs.storage),
+                                                         fs.replicas)
+        md5sum, sha1sum, serial = md5(), sha1(), 0
+        pending = set()
+
+        session = await self.run(fs.start_upload, transfer.claims['path'])
+        try:
+            with open(transfer.claims['temp'], 'rb') as f:
+                try:
+                    while True:
+                        data = await self.run(
+                            f.read, settings.CLOUDSTRYPE_CHUNK_SIZE)
+                        if not data:
+                            break
+                        md5sum.update(data)
+                        sha1sum.update(data)
+                        serial += 1
+                        if len(pending) >= self.window:
+                            done, pending = await asyncio.wait(
+                                pending, return_when=asyncio.FIRST_COMPLETED)
+                            self._results(done)
+                        pending.add(asyncio.ensure_future(
+                            self.write_chunk(fs, session, serial, data)))
+                    if pending:
+                        done, pending = await asyncio.wait(pending)
+                        self._results(done)
+                finally:
+                    for future in pending:
+                        future.cancel()
+
+            def commit():
+                with transaction.atomic():
+                    Version.objects.filter(id=session.version_id).update(
+                        md5=md5sum.hexdigest(), sha1=sha1sum.hexdigest())
+                    return fs.commit_upload(session)
+
+            return await self.run(commit)
+        except Exception:
+            await self.run(
+                UploadSession.objects.filter(pk=session.pk).purge)
+            raise
+
+    @staticmethod
+    def _results(done):
+        """
+        Collect the results of completed futures.
+
+        Raises the first failure, once every failure has been retrieved.
+        """
+        errors = [f.exception() for f in done if f.exception() is not None]
+        if errors:
+            raise errors[0]
+        return [f.result() for f in done]
+
+    async def write_chunk(self, fs, session, serial, data):
+        """
+        Write a chunk's replicas, as part serial of session.
+
+        Returns the chunk.
+        """
+        chunk = await self.run(fs.add_part, session, serial, len(data))
+        data = await self.run(chunk.pack, data)
+        await self.write_replicas(fs, chunk, data)
+        # Leading chunks are cached, as for MultiCloudWriter.
+        limit = settings.CHUNK_CACHE_WRITE_CHUNKS
+        if limit is None or serial <= limit:
+            CHUNK_CACHE_WRITER.set('chunk:%s' % chunk.uid, data)
+        return chunk
+
+    async def write_replicas(self, fs, chunk, data):
+        """
+        Write replicas of a chunk to distinct storages, in parallel.
+
+        Storages are chosen at random, one that fails is retried (after the
+        others) up to RETRIES times.
+        """
+        goal = fs.replicas + 1
+        storages = collections.deque(
+            sorted(fs.storage, key=lambda k: random.random()))
+        failures, pending, written = collections.Counter(), {}, 0
+        try:
+            while written < goal:
+                # Start enough writes to reach the goal.
+                while storages and len(pending) < goal - written:
+                    storage = storages.popleft()
+                    pending[asyncio.ensure_future(
+                        self.write_replica(storage, chunk, data))] = storage
+                if not pending:
+                    raise IOError('Failed to write chunk %s' % chunk.uid)
+                done, _ = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    storage = pending.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        LOGGER.exception(e)
+                        failures[storage.id] += 1
+                        if failures[storage.id] < RETRIES:
+                            storages.append(storage)
+                    else:
+                        written += 1
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def write_replica(self, storage, chunk, data):
+        attrs = await storage.get_async_client().upload(chunk, data)
+        cs = ChunkStorage(chunk=chunk, storage=storage)
+        cs.attrs = attrs or {}
+        await self.run(cs.save)
 
 
 class Command(BaseCommand):
-    help = """Transfer to/from cloud."""
+    help = """Transfer server.
+
+    Performs transfers handed off by the application."""
 
     def add_arguments(self, parser):
         parser.add_argument('--port', type=int, default=8001,
                             help='HTTP server port')
         parser.add_argument('--bind', default='localhost',
                             help='Server address to bind')
+        parser.add_argument('--workers', type=int, default=32,
+                            help='Threads making blocking (ORM) calls')
+        parser.add_argument('--window', type=int, default=4,
+                            help='Chunks in flight per transfer')
 
-    def handle(self, *args, bind='localhost', port=8001, **kwargs):
+    def handle(self, *args, bind='localhost', port=8001, workers=32, window=4,
+               **kwargs):
         LOGGER.addHandler(logging.StreamHandler())
         LOGGER.setLevel(logging.DEBUG)
 
-        loop = asyncio.get_event_loop()
-
-        # Create low-level aiohttp server.
-        server = web.Server(handler)
-        loop.run_until_complete(loop.create_server(bind, port))
-
-        loop.run_forever()
+        server = TransferServer(workers=workers, window=window)
+        try:
+            web.run_app(server.make_app(), host=bind, port=port)
+        finally:
+            server.close()
@@ -0,0 +1,20 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from main.models import Storage
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+
+class Command(BaseCommand):
+    help = """Reconcile storage usage.
+
+    Recounts the chunks stored in each storage, repairing the counters kept as
+    chunks are written and deleted."""
+
+    def handle(self, *args, **options):
+        repaired = Storage.objects.all().order_by('id').reconcile()
+        LOGGER.info('Repaired %s storages', repaired)
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """
+    Store the full path of each directory.
+
+    Existing paths are calculated using a recursive CTE.
+    """
+
+    dependencies = [
+        ('main', '0003_auto_20170529_0317'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userdir',
+            name='path',
+            field=models.TextField(null=True),
+        ),
+        migrations.RunSQL(
+            '    WITH RECURSIVE "tree" ("id", "path") AS ('
+            '        SELECT "id", \'/\'::text'
+            '        FROM "main_userdir"'
+            '        WHERE "parent_id" IS NULL'
+            '    UNION ALL'
+            '        SELECT "d"."id", rtrim("t"."path", \'/\') || \'/\' ||'
+            '                         "d"."name"'
+            '        FROM "main_userdir" "d"'
+            '        JOIN "tree" "t" ON "d"."parent_id" = "t"."id"'
+            '    )'
+            '    UPDATE "main_userdir" SET "path" = "tree"."path"'
+            '    FROM "tree" WHERE "main_userdir"."id" = "tree"."id"',
+            migrations.RunSQL.noop,
+        ),
+        migrations.AlterField(
+            model_name='userdir',
+            name='path',
+            field=models.TextField(db_index=True, editable=False),
+        ),
+        migrations.AlterUniqueTogether(
+            name='userdir',
+            unique_together=set([('user', 'name', 'parent'),
+                                 ('user', 'path')]),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 21:33
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0004_userdir_path'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='userdir',
+            index_together=set([('parent', 'name')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='userfile',
+            index_together=set([('parent', 'name')]),
+        ),
+    ]
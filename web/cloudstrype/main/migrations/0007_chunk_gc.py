@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 21:45
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunk',
+            name='gc_marked',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+    ]
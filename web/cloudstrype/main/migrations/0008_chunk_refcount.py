@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """
+    Count the references to each chunk.
+
+    Existing counts are calculated from VersionChunk.
+    """
+
+    dependencies = [
+        ('main', '0007_chunk_gc'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunk',
+            name='refcount',
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+        migrations.RunSQL(
+            '    UPDATE "main_chunk" SET "refcount" = ('
+            '        SELECT COUNT(*) FROM "main_versionchunk"'
+            '        WHERE "main_versionchunk"."chunk_id" = "main_chunk"."id"'
+            '    )',
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 21:53
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_chunk_refcount'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RetentionPolicy',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('keep_last', models.PositiveIntegerField(blank=True, null=True)),
+                ('keep_days', models.PositiveIntegerField(blank=True, null=True)),
+                ('keep_hourly', models.PositiveIntegerField(blank=True, null=True)),
+                ('keep_daily', models.PositiveIntegerField(blank=True, null=True)),
+                ('keep_weekly', models.PositiveIntegerField(blank=True, null=True)),
+                ('file', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='retention_policy', to='main.File')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='retention_policies', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='retentionpolicy',
+            unique_together=set([('user', 'file')]),
+        ),
+    ]
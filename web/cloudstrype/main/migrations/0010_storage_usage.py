@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """
+    Count the chunks stored in each storage.
+
+    Existing counts are calculated from ChunkStorage.
+    """
+
+    dependencies = [
+        ('main', '0009_retention_policy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storage',
+            name='chunk_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='storage',
+            name='chunk_count',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunSQL(
+            '    UPDATE "main_storage"'
+            '    SET "chunk_count" = "usage"."count",'
+            '        "chunk_bytes" = "usage"."bytes"'
+            '    FROM ('
+            '        SELECT "cs"."storage_id", COUNT(*) AS "count",'
+            '               SUM("c"."size") AS "bytes"'
+            '        FROM "main_chunkstorage" "cs"'
+            '        JOIN "main_chunk" "c" ON "c"."id" = "cs"."chunk_id"'
+            '        GROUP BY "cs"."storage_id"'
+            '    ) "usage"'
+            '    WHERE "main_storage"."id" = "usage"."storage_id"',
+            migrations.RunSQL.noop,
+        ),
+    ]
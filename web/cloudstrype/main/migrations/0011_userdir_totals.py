@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """
+    Keep recursive totals on each directory.
+
+    Existing totals are calculated from the directory paths, a directory's
+    descendants are those whose path starts with it's own.
+    """
+
+    dependencies = [
+        ('main', '0010_storage_usage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userdir',
+            name='total_dirs',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='userdir',
+            name='total_files',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='userdir',
+            name='total_size',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.RunSQL(
+            '    UPDATE "main_userdir"'
+            '    SET "total_size" = "totals"."size",'
+            '        "total_files" = "totals"."files",'
+            '        "total_dirs" = "totals"."dirs"'
+            '    FROM ('
+            '        SELECT "d"."id", "f"."size", "f"."files", "s"."dirs"'
+            '        FROM "main_userdir" "d",'
+            '        LATERAL ('
+            '            SELECT COUNT(*) - 1 AS "dirs"'
+            '            FROM "main_userdir" "sd"'
+            '            WHERE "sd"."user_id" = "d"."user_id"'
+            '              AND ("sd"."id" = "d"."id"'
+            '                   OR LEFT("sd"."path", LENGTH(RTRIM("d"."path", \'/\')) + 1)'
+            '                      = RTRIM("d"."path", \'/\') || \'/\')'
+            '        ) "s",'
+            '        LATERAL ('
+            '            SELECT COUNT("uf"."id") AS "files",'
+            '                   COALESCE(SUM("v"."size"), 0) AS "size"'
+            '            FROM "main_userfile" "uf"'
+            '            JOIN "main_userdir" "p" ON "p"."id" = "uf"."parent_id"'
+            '            JOIN "main_file" "fi" ON "fi"."id" = "uf"."file_id"'
+            '            LEFT JOIN "main_version" "v" ON "v"."id" = "fi"."version_id"'
+            '            WHERE "uf"."deleted" IS NULL'
+            '              AND "p"."user_id" = "d"."user_id"'
+            '              AND ("p"."id" = "d"."id"'
+            '                   OR LEFT("p"."path", LENGTH(RTRIM("d"."path", \'/\')) + 1)'
+            '                      = RTRIM("d"."path", \'/\') || \'/\')'
+            '        ) "f"'
+            '    ) "totals"'
+            '    WHERE "main_userdir"."id" = "totals"."id"',
+            migrations.RunSQL.noop,
+        ),
+    ]
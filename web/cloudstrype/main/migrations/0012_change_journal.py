@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_userdir_totals'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Change',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('action', models.SmallIntegerField(choices=[(1, 'Create'), (2, 'Update'), (3, 'Move'), (4, 'Delete'), (5, 'Tag')])),
+                ('isdir', models.BooleanField(default=False)),
+                ('uid', models.CharField(max_length=64)),
+                ('path', models.TextField()),
+                ('old_path', models.TextField(null=True)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='changes', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='change',
+            index_together=set([('user', 'id')]),
+        ),
+    ]
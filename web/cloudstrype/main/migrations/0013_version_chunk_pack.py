@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_change_journal'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='versionchunk',
+            name='length',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='versionchunk',
+            name='offset',
+            field=models.IntegerField(null=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_version_chunk_pack'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='version',
+            name='data',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='version',
+            name='key',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='versions', to='main.Key'),
+        ),
+    ]
@@ -4,14 +4,18 @@ Data models.
 This file contains the models that pertain to the whole application.
 """
 
+import collections
+import logging
+import operator
 import random
 import uuid
 import zlib
 
-from os.path import (
-    dirname, splitext
-)
+from datetime import timedelta
+from functools import reduce
+from os.path import splitext
 from os.path import join as pathjoin
+from os.path import normpath as pathnormpath
 from os.path import split as pathsplit
 
 from cryptography.fernet import Fernet
@@ -23,13 +27,40 @@ from django.contrib.postgres.fields import JSONField
 # from django.contrib.postgres.search import SearchVectorField
 from django.core.exceptions import ObjectDoesNotExist
 from django.conf import settings
+from django.core.cache import cache as default_cache
 from django.db import models, transaction, IntegrityError
-from django.db.models import Max
+from django.db.models import Count, Max, Prefetch, Q, Sum, Value
+from django.db.models.functions import Concat, Substr
 from django.db.models.query import QuerySet, F
 from django.utils.translation import ugettext as _
 from django.utils import timezone
 from hashids import Hashids
 
+from main.cache import DentryCache
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def normpath(path):
+    """
+    Normalize a path.
+
+    Paths are stored with a single leading slash and no trailing slash.
+    """
+    return pathnormpath('/' + path.lstrip('/'))
+
+
+def ancestors(path):
+    """
+    Return a (normalized) path and the paths of all of it's ancestors.
+    """
+    paths = [path]
+    while path != '/':
+        path = pathsplit(path)[0]
+        paths.append(path)
+    return paths
+
 
 def SET_FIELD(field_name, value):
     """
@@ -68,6 +99,13 @@ class UidQuerySet(QuerySet):
             except IndexError:
                 # Decode problem, invalid uid...
                 raise model.DoesNotExist()
+        uids = kwargs.pop('uid__in', None)
+        if uids is not None:
+            # Invalid uids simply match nothing.
+            hashids = model.get_hashids()
+            kwargs['id__in'] = [
+                id for uid in uids for id in hashids.decode(uid)[:1]
+            ]
 
     def filter(self, *args, **kwargs):
         UidQuerySet._args(self.model, kwargs)
@@ -295,6 +333,48 @@ class Key(models.Model):
         return Fernet(self.key).decrypt(data)
 
 
+class StorageQuerySet(UidQuerySet):
+    def summary(self):
+        """
+        Roll up the storages by provider.
+
+        Returns a list of dicts, one for each provider type.
+        """
+        rows = self.order_by('type').values('type').annotate(
+            storages=Count('id'), size=Sum('size'), used=Sum('used'),
+            chunks=Sum('chunk_count'), stored=Sum('chunk_bytes'))
+        for row in rows:
+            row['name'] = Storage.TYPES[row['type']]
+        return list(rows)
+
+    def reconcile(self):
+        """
+        Recount the chunks stored in each storage.
+
+        Returns the number of storages whose counters were repaired.
+        """
+        repaired = 0
+        for storage_id in self.values_list('id', flat=True):
+            with transaction.atomic():
+                # Locked so that chunks are not added while counting.
+                storage = Storage.objects.select_for_update() \
+                    .only('chunk_count', 'chunk_bytes').get(id=storage_id)
+                usage = ChunkStorage.objects.filter(storage_id=storage_id) \
+                    .aggregate(count=Count('id'), bytes=Sum('chunk__size'))
+                usage['bytes'] = usage['bytes'] or 0
+                if (storage.chunk_count, storage.chunk_bytes) == \
+                   (usage['count'], usage['bytes']):
+                    continue
+                LOGGER.warning('Storage %s counted %s chunks (%s bytes), '
+                               'should be %s (%s bytes)', storage_id,
+                               storage.chunk_count, storage.chunk_bytes,
+                               usage['count'], usage['bytes'])
+                Storage.objects.filter(id=storage_id).update(
+                    chunk_count=usage['count'], chunk_bytes=usage['bytes'])
+                repaired += 1
+        return repaired
+
+
 class Storage(UidModelMixin, models.Model):
     """
     Storage model.
@@ -336,9 +416,15 @@ class Storage(UidModelMixin, models.Model):
     type = models.SmallIntegerField(null=False, choices=TYPES.items())
     size = models.BigIntegerField(null=False, default=0)
     used = models.BigIntegerField(null=False, default=0)
+    # Number and size of the chunks stored here, kept by ChunkStorage.save()
+    # and ChunkStorageQuerySet.delete().
+    chunk_count = models.BigIntegerField(null=False, default=0)
+    chunk_bytes = models.BigIntegerField(null=False, default=0)
     auth = JSONField(blank=True, default={})
     attrs = JSONField(blank=True, default={})
 
+    objects = StorageQuerySet.as_manager()
+
     def __str__(self):
         return self.name
 
@@ -363,11 +449,11 @@ class Storage(UidModelMixin, models.Model):
         self.save(update_fields=['auth'])
 
     def get_client(self, *args, **kwargs):
-        # Cache the client
-        if getattr(self, '__client', None) is None:
-            client = get_client(self.type, storage=self)
-            setattr(self, '__client', client)
-        return getattr(self, '__client')
+        # Clients are pooled (per process), see main.fs.clouds.ClientPool.
+        return CLIENT_POOL.get(self)
+
+    def get_async_client(self):
+        return ASYNC_CLIENT_POOL.get(self)
 
 
 class Tag(models.Model):
@@ -390,44 +476,33 @@ class UserDirQuerySet(UidQuerySet):
 
     @staticmethod
     def _args(model, kwargs):
-        """Convert path pseudo argument actual fields."""
-        # Convert path into the constituate parts that are stored. For example
-        # when given a path, we split the path and recursively locate
-        # directories using their user, parent and name.
+        """Normalize path argument."""
+        # The full path of each directory is stored, so a path is located with
+        # a single (indexed) query, regardless of it's depth.
         path = kwargs.pop('path', None)
         if path is not None:
             try:
                 user = kwargs['user']
             except KeyError:
                 raise ValueError('`user` argument required with `path`')
-            parents = path.lstrip('/').split('/')
-            kwargs['name'] = parents.pop()
-            # This is the "root" for the user. We want to enforce uniqueness
-            # for (user, name, parent), but if parent is NULL, we cannot do so.
-            # Thus we use this "root" as the parent of everything at the
-            # top-level.
-            obj = UserDir.objects.get_root(user)
-            if parents:
-                for part in parents:
-                    obj = obj.child_dirs.get(name=part)
-                kwargs['parent'] = obj
-            elif kwargs['name'] == '':
-                # If name is also blank, they are looking for ROOT, thus parent
-                # should be null.
-                kwargs['parent'] = None
-            else:
-                kwargs['parent'] = obj
+            path = normpath(path)
+            if path == '/':
+                # This is the "root" for the user. It is created on demand, so
+                # that it always exists.
+                UserDir.objects.get_root(user)
+            kwargs['path'] = path
 
     def filter(self, *args, **kwargs):
         """Filter objects using full path."""
-        try:
-            UserDirQuerySet._args(self.model, kwargs)
-        except UserDir.DoesNotExist:
-            # We failed to find a parent for the given path, thus it cannot
-            # exist. Rather than raising, return an empty queryset.
-            return super().none()
+        UserDirQuerySet._args(self.model, kwargs)
         return super().filter(*args, **kwargs)
 
+    def add_usage(self, size=0, files=0, dirs=0):
+        """Add to the recursive totals of the directories."""
+        return self.update(total_size=F('total_size') + size,
+                           total_files=F('total_files') + files,
+                           total_dirs=F('total_dirs') + dirs)
+
 
 class UserDirManager(models.Manager):
     """Manage UserDir model."""
@@ -441,29 +516,97 @@ class UserDirManager(models.Manager):
         return UserDirQuerySet(self.model, using=self._db)
 
     def create(self, *args, **kwargs):
-        # Preserve this arg (_args() pops it...)
-        path = kwargs.get('path', None)
-        try:
-            UserDirQuerySet._args(self.model, kwargs)
-        except UserDir.DoesNotExist:
-            # Parent missing, create...
-            parent = dirname(path.lstrip('/'))
-            kwargs['parent'], _ = UserDir.objects.get_or_create(
-                user=kwargs['user'], path=parent)
+        # Convert path into the constituent parts (parent and name). Missing
+        # parents are created.
+        path = kwargs.pop('path', None)
+        if path is not None:
+            try:
+                user = kwargs['user']
+            except KeyError:
+                raise ValueError('`user` argument required with `path`')
+            parent, kwargs['name'] = pathsplit(normpath(path))
+            if kwargs['name'] == '':
+                # If name is blank, they are creating ROOT, thus parent should
+                # be null.
+                kwargs['parent'] = None
+            else:
+                kwargs['parent'], _ = self.get_or_create(user=user,
+                                                         path=parent)
         return super().create(*args, **kwargs)
 
     def get_or_create(self, *args, **kwargs):  # noqa: D402
         """
         Override default get_or_create().
         """
-        # It might be better to do this in save().
-        UserDirQuerySet._args(self.model, kwargs)
-        return super().get_or_create(*args, **kwargs)
+        if 'path' not in kwargs:
+            return super().get_or_create(*args, **kwargs)
+        try:
+            return self.get(*args, **kwargs), False
+        except UserDir.DoesNotExist:
+            pass
+        try:
+            with transaction.atomic():
+                return self.create(*args, **kwargs), True
+        except IntegrityError:
+            return self.get(*args, **kwargs), False
 
     def get_root(self, user):
         """Get a UserDir that serves as the user's "root"."""
         return UserDir.objects.get_or_create(user=user, name='')[0]
 
+    def add_usage(self, user_id, path, size=0, files=0, dirs=0):
+        """
+        Add to the totals of the directory at path and all of it's ancestors.
+
+        A single UPDATE, regardless of the depth of path.
+        """
+        if size or files or dirs:
+            self.get_queryset() \
+                .filter(user_id=user_id, path__in=ancestors(path)) \
+                .add_usage(size=size, files=files, dirs=dirs)
+
+    @transaction.atomic
+    def rebuild_usage(self, user):
+        """
+        Recalculate the totals of all of a user's directories.
+
+        Returns the number of directories that were repaired.
+        """
+        dirs = {
+            id: (parent_id, path, [size, files, subdirs])
+            for id, parent_id, path, size, files, subdirs in self
+            .get_queryset().filter(user=user).select_for_update()
+            .values_list('id', 'parent_id', 'path', 'total_size',
+                         'total_files', 'total_dirs')
+        }
+        totals = {id: [0, 0, 0] for id in dirs}
+        for parent_id, files, size in UserFile.objects \
+                .filter(user=user, parent__isnull=False).order_by() \
+                .values_list('parent_id').annotate(
+                    Count('id'), Sum('file__version__size')):
+            totals[parent_id][:2] = [size or 0, files]
+        # Children are added to their parents, deepest first.
+        for id in sorted(dirs, reverse=True,
+                         key=lambda id: dirs[id][1].rstrip('/').count('/')):
+            parent_id = dirs[id][0]
+            if parent_id is not None:
+                size, files, subdirs = totals[id]
+                parent = totals[parent_id]
+                parent[0] += size
+                parent[1] += files
+                parent[2] += subdirs + 1
+        repaired = 0
+        for id, (parent_id, path, current) in dirs.items():
+            if totals[id] == current:
+                continue
+            LOGGER.warning('Directory %s totals %s, should be %s', path,
+                           current, totals[id])
+            size, files, subdirs = totals[id]
+            self.get_queryset().filter(id=id).update(
+                total_size=size, total_files=files, total_dirs=subdirs)
+            repaired += 1
+        return repaired
+
 
 class UserDir(UidModelMixin, models.Model):
     """
@@ -475,18 +618,34 @@ class UserDir(UidModelMixin, models.Model):
     """
 
     class Meta:
-        unique_together = ('user', 'name', 'parent')
+        unique_together = (('user', 'name', 'parent'), ('user', 'path'))
+        # Listings are paged in (name, id) order.
+        index_together = ('parent', 'name')
 
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     parent = models.ForeignKey('self', null=True, related_name='child_dirs',
                                on_delete=models.CASCADE)
     name = models.CharField(max_length=255)
+    # Denormalized full path, maintained by save().
+    path = models.TextField(db_index=True, editable=False)
     created = models.DateTimeField(null=False, default=timezone.now)
     tags = models.ManyToManyField(Tag)
     attrs = JSONField(null=True, blank=True)
+    # Recursive totals of the live files (their current versions) and
+    # directories beneath this one. Maintained using UPDATEs as the tree
+    # changes (see UserDirManager.add_usage()), never saved from memory.
+    total_size = models.BigIntegerField(default=0, editable=False)
+    total_files = models.BigIntegerField(default=0, editable=False)
+    total_dirs = models.BigIntegerField(default=0, editable=False)
+
+    TOTALS = ('total_size', 'total_files', 'total_dirs')
 
     objects = UserDirManager()
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._saved_path = self.path
+
     def __str__(self):
         return self.path
 
@@ -498,10 +657,103 @@ class UserDir(UidModelMixin, models.Model):
     def isfile(self):
         return False
 
-    @property
-    def path(self):
-        parent_path = self.parent.path if self.parent else ''
-        return pathjoin('/', parent_path, self.name)
+    @transaction.atomic
+    def save(self, *args, **kwargs):
+        """
+        Maintain path.
+
+        When a directory is moved or renamed, the paths of all it's descendants
+        are rewritten using a single UPDATE. The totals of it's ancestors are
+        updated when it is created or moved.
+        """
+        adding = self._state.adding
+        self.path = pathjoin(self.parent.path, self.name) if self.parent_id \
+            else '/'
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None and not adding:
+            update_fields = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in self.TOTALS
+            ]
+        if update_fields is not None and 'path' not in update_fields:
+            update_fields = list(update_fields) + ['path']
+        if update_fields is not None:
+            kwargs['update_fields'] = update_fields
+        obj = super().save(*args, **kwargs)
+        old_path = self._saved_path
+        if adding and self.parent_id:
+            UserDir.objects.add_usage(self.user_id, self.parent.path, dirs=1)
+        elif old_path and pathsplit(old_path)[0] != pathsplit(self.path)[0]:
+            # Moved, from the old parent's totals to the new parent's.
+            size, files, dirs = UserDir.objects.filter(pk=self.pk) \
+                .values_list(*self.TOTALS).get()
+            UserDir.objects.add_usage(self.user_id, pathsplit(old_path)[0],
+                                      -size, -files, -dirs - 1)
+            UserDir.objects.add_usage(self.user_id, self.parent.path,
+                                      size, files, dirs + 1)
+        if old_path and old_path != self.path:
+            UserDir.objects.filter(
+                user_id=self.user_id, path__startswith=old_path + '/') \
+                .update(path=Concat(
+                    Value(self.path), Substr('path', len(old_path) + 1),
+                    output_field=models.TextField()))
+        self._saved_path = self.path
+        return obj
+
+    @transaction.atomic
+    def delete(self, using=None, keep_parents=False):
+        """
+        Delete the directory and everything beneath it.
+
+        The files within are soft-deleted (and detached from the tree) and the
+        directories removed, using a fixed number of queries regardless of the
+        size of the tree. Nothing is loaded into memory. Returns the number of
+        directories and files deleted.
+        """
+        totals = UserDir.objects.filter(pk=self.pk) \
+            .values_list(*self.TOTALS).get()
+        dirs = UserDir.objects.filter(
+            Q(pk=self.pk) | Q(**self._subtree_filter()))
+        files = UserFile.all.filter(parent__in=dirs)
+        stats = {
+            'files': files.filter(deleted__isnull=True)
+                          .update(deleted=timezone.now()),
+        }
+        # Detach all files, including those deleted previously.
+        files.update(parent=None)
+        UserDir.tags.through.objects.filter(userdir__in=dirs).delete()
+        # Nothing references the directories now, so they are deleted with a
+        # single DELETE, bypassing the collector (which would load them).
+        stats['dirs'] = dirs._raw_delete(dirs.db)
+        if self.parent_id:
+            size, files, subdirs = totals
+            UserDir.objects.add_usage(self.user_id, pathsplit(self.path)[0],
+                                      -size, -files, -subdirs - 1)
+        return stats
+
+    @transaction.atomic
+    def clear(self):
+        """
+        Delete everything beneath the directory, as delete() does.
+
+        The directory itself is kept, empty. Returns the number of directories
+        and files deleted.
+        """
+        totals = UserDir.objects.filter(pk=self.pk) \
+            .values_list(*self.TOTALS).get()
+        dirs = UserDir.objects.filter(**self._subtree_filter())
+        files = UserFile.all.filter(Q(parent=self) | Q(parent__in=dirs))
+        stats = {
+            'files': files.filter(deleted__isnull=True)
+                          .update(deleted=timezone.now()),
+        }
+        files.update(parent=None)
+        UserDir.tags.through.objects.filter(userdir__in=dirs).delete()
+        stats['dirs'] = dirs._raw_delete(dirs.db)
+        size, files, subdirs = totals
+        UserDir.objects.add_usage(self.user_id, self.path, -size, -files,
+                                  -subdirs)
+        return stats
 
     def add_tag(self, tag):
         if isinstance(tag, str):
@@ -511,6 +763,12 @@ class UserDir(UidModelMixin, models.Model):
     def share(self, user, parent=None, name=None, recursive=False):
         """
         Share the directory with another user.
+
+        The shared directory is created immediately. It is populated before
+        returning, unless it contains more than CLOUDSTRYPE_SHARE_JOB_THRESHOLD
+        files, in which case a background Job populates it. That job is
+        available as the returned directory's `job` attribute (None when the
+        share is complete).
         """
         if parent is None:
             # Get the target user's "root".
@@ -525,16 +783,175 @@ class UserDir(UidModelMixin, models.Model):
             # - If it exists, append sharing user's email address.
             else:
                 name = '%s (%s)' % (self.name, user.email)
-        dir = UserDir.objects.create(parent=parent, name=name, user=user)
-        for f in self.child_files.all():
-            f.share(user, parent=dir)
-        # Done if we only want to share the files in this directory.
-        if recursive:
-            # If recursive, share the child DIRECTORIES and their contents too.
-            for d in self.child_dirs.all():
-                d.share(user, parent=dir, name=d.name, recursive=recursive)
+        with transaction.atomic():
+            dir = UserDir.objects.create(parent=parent, name=name, user=user)
+            total = self.count_files(recursive=recursive)
+            if total > settings.CLOUDSTRYPE_SHARE_JOB_THRESHOLD:
+                dir.job = Job.objects.create(
+                    user=self.user, type=Job.TYPE_SHARE, total=total,
+                    args={'src': self.id, 'dst': dir.id,
+                          'recursive': recursive})
+            else:
+                dir.job = None
+                self.clone_into(dir, share=True, recursive=recursive)
+        # The target user's hierarchy changed beneath them.
+        DentryCache(user).invalidate_all()
         return dir
 
+    def _subtree_filter(self, prefix=''):
+        """Return filter arguments selecting directories beneath this one."""
+        return {
+            prefix + 'user_id': self.user_id,
+            prefix + 'path__startswith': self.path.rstrip('/') + '/',
+        }
+
+    def count_files(self, recursive=True):
+        """Count the files in this directory (and it's descendants)."""
+        files = UserFile.objects.filter(parent=self)
+        if recursive:
+            files |= UserFile.objects.filter(
+                **self._subtree_filter(prefix='parent__'))
+        return files.count()
+
+    def _snapshot(self, exclude=None):
+        """
+        Snapshot the descendants of this directory.
+
+        Returns lists of (id, parent_id, name, attrs, path, total_size,
+        total_files, total_dirs) tuples, one for each level of the tree (so
+        parents precede their children).
+        """
+        levels = collections.defaultdict(list)
+        subdirs = UserDir.objects.filter(**self._subtree_filter()) \
+            .exclude(id__in=[self.id] + ([exclude] if exclude else [])) \
+            .values_list('id', 'parent_id', 'name', 'attrs', 'path',
+                         *self.TOTALS)
+        for subdir in subdirs:
+            levels[subdir[4].count('/')].append(subdir)
+        return [levels[depth] for depth in sorted(levels)]
+
+    @transaction.atomic
+    def clone(self, parent, name, share=False, recursive=True):
+        """
+        Copy the directory and it's contents.
+
+        The copy is created in parent (which may belong to another user) as
+        name. See clone_into(). Returns the new directory.
+        """
+        # Snapshot the subtree first, the copy may be placed within it.
+        levels = self._snapshot() if recursive else []
+        root = UserDir.objects.create(user_id=parent.user_id, parent=parent,
+                                      name=name,
+                                      attrs=None if share else self.attrs)
+        self.clone_into(root, share=share, levels=levels)
+        return root
+
+    def clone_into(self, root, share=False, recursive=True, levels=None,
+                   batch_size=settings.CLOUDSTRYPE_BULK_BATCH_SIZE,
+                   progress=None):
+        """
+        Copy the contents of the directory into root.
+
+        If share is True, the files are shared rather than copied. They then
+        refer to the same File, and their attributes and tags are not copied.
+
+        The tree is written using batched inserts, a level at a time, so the
+        number of queries depends on the depth of the tree and the number of
+        batches, not the number of objects. Each batch is committed separately
+        unless the caller holds a transaction. If given, progress is called
+        with the number of files written after each batch.
+        """
+        if levels is None:
+            levels = self._snapshot(exclude=root.id) if recursive else []
+        user_id = root.user_id
+        # Maps the id of each source directory to the id of it's copy.
+        dirs = {self.id: root.id}
+
+        # The totals of the copy are those of the files within self, plus the
+        # (copied) totals of it's children.
+        totals = UserFile.objects.filter(parent=self) \
+            .aggregate(size=Sum('file__version__size'), files=Count('id'))
+        totals = [totals['size'] or 0, totals['files'], 0]
+        for subdir in levels[0] if levels else []:
+            totals[0] += subdir[5]
+            totals[1] += subdir[6]
+            totals[2] += subdir[7] + 1
+
+        # The paths of copies are the source paths, relative to self, appended
+        # to the path of root.
+        strip = len(self.path.rstrip('/'))
+        for level in levels:
+            copies = UserDir.objects.bulk_create([
+                UserDir(user_id=user_id, parent_id=dirs[parent_id],
+                        name=subname, path=root.path + path[strip:],
+                        attrs=None if share else attrs, total_size=size,
+                        total_files=files, total_dirs=subdirs)
+                for _, parent_id, subname, attrs, path, size, files, subdirs
+                in level
+            ], batch_size=batch_size)
+            for subdir, copy in zip(level, copies):
+                dirs[subdir[0]] = copy.id
+
+        src_ids, done = list(dirs), 0
+        for i in range(0, len(src_ids), batch_size):
+            batch = src_ids[i:i + batch_size]
+            if not share:
+                Through = UserDir.tags.through
+                Through.objects.bulk_create([
+                    Through(userdir_id=dirs[userdir_id], tag_id=tag_id)
+                    for userdir_id, tag_id in Through.objects
+                    .filter(userdir_id__in=batch)
+                    .values_list('userdir_id', 'tag_id')
+                ], batch_size=batch_size)
+            files = UserFile.objects.filter(parent_id__in=batch) \
+                .order_by('id') \
+                .values_list('id', 'parent_id', 'file_id', 'name', 'attrs',
+                             'file__version_id')
+            last = 0
+            while True:
+                page = list(files.filter(id__gt=last)[:batch_size])
+                if not page:
+                    break
+                last = page[-1][0]
+                with transaction.atomic():
+                    _clone_files(page, dirs, user_id, share)
+                done += len(page)
+                if progress:
+                    progress(done)
+        UserDir.objects.add_usage(user_id, root.path, *totals)
+
+
+def _clone_files(files, dirs, user_id, share):
+    """
+    Copy (or share) a batch of files for UserDir.clone().
+
+    files are tuples of (id, parent_id, file_id, name, attrs, version_id) and
+    dirs maps source directory ids to the ids of their copies.
+    """
+    if share:
+        file_ids = [f[2] for f in files]
+    else:
+        copies = File.objects.bulk_create([
+            File(owner_id=user_id, version_id=f[5]) for f in files
+        ])
+        FileVersion.objects.bulk_create([
+            FileVersion(file_id=copy.id, version_id=copy.version_id)
+            for copy in copies
+        ])
+        file_ids = [copy.id for copy in copies]
+    user_files = UserFile.objects.bulk_create([
+        UserFile(user_id=user_id, parent_id=dirs[f[1]], file_id=file_id,
+                 name=f[3], attrs=None if share else f[4])
+        for f, file_id in zip(files, file_ids)
+    ])
+    if not share:
+        ids = {f[0]: user_file.id for f, user_file in zip(files, user_files)}
+        FileTag.objects.bulk_create([
+            FileTag(file_id=ids[file_id], tag_id=tag_id)
+            for file_id, tag_id in FileTag.objects
+            .filter(file_id__in=list(ids)).values_list('file_id', 'tag_id')
+        ])
+
 
 class UserFileQuerySet(UidQuerySet):
     @staticmethod
@@ -545,30 +962,22 @@ class UserFileQuerySet(UidQuerySet):
                 user = kwargs['user']
             except KeyError:
                 raise ValueError('`user` argument required with `path`')
-            parent, name = pathsplit(path.lstrip('/'))
-            parent = parent if parent else ''
-            if name == '' and parent == '':
-                # If both are empty, caller is asking for '/' or similar, which
-                # cannot be a file.
+            parent, name = pathsplit(normpath(path))
+            if name == '':
+                # Caller is asking for '/' or similar, which cannot be a file.
                 raise UserFile.DoesNotExist()
-            elif parent == '':
-                # If only parent is empty, caller wants a file within root.
-                parent = UserDir.objects.get_root(user)
+            if create_parent:
+                # Caller wants us to create parent dirs (-p). For example,
+                # during create().
+                kwargs['parent'], _ = UserDir.objects.get_or_create(
+                    user=user, path=parent)
             else:
-                # If neither are empty, caller wants a file with a directory.
-                try:
-                    parent = UserDir.objects.get(user=user, path=parent)
-                except UserDir.DoesNotExist:
-                    # Caller may want us to create parent dirs (-p). For
-                    # example, during create().
-                    if not create_parent:
-                        # If not, raise.
-                        raise UserFile.DoesNotExist()
-                    parent = UserDir.objects.create(user=user, path=parent)
+                # Otherwise, the parent is matched by path (using a join).
+                kwargs['parent__user'] = user
+                kwargs['parent__path'] = parent
             # The caller provided a valid path consisting of a parent directory
             # and a name. Set kwargs for the query.
             kwargs['name'] = name
-            kwargs['parent'] = parent
 
     def filter(self, *args, **kwargs):
         try:
@@ -577,10 +986,60 @@ class UserFileQuerySet(UidQuerySet):
             return self.none()
         return super().filter(*args, **kwargs)
 
+    def at_paths(self, user, paths):
+        """
+        Select the user's files at any of paths, using a single query.
+        """
+        children = collections.defaultdict(set)
+        for path in paths:
+            parent, name = pathsplit(normpath(path))
+            if name:
+                children[parent].add(name)
+        if not children:
+            return self.none()
+        return self.filter(
+            reduce(operator.or_, (
+                Q(parent__path=parent, name__in=names)
+                for parent, names in children.items())),
+            user=user, parent__user=user)
+
+    def with_details(self, tags=True, versions=True, shared=True):
+        """
+        Load the related objects needed to describe these files.
+
+        The number of queries does not depend on the number of files, so this
+        is used when listing directories. Related objects the caller does not
+        need can be skipped.
+        """
+        qs = self.select_related('parent', 'file__owner', 'file__version')
+        if tags:
+            qs = qs.prefetch_related('tags')
+        if versions:
+            qs = qs.prefetch_related('file__versions')
+        if shared:
+            qs = qs.prefetch_related(
+                Prefetch('file__user_files',
+                         queryset=UserFile.objects.select_related('user')))
+        return qs
+
     def delete(self):
-        for m in self:
-            m.delete()
+        """
+        Soft-delete the files.
+
+        The files are marked deleted using a single UPDATE, rather than being
+        loaded and deleted one at a time. Returns the number of files deleted.
+        """
+        live = self.filter(deleted__isnull=True)
+        with transaction.atomic():
+            usage = list(
+                live.filter(parent__isnull=False).order_by()
+                .values_list('user_id', 'parent__path')
+                .annotate(Count('id'), Sum('file__version__size')))
+            deleted = live.update(deleted=timezone.now())
+            for user_id, path, files, size in usage:
+                UserDir.objects.add_usage(user_id, path, -(size or 0), -files)
         self._result_cache = None
+        return deleted
 
     delete.alters_data = True
     delete.queryset_only = True
@@ -651,6 +1110,10 @@ class UserFile(UidModelMixin, models.Model):
     own specific namespace, even if they are working with the same files.
     """
 
+    class Meta:
+        # Listings are paged in (name, id) order.
+        index_together = ('parent', 'name')
+
     user = models.ForeignKey(User, related_name='files',
                              on_delete=models.DO_NOTHING)
     # If the parent directory is deleted, soft-delete this file.
@@ -678,12 +1141,33 @@ class UserFile(UidModelMixin, models.Model):
     def isfile(self):
         return True
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._saved_parent_id = self.__dict__.get('parent_id')
+
+    @transaction.atomic
     def save(self, *args, **kwargs):
+        """
+        Maintain the totals of the directories containing the file.
+        """
         try:
             self.file
         except File.DoesNotExist:
             self.file = File.objects.create(owner=self.user)
-        return super().save(*args, **kwargs)
+        adding = self._state.adding
+        obj = super().save(*args, **kwargs)
+        old_parent_id = None if adding else self._saved_parent_id
+        if self.deleted is None and old_parent_id != self.parent_id:
+            size = self.file.version.size
+            if old_parent_id:
+                UserDir.objects.add_usage(
+                    self.user_id, UserDir.objects.filter(id=old_parent_id)
+                    .values_list('path', flat=True).get(), -size, -1)
+            if self.parent_id:
+                UserDir.objects.add_usage(self.user_id, self.parent.path,
+                                          size, 1)
+        self._saved_parent_id = self.parent_id
+        return obj
 
     @property
     def path(self):
@@ -693,6 +1177,15 @@ class UserFile(UidModelMixin, models.Model):
     def extension(self):
         return splitext(self.name)[1]
 
+    @transaction.atomic
+    def delete(self, using=None, keep_parents=False):
+        """Soft-delete the file."""
+        self.deleted = timezone.now()
+        if UserFile.all.filter(pk=self.pk, deleted__isnull=True) \
+                .update(deleted=self.deleted) and self.parent_id:
+            UserDir.objects.add_usage(self.user_id, self.parent.path,
+                                      -self.file.version.size, -1)
+
     def add_tag(self, tag):
         if isinstance(tag, str):
             tag, _ = Tag.objects.get_or_create(name=tag)
@@ -703,8 +1196,80 @@ class UserFile(UidModelMixin, models.Model):
             parent = UserDir.objects.get_root(user)
         if name is None:
             name = self.name
-        return UserFile.objects.create(parent=dir, user=user, file=self.file,
-                                       name=self.name)
+        shared = UserFile.objects.create(parent=parent, user=user,
+                                         file=self.file, name=name)
+        # The target user's hierarchy changed beneath them.
+        DentryCache(user).invalidate(shared.path)
+        return shared
+
+
+class FileQuerySet(QuerySet):
+    def dead(self, before):
+        """
+        Select files deleted by every user before the given time.
+        """
+        return self.exclude(user_files__deleted__isnull=True) \
+                   .exclude(user_files__deleted__gte=before)
+
+    @transaction.atomic
+    def purge(self):
+        """
+        Permanently delete files and their user files.
+
+        Versions no other file refers to are deleted, releasing their chunks.
+        Returns the number of files deleted.
+        """
+        ids = list(self.values_list('id', flat=True))
+        if not ids:
+            return 0
+        versions = list(FileVersion.objects.filter(file_id__in=ids)
+                        .values_list('version_id', flat=True))
+        FileTag.objects.filter(file__file_id__in=ids).delete()
+        UserFile.all.filter(file_id__in=ids)._raw_delete(self.db)
+        FileVersion.objects.filter(file_id__in=ids).delete()
+        File.objects.filter(id__in=ids).delete()
+        # Versions shared with other files (copies) are kept.
+        Version.objects.filter(id__in=versions).orphaned().purge()
+        return len(ids)
+
+    def prune(self, now=None):
+        """
+        Detach versions expired by retention policies.
+
+        Each file uses it's own policy, or that of it's owner. Files without a
+        policy keep every version. Versions no other file refers to are
+        deleted, releasing their chunks. Returns the number of versions
+        detached.
+        """
+        files = list(self.select_related('retention_policy')
+                         .prefetch_related('versions'))
+        defaults = {
+            policy.user_id: policy for policy in RetentionPolicy.objects
+            .filter(user_id__in={f.owner_id for f in files},
+                    file__isnull=True)
+        }
+        expired = []
+        for file in files:
+            try:
+                policy = file.retention_policy
+            except ObjectDoesNotExist:
+                policy = defaults.get(file.owner_id)
+            if policy is None:
+                continue
+            ids = [
+                v.id for v in policy.expired(file.versions.all(), now=now)
+                if v.id != file.version_id
+            ]
+            if ids:
+                expired.append(Q(file_id=file.id, version_id__in=ids))
+        if not expired:
+            return 0
+        with transaction.atomic():
+            fvs = FileVersion.objects.filter(reduce(operator.or_, expired))
+            versions = list(fvs.values_list('version_id', flat=True))
+            count, _ = fvs.delete()
+            Version.objects.filter(id__in=versions).orphaned().purge()
+        return count
 
 
 class File(UidModelMixin, models.Model):
@@ -723,7 +1288,7 @@ class File(UidModelMixin, models.Model):
                                 on_delete=models.PROTECT)
     created = models.DateTimeField(null=False, default=timezone.now)
 
-    objects = models.Manager()
+    objects = FileQuerySet.as_manager()
 
     def save(self, *args, **kwargs):
         new_version = False
@@ -737,6 +1302,18 @@ class File(UidModelMixin, models.Model):
             FileVersion.objects.create(file=self, version=self.version)
         return obj
 
+    def add_size(self, size):
+        """
+        Add size to the totals of the directories containing the file.
+
+        Used when the size of the current version changes, the file may be in
+        the trees of several users.
+        """
+        for user_id, path in self.user_files \
+                .filter(deleted__isnull=True, parent__isnull=False) \
+                .values_list('user_id', 'parent__path'):
+            UserDir.objects.add_usage(user_id, path, size=size)
+
     def add_version(self, version=None):
         if version is None:
             version = Version.objects.create()
@@ -761,6 +1338,26 @@ class FileTag(models.Model):
     tag = models.ForeignKey(Tag, related_name='files')
 
 
+class VersionQuerySet(UidQuerySet):
+    def orphaned(self):
+        """
+        Select versions no file refers to.
+        """
+        return self.filter(file__isnull=True, current_of__isnull=True)
+
+    @transaction.atomic
+    def purge(self):
+        """
+        Delete versions, releasing their chunks.
+
+        Returns the number of versions deleted.
+        """
+        ids = list(self.values_list('id', flat=True))
+        VersionChunk.objects.filter(version_id__in=ids).delete()
+        Version.objects.filter(id__in=ids).delete()
+        return len(ids)
+
+
 class Version(UidModelMixin, models.Model):
     """
     File version model.
@@ -773,7 +1370,8 @@ class Version(UidModelMixin, models.Model):
     (de-dupe).
 
     Chunks are attached to Version, since the Version represents the physical
-    storage of a File.
+    storage of a File. The data of tiny files is instead stored (encrypted) on
+    the row itself, so it can be read without any provider requests.
     """
 
     class Meta:
@@ -781,25 +1379,75 @@ class Version(UidModelMixin, models.Model):
 
     file = models.ManyToManyField(File, related_name='versions',
                                   through='FileVersion')
-    size = models.IntegerField(default=0)
+    # Big, files uploaded in parts (see UploadSession) can exceed 2GB.
+    size = models.BigIntegerField(default=0)
     md5 = models.CharField(max_length=32)
     sha1 = models.CharField(max_length=40)
     # Mime type is derived from file name, but can be overwritten by libmagic
     # during upgrade. Thus, it belongs with the Version, not the File.
     mime = models.CharField(max_length=64)
     created = models.DateTimeField(null=False, default=timezone.now)
+    # Inline data (see store()), a version with data has no chunks.
+    key = models.ForeignKey(Key, null=True, related_name='versions',
+                            on_delete=models.CASCADE)
+    data = models.BinaryField(null=True)
 
-    objects = UidManager()
+    objects = VersionQuerySet.as_manager()
+
+    @property
+    def inline(self):
+        return self.data is not None
+
+    def store(self, user, data):
+        """
+        Store data (the whole content of the version) inline.
+
+        The data is compressed and encrypted like that of a chunk.
+        """
+        self.key = Key.objects.random_key(user)
+        self.data = self.key.encrypt(zlib.compress(data))
+
+    def load(self):
+        """Return the inline data."""
+        return zlib.decompress(self.key.decrypt(bytes(self.data)))
+
+    @staticmethod
+    def count_chunks(version_ids):
+        """
+        Count the stored chunks of versions by storage type.
+
+        Returns {version_id: {storage type name: count}} using a single query.
+        """
+        counts = {version_id: {} for version_id in version_ids}
+        items = ChunkStorage.objects \
+            .filter(chunk__filechunks__version_id__in=version_ids) \
+            .values_list('chunk__filechunks__version_id', 'storage__type') \
+            .annotate(Count('id'))
+        for version_id, type, count in items:
+            counts[version_id][Storage.TYPES[type]] = count
+        return counts
 
     @transaction.atomic
-    def add_chunk(self, chunk):
-        "Adds a chunk to a file, taking care to set the serial number."
-        vc = VersionChunk(version=self, chunk=chunk)
-        vc.serial = (
-            VersionChunk.objects.filter(version=self).select_for_update()
-            .aggregate(Max('serial'))['serial__max'] or 0
-        ) + 1
+    def add_chunk(self, chunk, offset=None, length=None, serial=None):
+        """
+        Adds a chunk to a file, taking care to set the serial number.
+
+        If offset is given, only length bytes of the chunk (a pack) starting at
+        offset belong to the file. Chunks may be added out of order by giving
+        their serial, a chunk already at that serial is replaced.
+        """
+        vc = VersionChunk(version=self, chunk=chunk, offset=offset,
+                          length=length, serial=serial)
+        if serial is None:
+            vc.serial = (
+                VersionChunk.objects.filter(version=self).select_for_update()
+                .aggregate(Max('serial'))['serial__max'] or 0
+            ) + 1
+        else:
+            VersionChunk.objects.filter(version=self, serial=serial).delete()
         vc.save()
+        Chunk.objects.filter(id=chunk.id) \
+            .update(refcount=F('refcount') + 1, gc_marked=None)
         return vc
 
 
@@ -834,6 +1482,76 @@ class FileStat(models.Model):
     last = models.DateTimeField(auto_now=True)
 
 
+class RetentionPolicy(models.Model):
+    """
+    Version retention policy.
+
+    Decides which of a file's versions are kept. A policy without a file is
+    the user's default, a policy for a file overrides it. A version is kept
+    if any rule keeps it, a policy without rules keeps everything. The current
+    version is always kept.
+    """
+
+    class Meta:
+        unique_together = ('user', 'file')
+
+    # Thinning rules, keep the newest version of this many periods.
+    PERIODS = (
+        ('keep_hourly', '%Y-%m-%d %H'),
+        ('keep_daily', '%Y-%m-%d'),
+        ('keep_weekly', '%G-%V'),
+    )
+
+    user = models.ForeignKey(User, related_name='retention_policies',
+                             on_delete=models.CASCADE)
+    file = models.OneToOneField(File, null=True, blank=True,
+                                related_name='retention_policy',
+                                on_delete=models.CASCADE)
+    # Keep this many of the newest versions.
+    keep_last = models.PositiveIntegerField(null=True, blank=True)
+    # Keep versions created in the last this many days.
+    keep_days = models.PositiveIntegerField(null=True, blank=True)
+    keep_hourly = models.PositiveIntegerField(null=True, blank=True)
+    keep_daily = models.PositiveIntegerField(null=True, blank=True)
+    keep_weekly = models.PositiveIntegerField(null=True, blank=True)
+
+    def __str__(self):
+        return '<RetentionPolicy %s, %s>' % (self.user_id, self.file_id)
+
+    def expired(self, versions, now=None):
+        """
+        Return the versions this policy does not keep, newest first.
+        """
+        rules = [self.keep_last, self.keep_days] + \
+            [getattr(self, name) for name, _ in self.PERIODS]
+        if all(rule is None for rule in rules):
+            return []
+        versions = sorted(versions, key=lambda v: (v.created, v.id),
+                          reverse=True)
+        keep = {v.id for v in versions[:max(self.keep_last or 0, 1)]}
+        if self.keep_days is not None:
+            since = (now or timezone.now()) - timedelta(days=self.keep_days)
+            keep.update(v.id for v in versions if v.created >= since)
+        for name, format in self.PERIODS:
+            count, periods = getattr(self, name), set()
+            for v in versions:
+                if not count or len(periods) == count:
+                    break
+                period = v.created.strftime(format)
+                if period not in periods:
+                    periods.add(period)
+                    keep.add(v.id)
+        return [v for v in versions if v.id not in keep]
+
+
+class ChunkQuerySet(UidQuerySet):
+    def unreferenced(self):
+        """
+        Select chunks that no version refers to.
+        """
+        return self.filter(refcount=0)
+
+
 class Chunk(UidModelMixin, models.Model):
     """
     Chunk model.
@@ -849,8 +1567,13 @@ class Chunk(UidModelMixin, models.Model):
     key = models.ForeignKey(Key, related_name='chunks',
                             on_delete=models.CASCADE)
     size = models.IntegerField(null=False, blank=False)
+    # Number of versions referring to this chunk (VersionChunk rows), kept by
+    # Version.add_chunk() and VersionChunkQuerySet.delete().
+    refcount = models.IntegerField(default=0, db_index=True)
+    # Set by the garbage collector when it finds the chunk unreferenced.
+    gc_marked = models.DateTimeField(null=True, db_index=True)
 
-    objects = UidManager()
+    objects = ChunkQuerySet.as_manager()
 
     def __init__(self, *args, **kwargs):
         if not args and 'key' not in kwargs:
@@ -873,6 +1596,25 @@ class Chunk(UidModelMixin, models.Model):
         return zlib.decompress(data)
 
 
+class VersionChunkQuerySet(QuerySet):
+    @transaction.atomic
+    def delete(self):
+        """
+        Delete the rows, releasing their references to chunks.
+
+        Rows must be deleted this way (and not by cascading from Version) to
+        keep Chunk.refcount accurate.
+        """
+        counts = collections.defaultdict(list)
+        refs = collections.Counter(self.values_list('chunk_id', flat=True))
+        for chunk_id, count in refs.items():
+            counts[count].append(chunk_id)
+        for count, chunk_ids in counts.items():
+            Chunk.objects.filter(id__in=chunk_ids) \
+                .update(refcount=F('refcount') - count)
+        return super().delete()
+
+
 class FileChunkManager(models.Manager):
     """
     Manage FileChunks.
@@ -882,7 +1624,8 @@ class FileChunkManager(models.Manager):
         """
         Return QuerySet with default ordering.
         """
-        return QuerySet(self.model, using=self._db).order_by('serial')
+        return VersionChunkQuerySet(self.model, using=self._db) \
+            .order_by('serial')
 
 
 class VersionChunk(models.Model):
@@ -892,6 +1635,10 @@ class VersionChunk(models.Model):
     A file consists of a series of versions, each consisting of a series of
     chunks. This model ties chunks to a file version, ordering for a given
     version is provided by `serial`.
+
+    The data of small files is packed into chunks shared by many versions
+    (see main.fs.PackWriter), such a version uses `length` bytes of the chunk
+    starting at `offset`.
     """
 
     class Meta:
@@ -902,6 +1649,8 @@ class VersionChunk(models.Model):
     chunk = models.ForeignKey(Chunk, on_delete=models.PROTECT,
                               related_name='filechunks')
     serial = models.IntegerField(default=0)
+    offset = models.IntegerField(null=True)
+    length = models.IntegerField(null=True)
 
     objects = FileChunkManager()
 
@@ -909,6 +1658,24 @@ class VersionChunk(models.Model):
         return '%s' % self.serial
 
 
+class ChunkStorageQuerySet(QuerySet):
+    @transaction.atomic
+    def delete(self):
+        """
+        Delete the rows, releasing their storage usage.
+
+        Rows must be deleted this way (and not by cascading from Chunk) to
+        keep the Storage counters accurate.
+        """
+        usage = self.order_by().values('storage_id').annotate(
+            count=Count('id'), bytes=Sum('chunk__size'))
+        for row in usage:
+            Storage.objects.filter(id=row['storage_id']).update(
+                chunk_count=F('chunk_count') - row['count'],
+                chunk_bytes=F('chunk_bytes') - row['bytes'])
+        return super().delete()
+
+
 class ChunkStorage(models.Model):
     """
     Chunk<->Storage M2M model.
@@ -927,9 +1694,294 @@ class ChunkStorage(models.Model):
     # Provider-specific attribute storage, such as the chunk's file ID.
     attrs = JSONField(null=True, blank=True)
 
+    objects = ChunkStorageQuerySet.as_manager()
+
     def __str__(self):
         return '%s@%s' % (self.chunk, self.storage.name)
 
+    @transaction.atomic
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        if adding:
+            Storage.objects.filter(id=self.storage_id).update(
+                chunk_count=F('chunk_count') + 1,
+                chunk_bytes=F('chunk_bytes') + self.chunk.size)
+
+
+class JobQuerySet(UidQuerySet):
+    def claim(self):
+        """
+        Claim the next pending job.
+
+        The job is marked as running (and returned), or None is returned if no
+        jobs are pending. Jobs are locked while being claimed, so concurrent
+        workers never claim the same job. A job that has been running for
+        CLOUDSTRYPE_JOB_TIMEOUT is assumed to have been abandoned (by a worker
+        that crashed) and is claimed again.
+        """
+        abandoned = timezone.now() - \
+            timedelta(seconds=settings.CLOUDSTRYPE_JOB_TIMEOUT)
+        with transaction.atomic():
+            job = self.filter(
+                Q(state=Job.STATE_PENDING) |
+                Q(state=Job.STATE_RUNNING, started__lt=abandoned)) \
+                .order_by('id').select_for_update(skip_locked=True).first()
+            if job is None:
+                return
+            job.state = Job.STATE_RUNNING
+            job.started = timezone.now()
+            job.save(update_fields=['state', 'started'])
+        return job
+
+
+class Job(UidModelMixin, models.Model):
+    """
+    Background job.
+
+    Long running operations (such as sharing a large directory) are recorded as
+    jobs, which are run by the `jobs` management command. Progress is recorded
+    as they run so that it can be reported to the user.
+    """
+
+    TYPE_SHARE = 1
+
+    TYPES = {
+        TYPE_SHARE: 'Share',
+    }
+
+    STATE_PENDING = 0
+    STATE_RUNNING = 1
+    STATE_DONE = 2
+    STATE_FAILED = 3
+
+    STATES = {
+        STATE_PENDING: 'Pending',
+        STATE_RUNNING: 'Running',
+        STATE_DONE: 'Done',
+        STATE_FAILED: 'Failed',
+    }
+
+    user = models.ForeignKey(User, related_name='jobs',
+                             on_delete=models.CASCADE)
+    type = models.SmallIntegerField(null=False, choices=TYPES.items())
+    state = models.SmallIntegerField(null=False, choices=STATES.items(),
+                                     default=STATE_PENDING)
+    args = JSONField(blank=True, default={})
+    # Progress, in units of work (files for a share).
+    total = models.IntegerField(null=False, default=0)
+    done = models.IntegerField(null=False, default=0)
+    error = models.TextField(null=True, blank=True)
+    created = models.DateTimeField(null=False, default=timezone.now)
+    started = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+
+    objects = JobQuerySet.as_manager()
+
+    def __str__(self):
+        return '%s (%s)' % (self.TYPES[self.type], self.STATES[self.state])
+
+    def progress(self, done):
+        """Record progress."""
+        self.done = done
+        Job.objects.filter(pk=self.pk).update(done=done)
+
+    def run(self):
+        """
+        Perform the job.
+
+        Failures are recorded on the job rather than raised.
+        """
+        try:
+            getattr(self, '_run_%s' % self.TYPES[self.type].lower())()
+        except Exception as e:
+            LOGGER.exception(e)
+            self.state, self.error = Job.STATE_FAILED, str(e)
+        else:
+            self.state = Job.STATE_DONE
+        self.finished = timezone.now()
+        self.save(update_fields=['state', 'error', 'finished'])
+
+    def _run_share(self):
+        src = UserDir.objects.get(id=self.args['src'])
+        dst = UserDir.objects.get(id=self.args['dst'])
+        # Starts over if an earlier run was abandoned part way.
+        dst.clear()
+        src.clone_into(dst, share=True, recursive=self.args['recursive'],
+                       progress=self.progress)
+        DentryCache(dst.user).invalidate_all()
+
+
+def upload_expires():
+    """Expiry time of an upload session used now."""
+    return timezone.now() + \
+        timedelta(seconds=settings.CLOUDSTRYPE_UPLOAD_SESSION_TTL)
+
+
+class UploadSessionQuerySet(UidQuerySet):
+    def expired(self, now=None):
+        """
+        Select sessions that have not been used for their time to live.
+        """
+        return self.filter(expires__lt=now or timezone.now())
+
+    @transaction.atomic
+    def purge(self):
+        """
+        Delete sessions and the parts uploaded to them.
+
+        Releases the chunks of the parts (which the garbage collector then
+        reclaims). Returns the number of sessions deleted.
+        """
+        versions = list(self.values_list('version_id', flat=True))
+        count, _ = UploadSession.objects.filter(version_id__in=versions) \
+            .delete()
+        Version.objects.filter(id__in=versions).orphaned().purge()
+        return count
+
+
+class UploadSession(UidModelMixin, models.Model):
+    """
+    Resumable upload.
+
+    A large file is uploaded as a series of numbered parts, which may arrive
+    in any order (and in parallel). Each part is stored as a chunk of the
+    session's version, it's serial being the part number. Uploading a part
+    again replaces it. The file is created (or updated) when the session is
+    committed, abandoned sessions expire and are purged by the garbage
+    collector.
+    """
+
+    user = models.ForeignKey(User, related_name='upload_sessions',
+                             on_delete=models.CASCADE)
+    path = models.TextField(null=False)
+    version = models.OneToOneField(Version, related_name='upload_session',
+                                   on_delete=models.PROTECT)
+    # The size of the file, if given, is checked on commit.
+    size = models.BigIntegerField(null=True)
+    created = models.DateTimeField(null=False, default=timezone.now)
+    # Extended by each part.
+    expires = models.DateTimeField(null=False, default=upload_expires,
+                                   db_index=True)
+
+    objects = UploadSessionQuerySet.as_manager()
+
+    def __str__(self):
+        return '<UploadSession %s>' % self.path
+
+    def touch(self):
+        """Extend the session's life."""
+        self.expires = upload_expires()
+        UploadSession.objects.filter(pk=self.pk).update(expires=self.expires)
+
+    def parts(self):
+        """Return the (number, size) of the parts received, in order."""
+        return list(self.version.filechunks.values_list('serial',
+                                                        'chunk__size'))
+
+
+class ChangeQuerySet(models.QuerySet):
+    def _lock(self, user):
+        """
+        Lock user's journal until the transaction ends.
+
+        Change ids are allocated when recorded, but become visible when the
+        transaction commits. A client that has seen a change could otherwise
+        skip one with a lower id, committed later. With the lock held from
+        allocation to commit, a user's changes become visible in id order.
+        """
+        User.objects.select_for_update().values_list('pk').get(pk=user.pk)
+
+    @transaction.atomic(savepoint=False)
+    def record(self, user, action, obj, old_path=None):
+        """
+        Record a change to obj (a UserFile or UserDir) in user's journal.
+
+        Once the transaction commits, the id of the change is stored in the
+        cache (see latest_key()) so that waiting clients can notice it without
+        querying the journal. Other transactions recording changes for user
+        wait until then, so record changes last.
+        """
+        self._lock(user)
+        change = self.create(user=user, action=action, isdir=obj.isdir,
+                             uid=obj.uid, path=obj.path, old_path=old_path)
+        transaction.on_commit(lambda: default_cache.set(
+            Change.latest_key(user.id), change.id, None))
+        return change
+
+    @transaction.atomic(savepoint=False)
+    def record_many(self, user, action, objs):
+        """
+        Record the same change to many objects, using a single INSERT.
+        """
+        if not objs:
+            return []
+        self._lock(user)
+        changes = self.bulk_create([
+            Change(user=user, action=action, isdir=obj.isdir, uid=obj.uid,
+                   path=obj.path)
+            for obj in objs
+        ])
+        latest = max(change.id for change in changes)
+        transaction.on_commit(lambda: default_cache.set(
+            Change.latest_key(user.id), latest, None))
+        return changes
+
+    def since(self, cursor):
+        """Changes made after cursor, oldest first."""
+        return self.filter(id__gt=cursor).order_by('id')
+
+
+class Change(models.Model):
+    """
+    Change journal.
+
+    Every change to a user's tree is recorded, in order, by the filesystem.
+    Sync clients keep the id of the last change they have seen (their cursor)
+    and fetch only the changes made since, rather than listing their whole
+    tree. Changes to a directory are recorded once, they apply to everything
+    beneath it.
+    """
+
+    ACTION_CREATE = 1
+    ACTION_UPDATE = 2
+    ACTION_MOVE = 3
+    ACTION_DELETE = 4
+    ACTION_TAG = 5
+
+    ACTIONS = {
+        ACTION_CREATE: 'Create',
+        ACTION_UPDATE: 'Update',
+        ACTION_MOVE: 'Move',
+        ACTION_DELETE: 'Delete',
+        ACTION_TAG: 'Tag',
+    }
+
+    class Meta:
+        index_together = ('user', 'id')
+
+    id = models.BigAutoField(primary_key=True)
+    user = models.ForeignKey(User, related_name='changes',
+                             on_delete=models.CASCADE)
+    action = models.SmallIntegerField(null=False, choices=ACTIONS.items())
+    isdir = models.BooleanField(null=False, default=False)
+    # The changed object may no longer exist, so it's uid is recorded.
+    uid = models.CharField(null=False, max_length=64)
+    path = models.TextField(null=False)
+    # The previous path of a moved object.
+    old_path = models.TextField(null=True)
+    created = models.DateTimeField(null=False, default=timezone.now)
+
+    objects = ChangeQuerySet.as_manager()
+
+    def __str__(self):
+        return '%s %s' % (self.ACTIONS[self.action], self.path)
+
+    @staticmethod
+    def latest_key(user_id):
+        """Cache key holding the id of user's latest change."""
+        return 'changes:%s' % user_id
+
 
-from main.fs.clouds import get_client  # NOQA
+from main.fs.clouds import CLIENT_POOL, ASYNC_CLIENT_POOL  # NOQA
 from main.fs.array import ArrayClient  # NOQA
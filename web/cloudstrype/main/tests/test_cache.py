@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+import threading
+
+from django.test import SimpleTestCase
+
+from main.cache import WriteBehindCache, AssembledFileCache
+
+
+class BlockingCache(object):
+    def __init__(self):
+        self.data = {}
+        self.event = threading.Event()
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value, timeout=None):
+        self.event.wait()
+        self.data[key] = value
+
+
+class WriteBehindCacheTestCase(SimpleTestCase):
+    def test_set(self):
+        cache = BlockingCache()
+        cache.event.set()
+        writer = WriteBehindCache(cache)
+        self.assertTrue(writer.set('foo', b'bar'))
+        writer.join()
+        self.assertEqual(b'bar', writer.get('foo'))
+
+    def test_drop(self):
+        cache = BlockingCache()
+        writer = WriteBehindCache(cache, maxsize=1)
+        # The worker takes the first entry and blocks, the second fills the
+        # queue, and the third is dropped.
+        writer.set('foo', b'foo')
+        while writer._queue.qsize():
+            pass
+        self.assertTrue(writer.set('bar', b'bar'))
+        self.assertFalse(writer.set('baz', b'baz'))
+        self.assertEqual(1, writer.dropped)
+        cache.event.set()
+        writer.join()
+        self.assertEqual(b'bar', writer.get('bar'))
+        self.assertIsNone(writer.get('baz'))
+
+
+class AssembledFileCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_writer(self):
+        cache = AssembledFileCache(self.tmpdir)
+        self.assertIsNone(cache.get('foo'))
+
+        writer = cache.writer('foo')
+        writer.write(b'foo')
+        # Partial files are not visible.
+        self.assertIsNone(cache.get('foo'))
+        writer.commit()
+        with open(cache.get('foo'), 'rb') as f:
+            self.assertEqual(b'foo', f.read())
+
+        writer = cache.writer('bar')
+        writer.write(b'bar')
+        writer.abort()
+        self.assertIsNone(cache.get('bar'))
+        self.assertEqual(['foo'], os.listdir(self.tmpdir))
+
+    def test_cull(self):
+        cache = AssembledFileCache(self.tmpdir, max_entries=3)
+        for i, key in enumerate(('foo', 'bar', 'baz')):
+            writer = cache.writer(key)
+            writer.write(b'data')
+            writer.commit()
+            os.utime(cache.path(key), (i, i))
+        writer = cache.writer('qux')
+        writer.write(b'data')
+        writer.commit()
+        # The least recently used entry was removed.
+        self.assertEqual(['bar', 'baz', 'qux'],
+                         sorted(os.listdir(self.tmpdir)))
@@ -1,4 +1,7 @@
+import asyncio
 import httpretty
+import json
+import mock
 
 from django.test import TestCase
 
@@ -9,6 +12,7 @@ from main.fs.clouds.dropbox import DropboxAPIClient
 from main.fs.clouds.onedrive import OnedriveAPIClient
 from main.fs.clouds.box import BoxAPIClient
 from main.fs.clouds.google import GDriveAPIClient
+from main.fs.clouds import get_async_client
 
 TEST_CHUNK_BODY = b'Test chunk body'
 
@@ -191,3 +195,102 @@ class GDriveAPIClientTestCase(OAuth2APIClientTestCase):
 
     def test_authorization_url(self):
         self.assertTrue(self.client.authorization_url())
+
+
+class FakeResponse(object):
+    def __init__(self, status=200, body=b''):
+        self.status = status
+        self.body = body
+
+    async def read(self):
+        return self.body
+
+    def release(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeSession(object):
+    """Records requests, responding with the given responses in turn."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    async def request(self, method, url, **kwargs):
+        self.requests.append((method.upper(), url, kwargs))
+        return self.responses.pop(0)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+
+class AsyncAPIClientTestCase(OAuth2APIClientTestCase):
+    TYPE = Storage.TYPE_DROPBOX
+
+    def run_client(self, type, coro, *responses):
+        """Call a method of the asynchronous client of type."""
+        session = FakeSession(*responses)
+        client = get_async_client(type, storage=self.storage)
+        self.tokens = []
+        client.token_callback = self.tokens.append
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        with mock.patch('main.fs.clouds.aio.get_session',
+                        return_value=session):
+            return loop.run_until_complete(coro(client)), session.requests
+
+    def test_download(self):
+        body, requests = self.run_client(
+            Storage.TYPE_DROPBOX, lambda c: c.download(self.chunk),
+            FakeResponse(body=TEST_CHUNK_BODY))
+        self.assertEqual(TEST_CHUNK_BODY, body)
+        method, url, kwargs = requests[0]
+        self.assertEqual(('POST', DropboxAPIClient.DOWNLOAD_URL[1]),
+                         (method, url))
+        self.assertEqual('Bearer test-access_token',
+                         kwargs['headers']['Authorization'])
+        self.assertEqual('/' + self._get_path(), json.loads(
+            kwargs['headers']['Dropbox-API-Arg'])['path'])
+
+    def test_refresh(self):
+        # The refused request is repeated with the new token.
+        body, requests = self.run_client(
+            Storage.TYPE_ONEDRIVE, lambda c: c.download(self.chunk),
+            FakeResponse(status=401),
+            FakeResponse(body=b'{"access_token": "new-access_token"}'),
+            FakeResponse(body=TEST_CHUNK_BODY))
+        self.assertEqual(TEST_CHUNK_BODY, body)
+        self.assertEqual(OnedriveAPIClient.REFRESH_TOKEN_URL, requests[1][1])
+        self.assertEqual('Bearer new-access_token',
+                         requests[2][2]['headers']['Authorization'])
+        self.assertEqual('new-access_token', self.tokens[0]['access_token'])
+
+    def test_box_conflict(self):
+        # A conflicting file is deleted, the upload is then retried.
+        attrs, requests = self.run_client(
+            Storage.TYPE_BOX, lambda c: c.upload(self.chunk, TEST_CHUNK_BODY),
+            FakeResponse(status=409, body=json.dumps({
+                'context_info': {'conflicts': {'id': 'abc123'}}
+            }).encode('utf-8')),
+            FakeResponse(status=204),
+            FakeResponse(status=201, body=b'{"entries": [{"id": "def456"}]}'))
+        self.assertEqual({'file.id': 'def456'}, attrs)
+        self.assertEqual(
+            ('DELETE', BoxAPIClient.DELETE_URL[1].format(file_id='abc123')),
+            requests[1][:2])
+
+    def test_gdrive_upload(self):
+        attrs, requests = self.run_client(
+            Storage.TYPE_GOOGLE,
+            lambda c: c.upload(self.chunk, TEST_CHUNK_BODY),
+            FakeResponse(body=b'{"id": "abc123"}'))
+        self.assertEqual({'file.id': 'abc123'}, attrs)
+        headers = requests[0][2]['headers']
+        self.assertTrue(
+            headers['Content-Type'].startswith('multipart/related'))
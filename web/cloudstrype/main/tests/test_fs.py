@@ -1,18 +1,30 @@
 import mock
 import shutil
+import tempfile
+import threading
 
+from contextlib import ExitStack
+from datetime import timedelta
 from io import BytesIO
 
-from django.test import TestCase
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
 
-from main.fs import get_fs
+from main.cache import AssembledFileCache, DentryCache
+from main.fs import get_fs, PackWriter, CHUNK_CACHE_WRITER
 from main.fs.clouds import get_client
+from main.fs.collector import ChunkCollector
+from main.fs.compactor import PackCompactor
 from main.fs.errors import (
     PathNotFoundError, FileNotFoundError, DirectoryNotFoundError,
-    DirectoryConflictError, FileConflictError,
+    DirectoryConflictError, FileConflictError, IncompleteUploadError,
 )
 from main.models import (
-    User, Storage,
+    User, Storage, UserDir, UserFile, File, Job, Chunk, ChunkStorage,
+    VersionChunk, Change, UploadSession,
 )
 
 
@@ -47,6 +59,15 @@ class MockClients(object):
     def get_clients(self):
         return self.clients
 
+    def patch(self):
+        """Patch Storage.get_client() to return the mock clients."""
+        clients = {c.storage.id: c for c in self.clients}
+
+        def get_client(storage, *args, **kwargs):
+            return clients[storage.id]
+
+        return mock.patch('main.models.Storage.get_client', get_client)
+
 
 class FilesystemTestCase(TestCase):
     @classmethod
@@ -105,6 +126,116 @@ class FilesystemTestCase(TestCase):
         with self.assertRaises(DirectoryNotFoundError):
             fs.rmdir('/foo')
 
+    def test_rmdir_tree(self):
+        fs = get_fs(self.user)
+        fs.mkdir('/foo/bar/baz').add_tag('qux')
+        for path in ('/foo/a', '/foo/bar/b', '/foo/bar/baz/c', '/foo/bar/d',
+                     '/e'):
+            UserFile.objects.create(path=path, user=self.user)
+        fs.delete('/foo/bar/d')
+
+        with self.assertNumQueries(14):
+            stats = fs.rmdir('/foo')
+        self.assertEqual({'dirs': 3, 'files': 3}, stats)
+        self.assertFalse(fs.exists('/foo'))
+        self.assertFalse(UserDir.objects.filter(path__startswith='/foo',
+                                                user=self.user).exists())
+        self.assertEqual(4, UserFile.dead.filter(user=self.user).count())
+        self.assertFalse(
+            UserFile.dead.filter(user=self.user, parent__isnull=False)
+            .exists())
+        self.assertTrue(fs.isfile('/e'))
+
+    def assertTotals(self, path, size, files, dirs):
+        dir = UserDir.objects.get(path=path, user=self.user)
+        self.assertEqual((size, files, dirs),
+                         (dir.total_size, dir.total_files, dir.total_dirs))
+
+    def test_usage(self):
+        with MockClients(self.user).patch():
+            fs = get_fs(self.user)
+            fs.mkdir('/foo/bar')
+            for path in ('/foo/a', '/foo/bar/b', '/c'):
+                with BytesIO(TEST_FILE) as f:
+                    fs.upload(path, f)
+            size = len(TEST_FILE)
+            self.assertTotals('/', 3 * size, 3, 2)
+            self.assertTotals('/foo', 2 * size, 2, 1)
+            self.assertTotals('/foo/bar', size, 1, 0)
+
+            # A new version replaces the size of the old one.
+            with BytesIO(TEST_FILE * 2) as f:
+                fs.upload('/foo/bar/b', f)
+            self.assertTotals('/foo', 3 * size, 2, 1)
+
+            fs.mkdir('/qux')
+            fs.move('/foo/bar', '/qux')
+            self.assertTotals('/foo', size, 1, 0)
+            self.assertTotals('/qux', 2 * size, 1, 1)
+            fs.move('/c', '/qux/c')
+            self.assertTotals('/qux', 3 * size, 2, 1)
+
+            fs.copy('/qux', '/foo')
+            self.assertTotals('/foo/qux', 3 * size, 2, 1)
+            self.assertTotals('/foo', 4 * size, 3, 2)
+            self.assertTotals('/', 7 * size, 5, 5)
+
+            fs.delete('/foo/a')
+            self.assertTotals('/foo', 3 * size, 2, 2)
+            fs.rmdir('/foo/qux')
+            self.assertTotals('/foo', 0, 0, 0)
+            self.assertTotals('/', 3 * size, 2, 3)
+            UserFile.objects.filter(user=self.user).delete()
+            self.assertTotals('/', 0, 0, 3)
+
+            # Nothing to repair.
+            self.assertEqual(0, UserDir.objects.rebuild_usage(self.user))
+
+    def test_upload_many(self):
+        with MockClients(self.user).patch():
+            fs = get_fs(self.user)
+            fs.mkdir('/dir')
+            with BytesIO(TEST_FILE) as f:
+                fs.upload('/foo/a', f)
+            files = [
+                (path, BytesIO(TEST_FILE)) for path in
+                ('/foo/a', '/foo/b', '/bar/c', '/dir', '/foo/b', '/d')
+            ]
+            results = fs.upload_many(files)
+            self.assertEqual([path for path, _ in files],
+                             [path for path, _ in results])
+            self.assertEqual(
+                [UserFile, UserFile, UserFile, DirectoryConflictError,
+                 FileConflictError, UserFile],
+                [type(result) for _, result in results])
+            for path in ('/foo/a', '/foo/b', '/bar/c', '/d'):
+                with fs.download(path) as f:
+                    self.assertEqual(TEST_FILE, b''.join(iter(f.read, None)))
+            self.assertEqual(2, fs.info('/foo/a').file.versions.count())
+            size = len(TEST_FILE)
+            self.assertTotals('/', 4 * size, 4, 3)
+            self.assertTotals('/foo', 2 * size, 2, 0)
+            self.assertEqual(0, UserDir.objects.rebuild_usage(self.user))
+            self.assertEqual(
+                [(Change.ACTION_CREATE, '/foo/b'),
+                 (Change.ACTION_CREATE, '/bar/c'),
+                 (Change.ACTION_CREATE, '/d'),
+                 (Change.ACTION_UPDATE, '/foo/a')],
+                list(Change.objects.filter(user=self.user)
+                     .values_list('action', 'path').order_by('id'))[-4:])
+
+    def test_rebuild_usage(self):
+        fs = get_fs(self.user)
+        fs.mkdir('/foo/bar')
+        UserFile.objects.create(path='/foo/bar/a', user=self.user)
+        UserDir.objects.filter(user=self.user) \
+            .update(total_size=10, total_files=10, total_dirs=10)
+        self.assertEqual(3, UserDir.objects.rebuild_usage(self.user))
+        self.assertTotals('/', 0, 1, 2)
+        self.assertTotals('/foo/bar', 0, 1, 0)
+        call_command('du', user=self.user.email)
+        self.assertEqual(0, UserDir.objects.rebuild_usage(self.user))
+
     def test_listdir(self):
         fs = get_fs(self.user)
         fs.mkdir('/foo')
@@ -182,6 +313,37 @@ class FilesystemTestCase(TestCase):
         self.assertTrue(fs.isdir('/foo'))
         self.assertTrue(fs.isdir('/bar/foo'))
 
+    def test_copy_tree(self):
+        fs = get_fs(self.user)
+        fs.mkdir('/foo/bar/baz').add_tag('qux')
+        for path in ('/foo/a', '/foo/bar/b', '/foo/bar/baz/c'):
+            file = UserFile.objects.create(path=path, user=self.user,
+                                           attrs={'path': path})
+            file.add_tag('qux')
+
+        # Copying into the tree being copied is fine.
+        fs.copy('/foo', '/foo/bar')
+        for path in ('/foo/a', '/foo/bar/b', '/foo/bar/baz/c'):
+            src = UserFile.objects.get(path=path, user=self.user)
+            dst = UserFile.objects.get(path='/foo/bar' + path, user=self.user)
+            self.assertNotEqual(src.file_id, dst.file_id)
+            self.assertEqual(src.file.version_id, dst.file.version_id)
+            self.assertEqual(1, dst.file.versions.count())
+            self.assertEqual({'path': path}, dst.attrs)
+            self.assertEqual(['qux'], [t.name for t in dst.tags.all()])
+        dir = UserDir.objects.get(path='/foo/bar/foo/bar/baz', user=self.user)
+        self.assertEqual(['qux'], [t.name for t in dir.tags.all()])
+        self.assertFalse(fs.exists('/foo/bar/foo/bar/foo'))
+
+        # The number of queries does not depend on the number of files.
+        with self.assertNumQueries(36):
+            fs.copy('/foo', '/copy1')
+        for i in range(10):
+            UserFile.objects.create(path='/foo/bar/%s' % i, user=self.user)
+        with self.assertNumQueries(36):
+            fs.copy('/foo', '/copy2')
+        self.assertEqual(11, len(fs.listdir('/copy2/bar').files))
+
     def test_copy_file(self):
         with mock.patch('main.models.User.get_clients',
                         MockClients(self.user).get_clients):
@@ -263,6 +425,192 @@ class FilesystemTestCase(TestCase):
             # Two versions of the file should be produced.
             self.assertEqual(2, fi.file.versions.count())
 
+    @override_settings(CLOUDSTRYPE_INLINE_THRESHOLD=len(TEST_FILE))
+    def test_inline(self):
+        clients = MockClients(self.user)
+        fs = get_fs(self.user, chunk_size=len(TEST_FILE))
+        with clients.patch():
+            with BytesIO(TEST_FILE) as f:
+                file = fs.upload('/foo', f)
+        # Stored in the database, not by a provider.
+        first = file.file.version
+        self.assertTrue(first.inline)
+        self.assertEqual(0, Chunk.objects.count())
+        self.assertEqual(len(TEST_FILE), first.size)
+        with fs.download('/foo') as f:
+            self.assertEqual(TEST_FILE, b''.join(f))
+
+        # Once it grows, it is stored in chunks.
+        with clients.patch():
+            with BytesIO(TEST_FILE * 2) as f:
+                file = fs.upload('/foo', f)
+            version = file.file.version
+            self.assertFalse(version.inline)
+            self.assertEqual(2, version.filechunks.count())
+            with fs.download('/foo') as f:
+                self.assertEqual(TEST_FILE * 2, b''.join(f))
+        with fs.download('/foo', version=first) as f:
+            self.assertEqual(TEST_FILE, b''.join(f))
+
+    # Every chunk is cached, so none is read from a stale cache entry.
+    @override_settings(CHUNK_CACHE_WRITE_CHUNKS=None)
+    def test_short_reads(self):
+        class Stream(BytesIO):
+            # Like a socket, returns what has arrived.
+            def read(self, size=-1):
+                return super().read(min(size, 4))
+
+        fs = get_fs(self.user, chunk_size=8)
+        with MockClients(self.user).patch():
+            with Stream(TEST_FILE) as f:
+                file = fs.upload('/foo', f)
+            self.assertEqual([8, 7], [
+                c.size for c in file.file.version.chunks
+                .order_by('filechunks__serial')])
+            CHUNK_CACHE_WRITER.join()
+            with fs.download('/foo') as f:
+                self.assertEqual(TEST_FILE, b''.join(f))
+
+
+class DentryCacheTestCase(TransactionTestCase):
+    # Entries are only cached outside of transactions.
+    def setUp(self):
+        self.user = User.objects.create(email='foo@bar.org')
+        self.fs = get_fs(self.user)
+        self.fs.dentries = DentryCache(self.user, cache=LocMemCache('', {}))
+
+    def test_lookup(self):
+        fs = self.fs
+        fs.mkdir('/foo/bar')
+        self.assertTrue(fs.isdir('/foo/bar'))
+        self.assertFalse(fs.exists('/foo/baz'))
+        # Both positive and negative lookups are now cached.
+        with self.assertNumQueries(0):
+            self.assertTrue(fs.isdir('/foo/bar/'))
+            self.assertFalse(fs.isfile('foo/bar'))
+            self.assertFalse(fs.exists('/foo/baz'))
+        # Loading the object is a single primary key lookup.
+        with self.assertNumQueries(1):
+            self.assertEqual('/foo/bar', fs.info('/foo/bar').path)
+
+    def test_invalidate(self):
+        fs = self.fs
+        self.assertFalse(fs.exists('/foo/bar'))
+        fs.mkdir('/foo/bar')
+        self.assertTrue(fs.isdir('/foo/bar'))
+        fs.mkdir('/baz')
+        fs.move('/foo', '/baz')
+        self.assertFalse(fs.exists('/foo/bar'))
+        self.assertTrue(fs.isdir('/baz/foo/bar'))
+        fs.copy('/baz/foo', '/')
+        self.assertTrue(fs.isdir('/foo/bar'))
+        fs.rmdir('/baz')
+        self.assertFalse(fs.exists('/baz/foo/bar'))
+
+    def test_other_worker(self):
+        fs = self.fs
+        fs.mkdir('/foo/bar')
+        self.assertTrue(fs.isdir('/foo/bar'))
+        # Another worker (with it's own filesystem) removes the tree.
+        other = get_fs(self.user)
+        other.dentries = DentryCache(self.user, cache=fs.dentries.cache)
+        other.rmdir('/foo')
+        self.assertFalse(fs.exists('/foo/bar'))
+
+    def test_share_file(self):
+        other = User.objects.create(email='bar@foo.org')
+        cache = self.fs.dentries.cache
+        fs = get_fs(other)
+        fs.dentries = DentryCache(other, cache=cache)
+        self.assertFalse(fs.exists('/foo'))
+        file = UserFile.objects.create(path='/foo', user=self.user)
+        with mock.patch('main.models.DentryCache',
+                        lambda user: DentryCache(user, cache=cache)):
+            file.share(other)
+        self.assertTrue(fs.isfile('/foo'))
+
+
+class ChangeJournalTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(email='foo@bar.org')
+        self.fs = get_fs(self.user)
+
+    def test_commit_order(self):
+        foo, bar = self.fs.mkdir('/foo'), self.fs.mkdir('/bar')
+
+        def record():
+            try:
+                Change.objects.record(self.user, Change.ACTION_TAG, bar)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=record)
+        with transaction.atomic():
+            Change.objects.record(self.user, Change.ACTION_TAG, foo)
+            thread.start()
+            # Waits for this transaction, so it's change is numbered after.
+            thread.join(0.5)
+            self.assertTrue(thread.is_alive())
+        thread.join()
+        self.assertEqual(
+            ['/foo', '/bar'],
+            list(Change.objects.filter(action=Change.ACTION_TAG)
+                 .order_by('id').values_list('path', flat=True)))
+
+
+class AssembledCacheTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email='foo@bar.org')
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_assemble(self):
+        cache = AssembledFileCache(self.tmpdir)
+        with MockClients(self.user).patch(), \
+                mock.patch('main.fs.ASSEMBLED_CACHE', cache):
+            fs = get_fs(self.user, chunk_size=3)
+
+            with BytesIO(TEST_FILE) as f:
+                file = fs.upload('/foo', f)
+            CHUNK_CACHE_WRITER.join()
+            version = file.file.version
+
+            self.assertIsNone(fs.cached(version))
+            # The chunks are cached, so reading the file assembles it.
+            with fs.download('/foo') as f:
+                self.assertEqual(TEST_FILE, b''.join(f))
+
+            path = fs.cached(version)
+            self.assertIsNotNone(path)
+            with open(path, 'rb') as f:
+                self.assertEqual(TEST_FILE, f.read())
+
+    def test_not_assembled(self):
+        cache = AssembledFileCache(self.tmpdir)
+        with MockClients(self.user).patch(), \
+                mock.patch('main.fs.ASSEMBLED_CACHE', cache), \
+                override_settings(CHUNK_CACHE_WRITE_CHUNKS=None):
+            fs = get_fs(self.user, chunk_size=3)
+            with BytesIO(TEST_FILE) as f:
+                file = fs.upload('/foo', f)
+            CHUNK_CACHE_WRITER.join()
+            version = file.file.version
+
+            # Chunks fetched (out of order) are not assembled.
+            with fs.download('/foo') as f:
+                self.assertEqual(
+                    TEST_FILE, b''.join(f.fetch(c) for c in f.chunks))
+                self.assertIsNone(f._assembled)
+            # Nor are files over the size limit.
+            with override_settings(
+                    CLOUDSTRYPE_ASSEMBLED_CACHE_MAX_SIZE=len(TEST_FILE) - 1):
+                with fs.download('/foo') as f:
+                    self.assertEqual(TEST_FILE, b''.join(f))
+            self.assertIsNone(fs.cached(version))
+
 
 class SharingTestCase(TestCase):
     @classmethod
@@ -301,6 +649,334 @@ class SharingTestCase(TestCase):
                 self.assertTrue(fsb.exists('/foo-bar'))
 
 
+class ShareJobTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.usera = User.objects.create(email='foo@a.org')
+        cls.userb = User.objects.create(email='foo@b.org')
+        for path in ('/foo/a', '/foo/b', '/foo/bar/c', '/foo/bar/baz/d'):
+            UserFile.objects.create(path=path, user=cls.usera)
+        cls.dir = UserDir.objects.get(path='/foo', user=cls.usera)
+
+    def test_share(self):
+        dir = self.dir.share(self.userb, recursive=True)
+        self.assertIsNone(dir.job)
+        fsb = get_fs(self.userb)
+        self.assertTrue(fsb.isfile('/foo/bar/baz/d'))
+        self.assertEqual(
+            UserFile.objects.get(path='/foo/a', user=self.usera).file_id,
+            UserFile.objects.get(path='/foo/a', user=self.userb).file_id)
+
+    def test_share_files(self):
+        self.dir.share(self.userb)
+        self.assertEqual(2, len(get_fs(self.userb).listdir('/foo').files))
+        self.assertFalse(get_fs(self.userb).exists('/foo/bar'))
+
+        file = UserFile.objects.get(path='/foo/a', user=self.usera)
+        file.share(self.userb, name='e')
+        self.assertTrue(get_fs(self.userb).isfile('/e'))
+
+    @override_settings(CLOUDSTRYPE_SHARE_JOB_THRESHOLD=2)
+    def test_share_job(self):
+        dir = self.dir.share(self.userb, recursive=True)
+        job = dir.job
+        self.assertEqual(Job.STATE_PENDING, job.state)
+        self.assertEqual(4, job.total)
+        fsb = get_fs(self.userb)
+        self.assertTrue(fsb.isdir('/foo'))
+        self.assertFalse(fsb.exists('/foo/bar'))
+
+        call_command('jobs')
+        job.refresh_from_db()
+        self.assertEqual(Job.STATE_DONE, job.state)
+        self.assertEqual(4, job.done)
+        self.assertTrue(fsb.isfile('/foo/bar/baz/d'))
+        self.assertEqual(2, len(fsb.listdir('/foo').files))
+
+    @override_settings(CLOUDSTRYPE_SHARE_JOB_THRESHOLD=2)
+    def test_share_job_abandoned(self):
+        dir = self.dir.share(self.userb, recursive=True)
+        job = dir.job
+        # A worker claimed the job, shared some of the files and crashed.
+        self.assertEqual(job, Job.objects.claim())
+        self.dir.clone_into(dir, share=True, recursive=False)
+        self.assertIsNone(Job.objects.claim())
+
+        Job.objects.filter(pk=job.pk).update(
+            started=timezone.now() - timedelta(days=2))
+        call_command('jobs')
+        job.refresh_from_db()
+        self.assertEqual(Job.STATE_DONE, job.state)
+        fsb = get_fs(self.userb)
+        self.assertEqual(2, len(fsb.listdir('/foo').files))
+        self.assertTrue(fsb.isfile('/foo/bar/baz/d'))
+        # Nothing to repair.
+        self.assertEqual(0, UserDir.objects.rebuild_usage(self.userb))
+
+
+@override_settings(CLOUDSTRYPE_INLINE_THRESHOLD=0)
+class PackTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email='foo@bar.org')
+
+    def setUp(self):
+        self.clients = MockClients(self.user)
+        self.fs = get_fs(self.user)
+        self.bodies = {
+            '/%s' % i: TEST_FILE + str(i).encode() for i in range(6)
+        }
+        with self.clients.patch():
+            self.fs.upload_many([
+                (path, BytesIO(body)) for path, body in self.bodies.items()
+            ])
+
+    def read(self, path):
+        with self.fs.download(path) as f:
+            return b''.join(iter(f.read, None))
+
+    def test_pack(self):
+        # One chunk (and one object per replica) for all of the files.
+        pack = Chunk.objects.get()
+        self.assertEqual(6, pack.refcount)
+        self.assertEqual(sum(map(len, self.bodies.values())), pack.size)
+        self.assertEqual(1, sum(len(c.data) for c in self.clients.clients))
+        with self.clients.patch():
+            for path, body in self.bodies.items():
+                self.assertEqual(body, self.read(path))
+                version = self.fs.info(path).file.version
+                self.assertEqual(len(body), version.size)
+
+    @override_settings(CLOUDSTRYPE_PACK_SIZE=30)
+    def test_pack_size(self):
+        with self.clients.patch():
+            self.fs.upload_many([
+                ('/new/%s' % i, BytesIO(TEST_FILE)) for i in range(6)
+            ])
+        # 2 files per pack.
+        self.assertEqual(4, Chunk.objects.count())
+
+    def test_pack_failure(self):
+        client = self.clients.clients[0]
+
+        def write(chunk, data, replicas):
+            # One replica is written, the next fails.
+            client.upload(chunk, data)
+            ChunkStorage.objects.create(chunk=chunk, storage=client.storage)
+            raise IOError('Failed to write chunk')
+
+        with self.clients.patch(), \
+                mock.patch.object(PackWriter, '_write_chunk_replicas',
+                                  side_effect=write):
+            results = self.fs.upload_many([('/new', BytesIO(TEST_FILE))])
+        self.assertIsInstance(results[0][1], IOError)
+        self.assertFalse(self.fs.exists('/new'))
+        # The replica written is recorded, and reclaimed.
+        pack = Chunk.objects.get(refcount=0)
+        self.assertIn(pack.uid, client.data)
+        with self.clients.patch():
+            self.assertEqual((1, 1), ChunkCollector(grace=0).collect())
+        self.assertNotIn(pack.uid, client.data)
+
+    @override_settings(CLOUDSTRYPE_PACK_THRESHOLD=10)
+    def test_threshold(self):
+        with self.clients.patch():
+            self.fs.upload_many([('/large', BytesIO(TEST_FILE))])
+            self.assertEqual(TEST_FILE, self.read('/large'))
+        version = self.fs.info('/large').file.version
+        self.assertIsNone(version.filechunks.get().offset)
+
+    def test_compact(self):
+        pack = Chunk.objects.get()
+        with self.clients.patch():
+            self.fs.copy('/0', '/copy')
+            for path in ('/1', '/2', '/3', '/4'):
+                self.fs.delete(path)
+            File.objects.filter(user_files__deleted__isnull=False).purge()
+            self.assertEqual(0, PackCompactor(ratio=0.1).compact())
+            self.assertEqual(1, PackCompactor().compact())
+            # Nothing left to compact.
+            self.assertEqual(0, PackCompactor().compact())
+
+            pack.refresh_from_db()
+            self.assertEqual(0, pack.refcount)
+            new = Chunk.objects.exclude(id=pack.id).get()
+            self.assertEqual(2, new.refcount)
+            self.assertEqual(len(self.bodies['/0']) + len(self.bodies['/5']),
+                             new.size)
+            for path in ('/0', '/copy', '/5'):
+                self.assertEqual(self.bodies.get(path, self.bodies['/0']),
+                                 self.read(path))
+            call_command('compact')
+
+
+class ChunkCollectorTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email='foo@bar.org')
+
+    def setUp(self):
+        self.cache = LocMemCache('', {})
+        self.clients = MockClients(self.user)
+        self.fs = get_fs(self.user, chunk_size=3)
+        with self.clients.patch():
+            with BytesIO(TEST_FILE) as f:
+                self.foo = self.fs.upload('/foo', f)
+            with BytesIO(TEST_FILE) as f:
+                self.fs.upload('/bar', f)
+        self.chunks = list(self.foo.file.version.chunks.all())
+
+    def stored(self, chunk):
+        return [c for c in self.clients.clients if chunk.uid in c.data]
+
+    def collector(self, **kwargs):
+        return ChunkCollector(cache=self.cache, **kwargs)
+
+    def read(self, path):
+        with self.fs.download(path) as f:
+            return b''.join(iter(f.read, None))
+
+    def test_collect(self):
+        collector = self.collector(grace=0)
+        with self.clients.patch():
+            self.assertEqual((0, 0), collector.collect())
+            self.fs.delete('/foo')
+            self.assertEqual((len(self.chunks), len(self.chunks)),
+                             collector.collect())
+
+            for chunk in self.chunks:
+                self.assertFalse(self.stored(chunk))
+            self.assertFalse(
+                Chunk.objects.filter(id__in=[c.id for c in self.chunks]))
+            self.assertEqual(TEST_FILE, self.read('/bar'))
+
+    def test_grace(self):
+        with self.clients.patch():
+            self.fs.delete('/foo')
+            # Deleted, but still within the grace period.
+            self.assertEqual((0, 0), self.collector().collect())
+            UserFile.all.filter(id=self.foo.id).update(deleted=None)
+            self.assertEqual(TEST_FILE, self.read('/foo'))
+
+    def test_shared(self):
+        with self.clients.patch():
+            self.fs.copy('/foo', '/baz')
+            self.fs.delete('/foo')
+            # The copy shares the version.
+            self.assertEqual((0, 0), self.collector(grace=0).collect())
+            self.assertEqual(TEST_FILE, self.read('/baz'))
+
+    def test_referenced(self):
+        collector = self.collector(grace=0)
+        with self.clients.patch():
+            Chunk.objects.update(gc_marked=timezone.now())
+            # Referenced chunks are unmarked, not deleted.
+            self.assertEqual(0, collector.sweep())
+            self.assertFalse(Chunk.objects.filter(gc_marked__isnull=False))
+            self.assertEqual(TEST_FILE, self.read('/foo'))
+
+    def test_sweep_grace(self):
+        with self.clients.patch():
+            self.fs.delete('/foo')
+            self.collector(grace=0).mark()
+            # Marked, but not for the grace period.
+            self.assertEqual(0, self.collector().sweep())
+            Chunk.objects.filter(gc_marked__isnull=False).update(
+                gc_marked=timezone.now() - timedelta(days=8))
+            self.assertEqual(len(self.chunks), self.collector().sweep())
+
+    def test_refcount(self):
+        chunk = self.chunks[0]
+        self.assertEqual(1, Chunk.objects.get(id=chunk.id).refcount)
+        self.foo.file.add_version().add_chunk(chunk)
+        self.assertEqual(2, Chunk.objects.get(id=chunk.id).refcount)
+        VersionChunk.objects.filter(chunk=chunk).delete()
+        self.assertEqual(0, Chunk.objects.get(id=chunk.id).refcount)
+
+    def test_reconcile(self):
+        Chunk.objects.filter(id=self.chunks[0].id).update(refcount=0)
+        Chunk.objects.filter(id=self.chunks[1].id).update(refcount=3)
+        repaired = 0
+        for i in range(Chunk.objects.count()):
+            repaired += self.collector().reconcile(limit=1)
+        self.assertEqual(2, repaired)
+        self.assertEqual(0, self.collector().reconcile())
+        self.assertEqual(
+            {1}, set(Chunk.objects.values_list('refcount', flat=True)))
+
+    def test_failure(self):
+        collector = self.collector(grace=0)
+        client = self.clients.clients[0]
+        with self.clients.patch(), \
+                mock.patch.object(client, 'delete', side_effect=IOError()):
+            self.fs.delete('/foo')
+            collector.mark()
+            failed = [c for c in self.chunks if client in self.stored(c)]
+            self.assertEqual(len(self.chunks) - len(failed),
+                             collector.sweep())
+        # Only the replica on the failed storage remains.
+        for chunk in failed:
+            self.assertEqual([client], self.stored(chunk))
+            self.assertEqual(
+                [client.storage.id],
+                list(ChunkStorage.objects.filter(chunk=chunk)
+                     .values_list('storage_id', flat=True)))
+        # And is deleted by the next sweep.
+        with self.clients.patch():
+            self.assertEqual(len(failed), collector.sweep())
+
+    def test_upload_session(self):
+        collector = self.collector(grace=0)
+        with self.clients.patch():
+            session = self.fs.start_upload('/big')
+            chunk = self.fs.write_part(session, 1, TEST_FILE)
+            self.assertEqual((0, 0), collector.collect())
+            # Abandoned.
+            UploadSession.objects.update(expires=timezone.now())
+            self.assertEqual((1, 1), collector.collect())
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertFalse(self.stored(chunk))
+
+    def test_upload_part_in_flight(self):
+        collector = self.collector(grace=0)
+        write = self.fs._write_chunk_replicas
+
+        def collect(*args):
+            # The part is being written, and is not yet committed.
+            self.assertEqual((0, 0), collector.collect())
+            with self.assertRaises(IncompleteUploadError):
+                self.fs.commit_upload(session)
+            write(*args)
+
+        with self.clients.patch(), \
+                mock.patch.object(self.fs, '_write_chunk_replicas', collect):
+            session = self.fs.start_upload('/big')
+            self.fs.write_part(session, 1, TEST_FILE)
+            self.fs.commit_upload(session)
+            self.assertEqual(TEST_FILE, self.read('/big'))
+
+    def test_upload_part_failure(self):
+        collector = self.collector(grace=0)
+        with self.clients.patch(), ExitStack() as stack:
+            for client in self.clients.clients:
+                stack.enter_context(mock.patch.object(
+                    client, 'upload', side_effect=IOError()))
+            session = self.fs.start_upload('/big')
+            with self.assertRaises(IOError):
+                self.fs.write_part(session, 1, TEST_FILE)
+        self.assertEqual([], session.parts())
+        # The chunk is released, and reclaimed.
+        with self.clients.patch():
+            self.assertEqual((1, 1), collector.collect())
+
+    def test_command(self):
+        with self.clients.patch():
+            self.fs.delete('/foo')
+            call_command('gc', grace=0)
+        for chunk in self.chunks:
+            self.assertFalse(self.stored(chunk))
+
+
 class GetclientTestCase(TestCase):
     def test_get_client(self):
         with self.assertRaises(ValueError):
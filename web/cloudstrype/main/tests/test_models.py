@@ -1,12 +1,16 @@
 import time
 
+from datetime import timedelta
+
+from django.core.management import call_command
 from django.db import transaction
 from django.db.utils import IntegrityError
 from django.test import TestCase
+from django.utils import timezone
 
 from main.models import (
     User, UserFile, UserDir, Chunk, VersionChunk, Option, Storage,
-    ChunkStorage,
+    ChunkStorage, File, Version, RetentionPolicy,
 )
 from main.fs.clouds.base import BaseOAuth2APIClient
 from main.fs.array import ArrayClient
@@ -29,6 +33,35 @@ class UserDirTestCase(TestCase):
 
         dir1.delete()
 
+    def test_path(self):
+        dir = UserDir.objects.create(path='/a/b/c/d', user=self.user)
+
+        # Lookups are a single query, regardless of depth.
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                dir, UserDir.objects.get(path='/a/b/c/d/', user=self.user))
+        with self.assertNumQueries(1):
+            self.assertFalse(
+                UserDir.objects.filter(path='/a/b/x/d', user=self.user)
+                .exists())
+
+        # Renaming rewrites the paths of descendants.
+        a = UserDir.objects.get(path='/a', user=self.user)
+        a.name = 'z'
+        a.save(update_fields=['name'])
+        self.assertEqual('/z', a.path)
+        self.assertEqual(
+            '/z/b/c/d', UserDir.objects.get(id=dir.id).path)
+
+        # As does moving.
+        b = UserDir.objects.get(path='/z/b', user=self.user)
+        b.parent = UserDir.objects.get_root(self.user)
+        b.save(update_fields=['parent'])
+        self.assertEqual(
+            ['/', '/b', '/b/c', '/b/c/d', '/z'],
+            sorted(UserDir.objects.filter(user=self.user)
+                   .values_list('path', flat=True)))
+
 
 class UserFileTestCase(TestCase):
     @classmethod
@@ -88,6 +121,68 @@ class UserFileTestCase(TestCase):
         file.delete()
 
 
+class RetentionPolicyTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email='foo@bar.org')
+
+    def setUp(self):
+        self.now = timezone.now().replace(
+            hour=12, minute=40, second=0, microsecond=0) - timedelta(days=30)
+        self.file = UserFile.objects.create(path='/foo', user=self.user).file
+        # A version every 20 minutes, newest first.
+        self.versions = []
+        for i in range(12 * 3 * 8):
+            version = Version(created=self.now - timedelta(minutes=20 * i))
+            self.versions.append(version)
+        Version.objects.bulk_create(self.versions)
+        self.versions = list(Version.objects.filter(created__lte=self.now)
+                             .order_by('-created'))
+
+    def kept(self, **kwargs):
+        policy = RetentionPolicy(user=self.user, **kwargs)
+        expired = policy.expired(self.versions, now=self.now)
+        return [v for v in self.versions if v not in expired]
+
+    def test_expired(self):
+        self.assertEqual(self.versions, self.kept())
+        self.assertEqual(self.versions[:5], self.kept(keep_last=5))
+        self.assertEqual(self.versions[:1], self.kept(keep_last=0))
+        # 3 per hour.
+        self.assertEqual(self.versions[:3 * 24 + 1], self.kept(keep_days=1))
+        self.assertEqual(self.versions[:7:3], self.kept(keep_hourly=3))
+        self.assertEqual(
+            [self.versions[0], self.versions[3 * 13]], self.kept(keep_daily=2))
+        self.assertEqual(
+            self.versions[:3] + [self.versions[3 * 13]],
+            self.kept(keep_last=3, keep_daily=2))
+
+    def test_prune(self):
+        chunk = Chunk.objects.create(size=1024, user=self.user)
+        for version in self.versions[1:]:
+            self.file.add_version(version)
+        self.file.add_version(self.versions[0])
+        self.versions[-1].add_chunk(chunk)
+
+        # Without a policy, all versions are kept.
+        self.assertEqual(0, File.objects.all().prune())
+
+        RetentionPolicy.objects.create(user=self.user, keep_last=5)
+        # Plus the version created with the file.
+        self.assertEqual(len(self.versions) - 5 + 1,
+                         File.objects.all().prune(now=self.now))
+        self.assertEqual(5, self.file.versions.count())
+        self.assertEqual(self.versions[0], File.objects.get(
+            id=self.file.id).version)
+        self.assertEqual(0, Chunk.objects.get(id=chunk.id).refcount)
+
+        # A policy for the file overrides the user's.
+        RetentionPolicy.objects.create(user=self.user, file=self.file,
+                                       keep_last=2)
+        call_command('prune')
+        self.assertEqual(2, self.file.versions.count())
+
+
 class UserTestCase(TestCase):
     def test_create(self):
         user = User.objects.create_user('foo@bar.org', full_name='Foo Bar')
@@ -131,6 +226,30 @@ class UserStorageTestCase(TestCase):
         cls.user = User.objects.create_user('foo@bar.org',
                                             full_name='Foo Bar')
 
+    def test_usage(self):
+        storage = Storage.objects.create(type=Storage.TYPE_DROPBOX,
+                                         user=self.user)
+        for size in (10, 20, 30):
+            chunk = Chunk.objects.create(size=size, user=self.user)
+            ChunkStorage.objects.create(chunk=chunk, storage=storage)
+        storage.refresh_from_db()
+        self.assertEqual((3, 60), (storage.chunk_count, storage.chunk_bytes))
+
+        ChunkStorage.objects.filter(chunk=chunk).delete()
+        storage.refresh_from_db()
+        self.assertEqual((2, 30), (storage.chunk_count, storage.chunk_bytes))
+
+        Storage.objects.filter(id=storage.id).update(chunk_count=0)
+        self.assertEqual(1, Storage.objects.all().reconcile())
+        self.assertEqual(0, Storage.objects.all().reconcile())
+        storage.refresh_from_db()
+        self.assertEqual((2, 30), (storage.chunk_count, storage.chunk_bytes))
+
+        self.assertEqual([{
+            'type': Storage.TYPE_DROPBOX, 'name': 'Dropbox', 'storages': 1,
+            'size': 0, 'used': 0, 'chunks': 2, 'stored': 30,
+        }], Storage.objects.all().summary())
+
     def test_oauth2(self):
         storage = Storage.objects.create(type=Storage.TYPE_DROPBOX,
                                          user=self.user)
@@ -153,6 +272,32 @@ class UserStorageTestCase(TestCase):
         self.assertEqual('CCCC', storage.auth['access_token'])
         self.assertEqual('BBBB', storage.auth['refresh_token'])
 
+    def test_client_pool(self):
+        storage = Storage.objects.create(
+            type=Storage.TYPE_DROPBOX, user=self.user,
+            auth={'access_token': 'AAAA', 'expires_at': time.time()})
+        client = storage.get_client()
+        # Rows loaded afresh share the client.
+        self.assertIs(client, Storage.objects.get(id=storage.id).get_client())
+        # As do clients of the provider their connections.
+        other = Storage.objects.create(type=Storage.TYPE_DROPBOX,
+                                       user=self.user)
+        self.assertIs(client.oauthsession.get_adapter('https://'),
+                      other.get_client().oauthsession.get_adapter('https://'))
+
+        # A token refreshed by the client is kept.
+        stale = Storage.objects.get(id=storage.id)
+        client._update_token({'access_token': 'BBBB',
+                              'expires_at': time.time() + 10})
+        self.assertIs(client, stale.get_client())
+
+        # Re-authorizing replaces it.
+        storage.auth_update({'access_token': 'CCCC',
+                             'expires_at': time.time() + 20})
+        fresh = Storage.objects.get(id=storage.id).get_client()
+        self.assertIsNot(client, fresh)
+        self.assertEqual('CCCC', fresh.token['access_token'])
+
     def test_array(self):
         array = Storage.objects.create(type=Storage.TYPE_ARRAY,
                                        user=self.user)
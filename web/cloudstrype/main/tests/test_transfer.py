@@ -0,0 +1,184 @@
+import asyncio
+import json
+import mock
+import os
+import tempfile
+
+from hashlib import md5
+from io import BytesIO
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from django.test import TransactionTestCase, override_settings
+
+from main.fs import (
+    get_fs, MultiCloudFilesystem, CHUNK_CACHE, CHUNK_CACHE_WRITER,
+)
+from main.fs import transfer
+from main.fs.clouds.aio import get_session
+from main.fs.collector import ChunkCollector
+from main.management.commands.transfer import TransferServer
+from main.models import User, Storage, ChunkStorage, UploadSession
+from main.tests.test_fs import MockClients
+
+
+class AsyncMockClient(object):
+    """Asynchronous variant of a MockClient (sharing it's data)."""
+
+    def __init__(self, client):
+        self.client = client
+
+    async def upload(self, chunk, data):
+        return self.client.upload(chunk, data)
+
+    async def download(self, chunk):
+        return self.client.data[chunk.uid]
+
+
+# ORM calls are made from the server's threads, outside of the test case's
+# transaction. Every chunk written is cached, so none is read from a stale
+# cache entry.
+@override_settings(CLOUDSTRYPE_CHUNK_SIZE=1024,
+                   CLOUDSTRYPE_INLINE_THRESHOLD=16,
+                   CHUNK_CACHE_WRITE_CHUNKS=None)
+class TransferServerTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(email='foo@bar.org')
+        self.clients = MockClients(self.user)
+        clients = {c.storage.id: AsyncMockClient(c)
+                   for c in self.clients.clients}
+        for patch in (self.clients.patch(), mock.patch(
+                'main.models.Storage.get_async_client',
+                lambda storage: clients[storage.id])):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.server = TransferServer(workers=4, window=2)
+        self.addCleanup(self.server.close)
+
+    def request(self, token):
+        async def request():
+            server = TestServer(self.server.make_app(), loop=self.loop)
+            async with TestClient(server, loop=self.loop) as client:
+                response = await client.get('/transfer/%s' % token)
+                return response, await response.read()
+
+        asyncio.set_event_loop(self.loop)
+        return self.loop.run_until_complete(request())
+
+    def spool(self, data):
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_download(self):
+        fs = get_fs(self.user, chunk_size=1024)
+        data = os.urandom(5000)
+        with BytesIO(data) as f:
+            user_file = fs.upload('/foo', f)
+        CHUNK_CACHE_WRITER.join()
+        version = user_file.file.version
+
+        token = transfer.sign(transfer.ACTION_DOWNLOAD, self.user,
+                              file=user_file.id, version=version.id,
+                              disposition='attachment; filename="foo"')
+        response, body = self.request(token)
+        self.assertEqual(200, response.status)
+        self.assertEqual('chunked', response.headers['Transfer-Encoding'])
+        self.assertEqual('attachment; filename="foo"',
+                         response.headers['Content-Disposition'])
+        self.assertEqual(data, body)
+
+        # A bad token is refused.
+        response, _ = self.request(token + 'x')
+        self.assertEqual(403, response.status)
+
+    def test_download_uncached(self):
+        fs = get_fs(self.user, chunk_size=1024)
+        data = os.urandom(5000)
+        with BytesIO(data) as f:
+            user_file = fs.upload('/foo', f)
+        CHUNK_CACHE_WRITER.join()
+        version = user_file.file.version
+        CHUNK_CACHE.delete_many(
+            ['chunk:%s' % c.uid for c in version.chunks.all()])
+
+        token = transfer.sign(transfer.ACTION_DOWNLOAD, self.user,
+                              file=user_file.id, version=version.id,
+                              disposition='attachment; filename="foo"')
+        # Read by the asynchronous clients only.
+        with mock.patch('main.models.Storage.get_client',
+                        side_effect=AssertionError()):
+            response, body = self.request(token)
+        self.assertEqual(200, response.status)
+        self.assertEqual(data, body)
+
+    def test_upload(self):
+        data = os.urandom(5000)
+        temp = self.spool(data)
+        token = transfer.sign(transfer.ACTION_UPLOAD, self.user,
+                              path='/foo', temp=temp)
+        # Written by the asynchronous clients only.
+        with mock.patch('main.models.Storage.get_client',
+                        side_effect=AssertionError()):
+            response, body = self.request(token)
+        self.assertEqual(200, response.status)
+        self.assertEqual('/foo', json.loads(body.decode('utf8'))['path'])
+        self.assertFalse(os.path.exists(temp))
+
+        # Written in (5) chunks, the file reads back whole.
+        fs = get_fs(self.user)
+        version = fs.info('/foo').file.version
+        self.assertEqual(5000, version.size)
+        self.assertEqual(md5(data).hexdigest(), version.md5)
+        self.assertEqual(5, version.chunks.count())
+        self.assertEqual(5, ChunkStorage.objects.count())
+        CHUNK_CACHE_WRITER.join()
+        with fs.download('/foo') as f:
+            self.assertEqual(data, b''.join(f))
+
+    def test_upload_collect(self):
+        data = os.urandom(5000)
+        token = transfer.sign(transfer.ACTION_UPLOAD, self.user,
+                              path='/foo', temp=self.spool(data))
+        commit_upload = MultiCloudFilesystem.commit_upload
+
+        def collect(fs, session):
+            # The chunks are written, but not yet committed.
+            self.assertEqual((0, 0), ChunkCollector(grace=0).collect())
+            return commit_upload(fs, session)
+
+        with mock.patch.object(MultiCloudFilesystem, 'commit_upload',
+                               collect):
+            response, _ = self.request(token)
+        self.assertEqual(200, response.status)
+        self.assertEqual(5, ChunkStorage.objects.count())
+        CHUNK_CACHE_WRITER.join()
+        with get_fs(self.user).download('/foo') as f:
+            self.assertEqual(data, b''.join(f))
+
+    def test_upload_failure(self):
+        temp = self.spool(os.urandom(5000))
+        token = transfer.sign(transfer.ACTION_UPLOAD, self.user,
+                              path='/foo', temp=temp)
+        for client in self.clients.clients:
+            client.upload = mock.Mock(side_effect=IOError())
+        response, _ = self.request(token)
+        self.assertEqual(503, response.status)
+        # Nothing was committed.
+        self.assertFalse(get_fs(self.user).exists('/foo'))
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertFalse(os.path.exists(temp))
+
+    def test_cleanup(self):
+        async def serve():
+            server = TestServer(self.server.make_app(), loop=self.loop)
+            async with TestClient(server, loop=self.loop):
+                return get_session(Storage.TYPE_DROPBOX)
+
+        asyncio.set_event_loop(self.loop)
+        session = self.loop.run_until_complete(serve())
+        # Closed when the server shut down.
+        self.assertTrue(session.closed)
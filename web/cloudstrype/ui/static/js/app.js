@@ -138,12 +138,21 @@ var app = app || {};
             /* Called when the user navigate to /files*path. We do the ajax
             here because we need to initialize a model for the directory itself
             as well as a collection for all the directories and files it
-            contains. All of which is returned in the same call. */
-            $.get('/api/v1/me/dirs/by-path:' + path + ':', function(data) {
-                this.breadCrumbView.model.set(data.info);
-                this.pathListView.collection.add(data.dirs);
-                this.pathListView.collection.add(data.files);
-            }.bind(this));
+            contains. All of which is returned in the same call. Large
+            directories are returned a page at a time, so we follow the
+            cursor until the listing is complete. */
+            var url = '/api/v1/me/dirs/by-path:' + path + ':';
+            var load = function(params) {
+                $.get(url, params, function(data) {
+                    this.breadCrumbView.model.set(data.info);
+                    this.pathListView.collection.add(data.dirs);
+                    this.pathListView.collection.add(data.files);
+                    if (data.next) {
+                        load({cursor: data.next});
+                    }
+                }.bind(this));
+            }.bind(this);
+            load({});
         }
     });
 